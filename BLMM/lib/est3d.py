@@ -71,6 +71,9 @@ from BLMM.lib.npMatrix2d import *
 #         -spatially varying). 
 #  - `reml`: Restricted maximum likelihood estimation (currently not implemented)
 #            Default: False. 
+#  - `compact` (optional): The fraction of the rows allocated in memory which
+#                          must be unused before the arrays are reallocated
+#                          (see `compactNow` in `npMatrix3d.py`). Default: 0.25.
 #
 # ----------------------------------------------------------------------------
 #
@@ -82,7 +85,7 @@ from BLMM.lib.npMatrix2d import *
 #                   sigma2, vech(D1),...vech(Dr)) for every voxel.
 #
 # ============================================================================
-def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False):
+def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False, compact=0.25):
     
 
     # ------------------------------------------------------------------------------
@@ -129,7 +132,7 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     dupMatTdict = dict()
     for i in np.arange(len(nraneffs)):
 
-        dupMatTdict[i] = np.asarray(dupMat2D(nraneffs[i]).todense()).transpose()
+        dupMatTdict[i] = dupMatT2D(nraneffs[i])
         
     # ------------------------------------------------------------------------------
     # Inital D
@@ -195,6 +198,15 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # ------------------------------------------------------------------------------
     # Vector checking if all voxels converged
     converged_global = np.zeros(v)
+
+    # The voxels currently held in the arrays (relative to the full list of
+    # voxels) and which of these have not yet converged. Converged voxels are
+    # removed from the arrays in the iteration they converge, and the arrays
+    # are only reallocated once enough of their rows are unused (see
+    # `compactNow` in `npMatrix3d.py`).
+    rows = np.arange(v)
+    active = np.ones(v, dtype=bool)
+    allocated = None
     
     # Vector of saved parameters which have converged
     savedparams = np.zeros((v, np.int32(np.sum(nraneffs*(nraneffs+1)/2) + p + 1),1))
@@ -205,10 +217,12 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # ------------------------------------------------------------------------------
     # Iteration
     # ------------------------------------------------------------------------------
-    while np.any(np.abs(llhprev-llhcurr)>tol):
+    while np.any(active):
 
         # Update number of iterations
         nit = nit + 1
+        compactionStats['iterations'] = compactionStats['iterations'] + 1
+        compactionStats['wasted'] = compactionStats['wasted'] + len(active) - np.count_nonzero(active)
 
         # Change current likelihood to previous
         llhprev = llhcurr
@@ -345,15 +359,17 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update the step size
         # --------------------------------------------------------------------------
-        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtZ, ZtX)
+        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX)
         lam[llhprev>llhcurr] = lam[llhprev>llhcurr]/2
                 
         # --------------------------------------------------------------------------
         # Work out which voxels converged and reduce the set of voxels we look at
         # next iteration
         # --------------------------------------------------------------------------
-        # Get voxel indices in various formats
-        indices_ConAfterIt, indices_notConAfterIt, indices_ConDuringIt, localconverged, localnotconverged = getConvergedIndices(converged_global, (np.abs(llhprev-llhcurr)<tol))
+        # Get indices of the active voxels which converged this iteration
+        localconverged = np.where(active & (np.abs(llhprev-llhcurr)<tol))[0]
+        indices_ConDuringIt = rows[localconverged]
+        active[localconverged] = False
 
         # Update the record of which voxels have converged.
         converged_global[indices_ConDuringIt] = 1
@@ -364,76 +380,39 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update matrices
         # --------------------------------------------------------------------------
-        XtY = XtY[localnotconverged, :, :]
-        YtX = YtX[localnotconverged, :, :]
-        YtY = YtY[localnotconverged, :, :]
-        ZtY = ZtY[localnotconverged, :, :]
-        YtZ = YtZ[localnotconverged, :, :]
-        Zte = Zte[localnotconverged, :, :]
-        ete = ete[localnotconverged, :, :]
-        # In the one factor, one random effect case we only have the diagonal 
-        # D(I+Z'Z)^(-1) elements because D(I+Z'Z)^(-1) is diagonal in this use
-        # case.
-        if r == 1 and nraneffs[0]==1:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :]
-        else:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :, :]
+        # Remove the converged voxels from the arrays
+        if len(localconverged) > 0:
 
-        # Spatially varying design
-        if XtX.shape[0] > 1:
+            # Voxels to keep
+            localnotconverged = np.where(active)[0]
 
-            XtX = XtX[localnotconverged, :, :]
-            ZtX = ZtX[localnotconverged, :, :]
-            XtZ = XtZ[localnotconverged, :, :]
-                
-            # In the one factor, one random effect case we only have the diagonal 
-            # Z'Z elements because Z'Z is diagonal in this use case.
-            if r == 1 and nraneffs[0]==1:
-                ZtZ = ZtZ[localnotconverged, :]
-            else:
-                ZtZ = ZtZ[localnotconverged, :, :]
+            # Reallocate the arrays if enough of their rows are unused,
+            # otherwise move the voxels left into the rows of those removed
+            inPlace = not compactNow(len(localnotconverged), allocated, compact)
+            if not inPlace:
+                allocated = len(localnotconverged)
+                compactionStats['compactions'] = compactionStats['compactions'] + 1
 
-            # ----------------------------------------------------------------------
-            # Update ZtZmat
-            # ----------------------------------------------------------------------
-            # ZtZmat
-            for k in np.arange(len(nraneffs)):
-                if ZtZmatdict[k] is not None:
-                    ZtZmatdict[k]=ZtZmatdict[k][localnotconverged, :, :]
+            # Product matrices (any which don't vary with voxel are unchanged)
+            XtY, YtX, YtY, ZtY, YtZ, Zte, ete = compactRows(localnotconverged, XtY, YtX, YtY, ZtY, YtZ, Zte, ete, inPlace=inPlace)
+            XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD = compactRows(localnotconverged, XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD, inPlace=inPlace)
 
-        # Update n
-        if hasattr(n, "ndim"):
-            # Check if n varies with voxel
-            if n.shape[0] > 1:
-                if n.ndim == 1:
-                    n = n[localnotconverged]
-                if n.ndim == 2:
-                    n = n[localnotconverged,:]
-                if n.ndim == 3:
-                    n = n[localnotconverged,:,:]
+            # Step size and log likelihoods
+            lam, llhprev, llhcurr = compactRows(localnotconverged, lam, llhprev, llhcurr, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update step size and likelihoods
-        # --------------------------------------------------------------------------
-        # Update step size
-        lam = lam[localnotconverged]
+            # Parameters
+            beta, sigma2 = compactRows(localnotconverged, beta, sigma2, inPlace=inPlace)
 
-        # Update log likelihoods
-        llhprev = llhprev[localnotconverged]
-        llhcurr = llhcurr[localnotconverged]
+            # We don't need this representation of D in the simple case of 1 
+            # random factor
+            if r!=1:
+                D, = compactRows(localnotconverged, D, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update paramaters
-        # --------------------------------------------------------------------------
-        beta = beta[localnotconverged, :, :]
-        sigma2 = sigma2[localnotconverged]
-        # We don't need this representation of D in the simple case of 1 random 
-        # factor
-        if r!=1:
-            D = D[localnotconverged, :, :]
+            for k in np.arange(len(nraneffs)):
+                ZtZmatdict[k], Ddict[k] = compactRows(localnotconverged, ZtZmatdict[k], Ddict[k], inPlace=inPlace)
 
-        for k in np.arange(len(nraneffs)):
-            Ddict[k] = Ddict[k][localnotconverged, :, :]
+            # Record which voxels are now held in the arrays
+            rows, active = compactRows(localnotconverged, rows, active, inPlace=inPlace)
             
         # --------------------------------------------------------------------------
         # Matrices needed later:
@@ -496,6 +475,9 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #         -spatially varying). 
 #  - `reml`: Restricted maximum likelihood estimation (currently not implemented)
 #            Default: False. 
+#  - `compact` (optional): The fraction of the rows allocated in memory which
+#                          must be unused before the arrays are reallocated
+#                          (see `compactNow` in `npMatrix3d.py`). Default: 0.25.
 #
 # ----------------------------------------------------------------------------
 #
@@ -507,7 +489,7 @@ def FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #                   sigma2, vech(D1),...vech(Dr)) for every voxel.
 #
 # ============================================================================
-def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False):
+def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False, compact=0.25):
 
     # ------------------------------------------------------------------------------
     # Useful scalars
@@ -553,7 +535,7 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     dupMatTdict = dict()
     for i in np.arange(len(nraneffs)):
 
-        dupMatTdict[i] = np.asarray(dupMat2D(nraneffs[i]).todense()).transpose()
+        dupMatTdict[i] = dupMatT2D(nraneffs[i])
 
     # ------------------------------------------------------------------------------
     # Inital D
@@ -619,6 +601,15 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # ------------------------------------------------------------------------------
     # Vector checking if all voxels converged
     converged_global = np.zeros(v)
+
+    # The voxels currently held in the arrays (relative to the full list of
+    # voxels) and which of these have not yet converged. Converged voxels are
+    # removed from the arrays in the iteration they converge, and the arrays
+    # are only reallocated once enough of their rows are unused (see
+    # `compactNow` in `npMatrix3d.py`).
+    rows = np.arange(v)
+    active = np.ones(v, dtype=bool)
+    allocated = None
     
     # Vector of saved parameters which have converged
     savedparams = np.zeros((v, np.int32(np.sum(nraneffs**2) + p + 1),1))
@@ -629,10 +620,12 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # ------------------------------------------------------------------------------
     # Iteration
     # ------------------------------------------------------------------------------
-    while np.any(np.abs(llhprev-llhcurr)>tol):
+    while np.any(active):
 
         # Update number of iterations
         nit = nit + 1
+        compactionStats['iterations'] = compactionStats['iterations'] + 1
+        compactionStats['wasted'] = compactionStats['wasted'] + len(active) - np.count_nonzero(active)
             
         # --------------------------------------------------------------------------
         # Update loglikelihood and number of voxels
@@ -768,14 +761,16 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update the step size and likelihoods
         # --------------------------------------------------------------------------
-        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtZ, ZtX)
+        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX)
         lam[llhprev>llhcurr] = lam[llhprev>llhcurr]/2
                 
         # --------------------------------------------------------------------------
         # Work out which voxels converged
         # --------------------------------------------------------------------------
-        # Get indices of converged voxels
-        indices_ConAfterIt, indices_notConAfterIt, indices_ConDuringIt, localconverged, localnotconverged = getConvergedIndices(converged_global, (np.abs(llhprev-llhcurr)<tol))
+        # Get indices of the active voxels which converged this iteration
+        localconverged = np.where(active & (np.abs(llhprev-llhcurr)<tol))[0]
+        indices_ConDuringIt = rows[localconverged]
+        active[localconverged] = False
         # Update record of converged voxels
         converged_global[indices_ConDuringIt] = 1
 
@@ -787,73 +782,39 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update matrices
         # --------------------------------------------------------------------------
-        XtY = XtY[localnotconverged, :, :]
-        YtX = YtX[localnotconverged, :, :]
-        YtY = YtY[localnotconverged, :, :]
-        ZtY = ZtY[localnotconverged, :, :]
-        YtZ = YtZ[localnotconverged, :, :]
-        Zte = Zte[localnotconverged, :, :]
-        ete = ete[localnotconverged, :, :]
-        # In the one factor, one random effect case we only have the diagonal 
-        # D(I+Z'Z)^(-1) elements because D(I+Z'Z)^(-1) is diagonal in this use
-        # case.
-        if r == 1 and nraneffs[0]==1:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :]
-        else:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :, :]
+        # Remove the converged voxels from the arrays
+        if len(localconverged) > 0:
 
-        # Spatially varying design
-        if XtX.shape[0] > 1:
+            # Voxels to keep
+            localnotconverged = np.where(active)[0]
 
-            XtX = XtX[localnotconverged, :, :]
-            ZtX = ZtX[localnotconverged, :, :]
-            XtZ = XtZ[localnotconverged, :, :]
-                
-            # In the one factor, one random effect case we only have the diagonal 
-            # Z'Z elements because Z'Z is diagonal in this use case.
-            if r == 1 and nraneffs[0]==1:
-                ZtZ = ZtZ[localnotconverged, :]
-            else:
-                ZtZ = ZtZ[localnotconverged, :, :]
-                
-            # ----------------------------------------------------------------------
-            # Update ZtZmat
-            # ----------------------------------------------------------------------
-            # ZtZmat
-            for k in np.arange(len(nraneffs)):
-                if ZtZmatdict[k] is not None:
-                    ZtZmatdict[k]=ZtZmatdict[k][localnotconverged, :, :]
+            # Reallocate the arrays if enough of their rows are unused,
+            # otherwise move the voxels left into the rows of those removed
+            inPlace = not compactNow(len(localnotconverged), allocated, compact)
+            if not inPlace:
+                allocated = len(localnotconverged)
+                compactionStats['compactions'] = compactionStats['compactions'] + 1
 
-        # Update n
-        if hasattr(n, "ndim"):
-            # Check if n varies with voxel
-            if n.shape[0] > 1:
-                if n.ndim == 1:
-                    n = n[localnotconverged]
-                if n.ndim == 2:
-                    n = n[localnotconverged,:]
-                if n.ndim == 3:
-                    n = n[localnotconverged,:,:]
+            # Product matrices (any which don't vary with voxel are unchanged)
+            XtY, YtX, YtY, ZtY, YtZ, Zte, ete = compactRows(localnotconverged, XtY, YtX, YtY, ZtY, YtZ, Zte, ete, inPlace=inPlace)
+            XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD = compactRows(localnotconverged, XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update step size and log likelihoods
-        # --------------------------------------------------------------------------
-        lam = lam[localnotconverged]
-        llhprev = llhprev[localnotconverged]
-        llhcurr = llhcurr[localnotconverged]
+            # Step size and log likelihoods
+            lam, llhprev, llhcurr = compactRows(localnotconverged, lam, llhprev, llhcurr, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update parameter estimates
-        # --------------------------------------------------------------------------
-        beta = beta[localnotconverged, :, :]
-        sigma2 = sigma2[localnotconverged]
-        # We don't need this representation of D in the simple case of 1 random 
-        # factor
-        if r!=1:
-            D = D[localnotconverged, :, :]
+            # Parameters
+            beta, sigma2 = compactRows(localnotconverged, beta, sigma2, inPlace=inPlace)
 
-        for k in np.arange(len(nraneffs)):
-            Ddict[k] = Ddict[k][localnotconverged, :, :]
+            # We don't need this representation of D in the simple case of 1 
+            # random factor
+            if r!=1:
+                D, = compactRows(localnotconverged, D, inPlace=inPlace)
+
+            for k in np.arange(len(nraneffs)):
+                ZtZmatdict[k], Ddict[k] = compactRows(localnotconverged, ZtZmatdict[k], Ddict[k], inPlace=inPlace)
+
+            # Record which voxels are now held in the arrays
+            rows, active = compactRows(localnotconverged, rows, active, inPlace=inPlace)
             
         # --------------------------------------------------------------------------
         # Matrices needed later by many calculations
@@ -921,6 +882,9 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #         -spatially varying). 
 #  - `reml`: Restricted maximum likelihood estimation (currently not implemented)
 #            Default: False. 
+#  - `compact` (optional): The fraction of the rows allocated in memory which
+#                          must be unused before the arrays are reallocated
+#                          (see `compactNow` in `npMatrix3d.py`). Default: 0.25.
 #
 # ----------------------------------------------------------------------------
 #
@@ -932,7 +896,7 @@ def pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #                   sigma2, vech(D1),...vech(Dr)) for every voxel.
 #
 # ============================================================================
-def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False):
+def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n, reml=False, compact=0.25):
 
     # ------------------------------------------------------------------------------
     # Useful scalars
@@ -978,7 +942,7 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     dupMatTdict = dict()
     for i in np.arange(len(nraneffs)):
 
-        dupMatTdict[i] = np.asarray(dupMat2D(nraneffs[i]).todense()).transpose()
+        dupMatTdict[i] = dupMatT2D(nraneffs[i])
         
     # ------------------------------------------------------------------------------
     # Inital D
@@ -1044,6 +1008,15 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # ------------------------------------------------------------------------------
     # Vector checking if all voxels converged
     converged_global = np.zeros(v)
+
+    # The voxels currently held in the arrays (relative to the full list of
+    # voxels) and which of these have not yet converged. Converged voxels are
+    # removed from the arrays in the iteration they converge, and the arrays
+    # are only reallocated once enough of their rows are unused (see
+    # `compactNow` in `npMatrix3d.py`).
+    rows = np.arange(v)
+    active = np.ones(v, dtype=bool)
+    allocated = None
     
     # Vector of saved parameters which have converged
     savedparams = np.zeros((v, np.int32(np.sum(nraneffs*(nraneffs+1)/2) + p + 1),1))
@@ -1070,10 +1043,12 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
     # Iteration
     # ------------------------------------------------------------------------------
     nit=0
-    while np.any(np.abs(llhprev-llhcurr)>tol):
+    while np.any(active):
 
         # Update number of iterations
         nit = nit + 1
+        compactionStats['iterations'] = compactionStats['iterations'] + 1
+        compactionStats['wasted'] = compactionStats['wasted'] + len(active) - np.count_nonzero(active)
             
         # --------------------------------------------------------------------------
         # Update loglikelihood and number of voxels
@@ -1201,9 +1176,8 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
             Ddict[k] = makeDnnd3D(vech2mat3D(mat2vech3D(Ddict[k]) + update))
             
             # Add D_k back into D and recompute DinvIplusZtZD (This isn't necessary for the
-            # one random effect, one random factor use case as D only contains one unique 
-            # element)
-            if not (r!=1 and nraneffs[0] == 1):
+            # one random factor use case as D is not used)
+            if r!=1:
 
                 for j in np.arange(nlevels[k]):
                     D[:, Dinds[counter]:Dinds[counter+1], Dinds[counter]:Dinds[counter+1]] = Ddict[k]
@@ -1224,15 +1198,17 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update the step size and log likelihoods
         # --------------------------------------------------------------------------
-        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtZ, ZtX)
+        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtiVX)
         lam[llhprev>llhcurr] = lam[llhprev>llhcurr]/2
         
         # --------------------------------------------------------------------------
         # Work out which voxels converged
         # --------------------------------------------------------------------------
 
-        # Get indices of converged voxels
-        indices_ConAfterIt, indices_notConAfterIt, indices_ConDuringIt, localconverged, localnotconverged = getConvergedIndices(converged_global, (np.abs(llhprev-llhcurr)<tol))
+        # Get indices of the active voxels which converged this iteration
+        localconverged = np.where(active & (np.abs(llhprev-llhcurr)<tol))[0]
+        indices_ConDuringIt = rows[localconverged]
+        active[localconverged] = False
 
         # Record which voxels converged this iteration
         converged_global[indices_ConDuringIt] = 1
@@ -1256,73 +1232,39 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
         # --------------------------------------------------------------------------
         # Update matrices
         # --------------------------------------------------------------------------
-        XtY = XtY[localnotconverged, :, :]
-        YtX = YtX[localnotconverged, :, :]
-        YtY = YtY[localnotconverged, :, :]
-        ZtY = ZtY[localnotconverged, :, :]
-        YtZ = YtZ[localnotconverged, :, :]
-        Zte = Zte[localnotconverged, :, :]
-        ete = ete[localnotconverged, :, :]
-        # In the one factor, one random effect case we only have the diagonal 
-        # D(I+Z'Z)^(-1) elements because D(I+Z'Z)^(-1) is diagonal in this use
-        # case.
-        if r == 1 and nraneffs[0]==1:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :]
-        else:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :, :]
+        # Remove the converged voxels from the arrays
+        if len(localconverged) > 0:
 
-        # Spatially varying design
-        if XtX.shape[0] > 1:
+            # Voxels to keep
+            localnotconverged = np.where(active)[0]
 
-            XtX = XtX[localnotconverged, :, :]
-            ZtX = ZtX[localnotconverged, :, :]
-            XtZ = XtZ[localnotconverged, :, :]
-                
-            # In the one factor, one random effect case we only have the diagonal 
-            # Z'Z elements because Z'Z is diagonal in this use case.
-            if r == 1 and nraneffs[0]==1:
-                ZtZ = ZtZ[localnotconverged, :]
-            else:
-                ZtZ = ZtZ[localnotconverged, :, :]
-                
-            # ----------------------------------------------------------------------
-            # Update ZtZmat
-            # ----------------------------------------------------------------------
-            # ZtZmat
-            for k in np.arange(len(nraneffs)):
-                if ZtZmatdict[k] is not None:
-                    ZtZmatdict[k]=ZtZmatdict[k][localnotconverged, :, :]
+            # Reallocate the arrays if enough of their rows are unused,
+            # otherwise move the voxels left into the rows of those removed
+            inPlace = not compactNow(len(localnotconverged), allocated, compact)
+            if not inPlace:
+                allocated = len(localnotconverged)
+                compactionStats['compactions'] = compactionStats['compactions'] + 1
 
-        # Update n
-        if hasattr(n, "ndim"):
-            # Check if n varies with voxel
-            if n.shape[0] > 1:
-                if n.ndim == 1:
-                    n = n[localnotconverged]
-                if n.ndim == 2:
-                    n = n[localnotconverged,:]
-                if n.ndim == 3:
-                    n = n[localnotconverged,:,:]
+            # Product matrices (any which don't vary with voxel are unchanged)
+            XtY, YtX, YtY, ZtY, YtZ, Zte, ete = compactRows(localnotconverged, XtY, YtX, YtY, ZtY, YtZ, Zte, ete, inPlace=inPlace)
+            XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD = compactRows(localnotconverged, XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update step size and log-likelihoods
-        # --------------------------------------------------------------------------
-        lam = lam[localnotconverged]
-        llhprev = llhprev[localnotconverged]
-        llhcurr = llhcurr[localnotconverged]
+            # Step size and log likelihoods
+            lam, llhprev, llhcurr = compactRows(localnotconverged, lam, llhprev, llhcurr, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update parameters
-        # --------------------------------------------------------------------------
-        beta = beta[localnotconverged, :, :]
-        sigma2 = sigma2[localnotconverged]
-        # We don't need this representation of D in the simple case of 1 random 
-        # factor
-        if r!=1:
-            D = D[localnotconverged, :, :]
+            # Parameters
+            beta, sigma2 = compactRows(localnotconverged, beta, sigma2, inPlace=inPlace)
 
-        for k in np.arange(len(nraneffs)):
-            Ddict[k] = Ddict[k][localnotconverged, :, :]
+            # We don't need this representation of D in the simple case of 1 
+            # random factor
+            if r!=1:
+                D, = compactRows(localnotconverged, D, inPlace=inPlace)
+
+            for k in np.arange(len(nraneffs)):
+                ZtZmatdict[k], Ddict[k] = compactRows(localnotconverged, ZtZmatdict[k], Ddict[k], inPlace=inPlace)
+
+            # Record which voxels are now held in the arrays
+            rows, active = compactRows(localnotconverged, rows, active, inPlace=inPlace)
     
     return(savedparams)
 
@@ -1393,6 +1335,23 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #            unlikely this option will be useful and therefore isn't
 #            implemented everywhere or offered to users as an option
 #            currently.
+#  - `maxnit`: The maximum number of iterations.
+#  - `init` (optional): Initial values for the parameters, in the same form
+#                       as `savedparams` (see below), e.g. the estimates from
+#                       neighbouring voxels ("warm starting"). Voxels for
+#                       which `init` contains NaNs are initialised as usual
+#                       (from the OLS estimates).
+#  - `returnNits` (optional): If true, the number of iterations each voxel
+#                             took to converge is also returned.
+#  - `compact` (optional): The fraction of the rows allocated in memory which
+#                          must be unused before the arrays are reallocated
+#                          (see `compactNow` in `npMatrix3d.py`). Default: 0.25.
+#  - `schur` (optional): If true, D(I+Z'ZD)^(-1) is computed by block 
+#                        elimination for designs with multiple random factors
+#                        (see `schurDinvIplusZtZD3D` in `npMatrix3d.py`).
+#  - `returnState` (optional): If true, the quantities computed from the
+#                              final estimates of each voxel, which are also
+#                              needed for inference, are returned as well.
 #
 # ----------------------------------------------------------------------------
 #
@@ -1402,9 +1361,15 @@ def SFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,n,
 #
 #  - `savedparams`: \theta_h in the previous notation; the vector (beta, 
 #                   sigma2, vech(D1),...vech(Dr)) for every voxel.
+#  - `nits` (optional): The number of iterations each voxel took to converge
+#                       (only returned if `returnNits` is true).
+#  - `state` (optional): A dictionary holding, for every voxel, the values of
+#                        `DinvIplusZtZD`, `logdet` (the log determinant of
+#                        I+Z'ZD), `Zte` and `ete` at the final estimates (only
+#                        returned if `returnState` is true).
 #
 # ============================================================================
-def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, reml=False, maxnit=10000):
+def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, reml=False, maxnit=10000, init=None, returnNits=False, compact=0.25, schur=False, returnState=False):
 
     # ------------------------------------------------------------------------------
     # Useful scalars
@@ -1450,7 +1415,7 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
     dupMatTdict = dict()
     for i in np.arange(len(nraneffs)):
 
-        dupMatTdict[i] = np.asarray(dupMat2D(nraneffs[i]).todense()).transpose()
+        dupMatTdict[i] = dupMatT2D(nraneffs[i])
         
     # ------------------------------------------------------------------------------
     # Inital D
@@ -1461,13 +1426,6 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
 
         Ddict[k] = makeDnnd3D(initDk3D(k, ZtZ, Zte, sigma2, nlevels, nraneffs, dupMatTdict))
 
-    # Full version of D (not needed in the 1 random factor case as there
-    # is only one unique block in D)
-    if r == 1:
-        D = None
-    else:
-        D = getDfromDict3D(Ddict, nraneffs, nlevels)
-    
     # ------------------------------------------------------------------------------
     # Index variables
     # ------------------------------------------------------------------------------
@@ -1477,6 +1435,31 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
     # Indices for submatrics corresponding to Dks
     FishIndsDk = np.int32(np.cumsum(nraneffs*(nraneffs+1)/2) + p + 1)
     FishIndsDk = np.insert(FishIndsDk,0,p+1)
+
+    # ------------------------------------------------------------------------------
+    # Warm start
+    # ------------------------------------------------------------------------------
+    # Use any initial values we have been given in place of the OLS based ones
+    if init is not None:
+
+        # Voxels we have initial values for
+        init = init.reshape(v, tnp)
+        warm = np.all(np.isfinite(init), axis=1)
+
+        if np.any(warm):
+
+            beta[warm,:,:] = init[warm,0:p].reshape(np.sum(warm),p,1)
+            sigma2[warm] = init[warm,p].reshape(sigma2[warm].shape)
+
+            for k in np.arange(len(nraneffs)):
+                Ddict[k][warm,:,:] = makeDnnd3D(vech2mat3D(init[warm,FishIndsDk[k]:FishIndsDk[k+1]].reshape(np.sum(warm),FishIndsDk[k+1]-FishIndsDk[k],1)))
+
+    # Full version of D (not needed in the 1 random factor case as there
+    # is only one unique block in D)
+    if r == 1:
+        D = None
+    else:
+        D = getDfromDict3D(Ddict, nraneffs, nlevels)
     
     # ------------------------------------------------------------------------------
     # Obtain D(I+Z'ZD)^(-1)
@@ -1484,7 +1467,7 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
     # Inverse of (I+Z'ZD) multiplied by D. If we are looking at a single random 
     # factor single random effect model DinvIplusZtZD will only hold the diagonal 
     # elements of D(I+Z'ZD)^(-1)
-    DinvIplusZtZD = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs) 
+    DinvIplusZtZD = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs, schur=schur)
 
     # ------------------------------------------------------------------------------
     # Step size and log likelihoods
@@ -1515,9 +1498,29 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
     # ------------------------------------------------------------------------------
     # Vector checking if all voxels converged
     converged_global = np.zeros(v)
+
+    # The voxels currently held in the arrays (relative to the full list of
+    # voxels) and which of these have not yet converged. Converged voxels are
+    # removed from the arrays in the iteration they converge, and the arrays
+    # are only reallocated once enough of their rows are unused (see
+    # `compactNow` in `npMatrix3d.py`).
+    rows = np.arange(v)
+    active = np.ones(v, dtype=bool)
+    allocated = None
     
     # Vector of saved parameters which have converged
     savedparams = np.zeros((v, np.int32(np.sum(nraneffs*(nraneffs+1)/2) + p + 1),1))
+
+    # Number of iterations each voxel took to converge
+    nits = np.zeros(v)
+
+    # Quantities at the final estimates of each voxel. Rows are only filled in
+    # (and, for large arrays, only take up memory) once a voxel has converged.
+    if returnState:
+        state = {'DinvIplusZtZD': np.empty((v,)+DinvIplusZtZD.shape[1:]),
+                 'logdet': np.empty(v),
+                 'Zte': np.empty((v,)+ZtY.shape[1:]),
+                 'ete': np.empty((v,1,1))}
     
     # ------------------------------------------------------------------------------
     # Work out D indices (there is one block of D per level)
@@ -1541,10 +1544,12 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
     # Iteration
     # ------------------------------------------------------------------------------
     nit=0
-    while np.any(np.abs(llhprev-llhcurr)>tol):
+    while np.any(active):
 
         # Update number of iterations
         nit = nit + 1
+        compactionStats['iterations'] = compactionStats['iterations'] + 1
+        compactionStats['wasted'] = compactionStats['wasted'] + len(active) - np.count_nonzero(active)
 
         # If we've hit maximum number of iterations halt.
         if (nit > maxnit):
@@ -1554,7 +1559,7 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
 
             # Print warning:
             print('Maxmimum number of iterations, ' + str(maxnit) + ', reached whilst estimating ' +
-                  str(np.prod(llhprev.shape)) + ' voxels.')
+                  str(np.count_nonzero(active)) + ' voxels.')
             
         # --------------------------------------------------------------------------
         # Update loglikelihood and number of voxels
@@ -1597,6 +1602,8 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
 
         # If in reml mode it is useful to get ZtiVX at this point as 
         # we need it for dldB but we have all the building blocks here
+        # (otherwise it is not needed)
+        ZtiVX = None
         if reml==True:
 
             if r == 1 and nraneffs[0]==1:
@@ -1624,6 +1631,10 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
                 # Get Z'V^{-1}X
                 ZtiVX = ZtX - ZtZ @ DinvIplusZtZDZtX
 
+        # Reshape appropriately (in reml mode this was done above)
+        if r == 1 and nraneffs[0] > 1 and reml==False:
+            DinvIplusZtZDZtX = DinvIplusZtZDZtX.reshape(v_iter,q0*l0,p)
+
         # Work out X'V^(-1)X and X'V^(-1)Y by dimension reduction formulae
         XtiVX = XtX - DinvIplusZtZDZtX.transpose((0,2,1)) @ ZtX
         XtiVY = XtY - DinvIplusZtZDZtX.transpose((0,2,1)) @ ZtY
@@ -1750,7 +1761,7 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
         # Inverse of (I+Z'ZD) multiplied by D. If we are looking at a single random 
         # factor single random effect model DinvIplusZtZD will only hold the diagonal 
         # elements of D(I+Z'ZD)^(-1)
-        DinvIplusZtZD = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs)  
+        DinvIplusZtZD, logdet = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs, returnLogdet=True, schur=schur)
 
         # --------------------------------------------------------------------------
         # Recalculate matrices
@@ -1764,18 +1775,21 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
         # --------------------------------------------------------------------------
         # Update the step size and log likelihood
         # --------------------------------------------------------------------------
-        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtiVX)
+        llhcurr = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml, XtX, XtiVX, logdet=logdet)
 
         lam[llhprev>llhcurr] = lam[llhprev>llhcurr]/2
         
         # --------------------------------------------------------------------------
         # Work out which voxels converged
         # --------------------------------------------------------------------------
-        # Obatin indices of converged voxels
-        indices_ConAfterIt, indices_notConAfterIt, indices_ConDuringIt, localconverged, localnotconverged = getConvergedIndices(converged_global, (np.abs(llhprev-llhcurr)<tol))
+        # Get indices of the active voxels which converged this iteration
+        localconverged = np.where(active & (np.abs(llhprev-llhcurr)<tol))[0]
+        indices_ConDuringIt = rows[localconverged]
+        active[localconverged] = False
 
         # Record which voxels converged.
         converged_global[indices_ConDuringIt] = 1
+        nits[indices_ConDuringIt] = nit
 
         # --------------------------------------------------------------------------
         # Save parameters from this run
@@ -1792,79 +1806,50 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
             # random effects for factor k squared, 1))
             vech_Dk = vech_Dk.reshape(len(localconverged),nraneffs[k]*(nraneffs[k]+1)//2,1)
             savedparams[indices_ConDuringIt,FishIndsDk[k]:FishIndsDk[k+1],:]=vech_Dk
+
+        # Save the quantities inference needs at these estimates
+        if returnState:
+            state['DinvIplusZtZD'][indices_ConDuringIt] = DinvIplusZtZD[localconverged]
+            state['logdet'][indices_ConDuringIt] = logdet[localconverged]
+            state['Zte'][indices_ConDuringIt] = Zte[localconverged]
+            state['ete'][indices_ConDuringIt] = ete[localconverged].reshape(len(localconverged),1,1)
             
         # --------------------------------------------------------------------------
         # Update matrices
         # --------------------------------------------------------------------------
-        XtY = XtY[localnotconverged, :, :]
-        YtX = YtX[localnotconverged, :, :]
-        YtY = YtY[localnotconverged, :, :]
-        ZtY = ZtY[localnotconverged, :, :]
-        YtZ = YtZ[localnotconverged, :, :]
-        ete = ete[localnotconverged, :, :]
-
-        # Spatially varying design
-        if XtX.shape[0] > 1:
+        # Remove the converged voxels from the arrays
+        if len(localconverged) > 0:
 
-            XtX = XtX[localnotconverged, :, :]
-            ZtX = ZtX[localnotconverged, :, :]
-            XtZ = XtZ[localnotconverged, :, :]
-                
-            # In the one factor, one random effect case we only have the diagonal 
-            # Z'Z elements because Z'Z is diagonal in this use case.
-            if r == 1 and nraneffs[0]==1:
-                ZtZ = ZtZ[localnotconverged, :]
-            else:
-                ZtZ = ZtZ[localnotconverged, :, :]
+            # Voxels to keep
+            localnotconverged = np.where(active)[0]
 
+            # Reallocate the arrays if enough of their rows are unused,
+            # otherwise move the voxels left into the rows of those removed
+            inPlace = not compactNow(len(localnotconverged), allocated, compact)
+            if not inPlace:
+                allocated = len(localnotconverged)
+                compactionStats['compactions'] = compactionStats['compactions'] + 1
 
-            # ----------------------------------------------------------------------
-            # Update ZtZmat
-            # ----------------------------------------------------------------------
-            # ZtZmat
-            for k in np.arange(len(nraneffs)):
-                if ZtZmatdict[k] is not None:
-                    ZtZmatdict[k]=ZtZmatdict[k][localnotconverged, :, :]
+            # Product matrices (any which don't vary with voxel are unchanged)
+            XtY, YtX, YtY, ZtY, YtZ, ete = compactRows(localnotconverged, XtY, YtX, YtY, ZtY, YtZ, ete, inPlace=inPlace)
+            XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD = compactRows(localnotconverged, XtX, ZtX, XtZ, ZtZ, n, DinvIplusZtZD, inPlace=inPlace)
 
-        # Update n
-        if hasattr(n, "ndim"):
-            # Check if n varies with voxel
-            if n.shape[0] > 1:
-                if n.ndim == 1:
-                    n = n[localnotconverged]
-                if n.ndim == 2:
-                    n = n[localnotconverged,:]
-                if n.ndim == 3:
-                    n = n[localnotconverged,:,:]
-                
-        # In the one factor, one random effect case we only have the diagonal 
-        # D(I+Z'Z)^(-1) elements because D(I+Z'Z)^(-1) is diagonal in this use
-        # case.
-        if r == 1 and nraneffs[0]==1:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :]
-        else:
-            DinvIplusZtZD = DinvIplusZtZD[localnotconverged, :, :]
+            # Step size and log likelihoods
+            lam, llhprev, llhcurr = compactRows(localnotconverged, lam, llhprev, llhcurr, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update step size and log likelihoods
-        # --------------------------------------------------------------------------
-        lam = lam[localnotconverged]
-        llhprev = llhprev[localnotconverged]
-        llhcurr = llhcurr[localnotconverged]
+            # Parameters
+            beta, sigma2 = compactRows(localnotconverged, beta, sigma2, inPlace=inPlace)
 
-        # --------------------------------------------------------------------------
-        # Update parameters
-        # --------------------------------------------------------------------------
-        beta = beta[localnotconverged, :, :]
-        sigma2 = sigma2[localnotconverged]
+            # We don't need this representation of D in the simple case of 1 
+            # random factor
+            if r!=1:
+                D, = compactRows(localnotconverged, D, inPlace=inPlace)
 
-        # We don't need this representation of D in the simple case of 1 random 
-        # factor
-        if r!=1:
-            D = D[localnotconverged, :, :]
+            for k in np.arange(len(nraneffs)):
+                ZtZmatdict[k], Ddict[k] = compactRows(localnotconverged, ZtZmatdict[k], Ddict[k], inPlace=inPlace)
 
-        for k in np.arange(len(nraneffs)):
-            Ddict[k] = Ddict[k][localnotconverged, :, :]
+            # Record which voxels are now held in the arrays
+            rows, active = compactRows(localnotconverged, rows, active, inPlace=inPlace)
             
         # --------------------------------------------------------------------------
         # Matrices needed later by many calculations
@@ -1873,5 +1858,12 @@ def pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol,
         Xte = XtY - (XtX @ beta)
         Zte = ZtY - (ZtX @ beta)
     
-    return(savedparams)
+    if returnNits and returnState:
+        return(savedparams, nits, state)
+    elif returnNits:
+        return(savedparams, nits)
+    elif returnState:
+        return(savedparams, state)
+    else:
+        return(savedparams)
 
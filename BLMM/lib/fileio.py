@@ -1,5 +1,9 @@
 import os
+import json
 import time
+import pickle
+import queue
+import threading
 import pandas as pd
 import nibabel as nib
 import numpy as np
@@ -289,6 +293,226 @@ def addBlockToNifti(fname, block, blockInds,dim=None,volInd=None,aff=None,hdr=No
     del nifti, fname, data_out, affine
 
 
+# ============================================================================
+#
+# The below function writes a block of voxels, destined for an output NIFTI,
+# to a compact "shard" file instead of the NIFTI itself. Each shard holds
+# only the voxels in `blockInds` and is saved under `tmp/shards` in the 
+# output directory, keyed by the NIFTI name, the volume written to and the 
+# first voxel in the block (each voxel is only ever computed by one job). The
+# shards are assembled into the output NIFTIs once, during cleanup (see 
+# `blmm_cleanup.assembleShards`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `fname`: An absolute path to the Nifti file the block belongs to.
+# - `block`: The block of values to write to the NIFTI.
+# - `blockInds`: The (flattened) indices of the 3D voxels `block` should be
+#                written to (see `addBlockToNifti`).
+# - `dim` (optional): The dimensions of the NIFTI image.
+# - `volInd` (optional): If we only want to write to one 3D volume/slice,
+#                        within a 4D file, this specifies the index of the
+#                        volume of interest.
+#
+# ============================================================================
+def addBlockToShard(fname, block, blockInds, dim=None, volInd=None):
+
+  # Nothing to write
+  blockInds = np.asarray(blockInds).reshape(-1)
+  if blockInds.shape[0]==0:
+    return
+
+  # Directory holding the shards for this NIFTI
+  shardDir = os.path.join(os.path.dirname(fname), 'tmp', 'shards',
+                          os.path.basename(fname).replace('.gz','').replace('.nii',''))
+  os.makedirs(shardDir, exist_ok=True)
+
+  # Record the dimensions of the NIFTI (every job records the same ones)
+  if dim is not None and not os.path.isfile(os.path.join(shardDir, 'dim.npy')):
+    with open(os.path.join(shardDir, 'dim.' + str(os.getpid()) + '.part'), 'wb') as f:
+      np.save(f, np.array(dim, dtype=np.int64))
+    os.replace(os.path.join(shardDir, 'dim.' + str(os.getpid()) + '.part'),
+               os.path.join(shardDir, 'dim.npy'))
+
+  # Work out which volume(s) the block is for
+  if volInd is None:
+    volStr = 'all'
+  else:
+    volStr = str(int(volInd))
+
+  # The shard; voxel indices followed by their values
+  shard = np.concatenate((blockInds.reshape(-1,1),
+                          np.asarray(block).reshape(blockInds.shape[0],-1)), axis=1)
+
+  # Write the shard, or hand it to the output sink if there is one running
+  filename = os.path.join(shardDir, volStr + '_' + str(blockInds[0]) + '.npy')
+  if 'queue' in outputSink:
+    t1 = time.time()
+    outputSink['queue'].put((filename, shard))
+    outputSink['wait'] = outputSink['wait'] + time.time() - t1
+  else:
+    writeShard(filename, shard)
+
+
+# ============================================================================
+#
+# The below function saves a shard (see `addBlockToShard`) under a temporary
+# name and then renames it, so that a job which fails does not leave behind a
+# partially written shard.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `filename`: The shard file.
+# - `shard`: The shard to save.
+#
+# ============================================================================
+def writeShard(filename, shard):
+
+  with open(filename + '.part', 'wb') as f:
+    np.save(f, shard)
+  os.replace(filename + '.part', filename)
+
+
+# ============================================================================
+#
+# The output sink lets a job carry on with its computation whilst its shards
+# are written to disk. Whilst the sink is running, `addBlockToShard` places
+# each shard on a bounded queue, which a background thread writes out. The
+# below dictionary holds the state of the sink for this process.
+#
+# ============================================================================
+outputSink = dict()
+
+
+# ============================================================================
+#
+# The below function starts the output sink.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `maxsize` (optional): The maximum number of shards which may be waiting
+#                         to be written at any one time. Once the queue is 
+#                         full `addBlockToShard` waits for the writer.
+#
+# ============================================================================
+def startOutputSink(maxsize=16):
+
+  # Make sure any previous sink has finished
+  flushOutputSink()
+
+  outputSink['queue'] = queue.Queue(maxsize=maxsize)
+  outputSink['written'] = []
+  outputSink['errors'] = []
+  outputSink['wait'] = 0
+
+  # Start the writer
+  outputSink['thread'] = threading.Thread(target=runOutputSink,
+                                          args=(outputSink['queue'],
+                                                outputSink['written'],
+                                                outputSink['errors']),
+                                          daemon=True)
+  outputSink['thread'].start()
+
+
+# ============================================================================
+#
+# The below function is run by the output sink's background thread. It 
+# writes shards from the queue until it is told to stop (by `None` being 
+# placed on the queue).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `shardQueue`: The queue of (filename, shard) pairs to write.
+# - `written`: A list to which the filename of each shard is appended once it
+#              has been written.
+# - `errors`: A list to which any errors raised whilst writing are appended.
+#
+# ============================================================================
+def runOutputSink(shardQueue, written, errors):
+
+  while True:
+
+    item = shardQueue.get()
+
+    # Check if we are done
+    if item is None:
+      break
+
+    # Write the shard (recording, rather than raising, any errors so that
+    # the queue keeps draining)
+    try:
+      writeShard(item[0], item[1])
+      written.append(item[0])
+    except Exception as error:
+      errors.append(error)
+
+
+# ============================================================================
+#
+# The below function waits for every shard given to the output sink to be
+# written and then stops the sink. Optionally, the filenames of the shards 
+# written are recorded in a "manifest" file, so that the cleanup stage can 
+# check every write landed (see `blmm_cleanup.assembleShards`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `manifest` (optional): The file to record the written shards in.
+#
+# ============================================================================
+def flushOutputSink(manifest=None):
+
+  # Check the sink is running
+  if 'queue' not in outputSink:
+    return
+
+  t1 = time.time()
+
+  # Wait for the writer to finish
+  outputSink['queue'].put(None)
+  outputSink['thread'].join()
+
+  t2 = time.time()
+
+  written = outputSink['written']
+  errors = outputSink['errors']
+  wait = outputSink['wait']
+  outputSink.clear()
+
+  if errors:
+    raise errors[0]
+
+  print('Output sink wrote ' + str(len(written)) + ' shards (waited ' + 
+        '{:.2f}'.format(wait) + 's for the queue and ' + '{:.2f}'.format(t2-t1) +
+        's for the final writes)')
+
+  # Record the shards written
+  if manifest is not None:
+    with open(manifest + '.part', 'w') as f:
+      for filename in written:
+        print(filename, file=f)
+    os.replace(manifest + '.part', manifest)
+
+
 # ============================================================================
 #
 # The below function reads in a numpy file as a memory map and returns the 
@@ -372,6 +596,153 @@ def get_amInds(am, vb=None, nvb=None):
   return(amInds)
 
 
+# ============================================================================
+#
+# The below function reads in only the voxels with the given (flattened)
+# indices from a NIFTI volume and returns them as a 1D vector. For
+# uncompressed images the data is memory mapped, so that only the requested
+# voxels are read from disk. Compressed images cannot be memory mapped and
+# are instead read in full before the voxels are extracted.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `filepath`: The NIFTI volume.
+# - `inds`: The flattened indices of the voxels to be read (e.g. as given by
+#           `get_amInds`).
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `data`: The values of the requested voxels, as a 1D vector.
+#
+# ============================================================================
+def loadVoxels(filepath, inds):
+
+  # Load in the image (this only reads the header)
+  img = nib.load(filepath)
+
+  # If the image is uncompressed we can memory map it and read only the
+  # voxels we need
+  if not filepath.lower().endswith('.gz') and nib.is_proxy(img.dataobj):
+
+    # Memory mapped, unscaled data
+    data = img.dataobj.get_unscaled()
+
+    # Read the voxels we need
+    data = np.asarray(data[np.unravel_index(inds, data.shape)], dtype=np.float64)
+
+    # Apply any scaling stored in the header
+    slope = img.dataobj.slope
+    inter = img.dataobj.inter
+    if slope != 1 or inter != 0:
+      data = data*slope + inter
+
+  else:
+
+    # Read in the full volume and extract the voxels we need
+    data = np.asarray(img.dataobj, dtype=np.float64).reshape(-1)[inds]
+
+  return(data)
+
+
+# ============================================================================
+#
+# The below function opens a store of input images made by `blmm_import.py`.
+# The store holds the (masked and thresholded) input images as a series of
+# blocks of voxels, each saved as a `.npy` file, alongside a JSON manifest
+# describing them. The blocks are memory mapped, so only the parts of them
+# which are used are read from disk. If the inputs of an analysis are given,
+# they are checked against the masks the store was made with.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `storeDir`: The directory of the store.
+# - `inputs` (optional): The inputs dictionary read from a blmm inputs cfg
+#                        file. If `data_mask_files` or `data_mask_thresh` are
+#                        given, they must match those the store was made
+#                        with, as the store cannot be masked again.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `store`: The manifest of the store (see `blmm_import.py`), as a 
+#            dictionary, with the following fields added:
+#     - `Y`: A list of the memory mapped blocks of the store. Blocks with
+#            `layout` `voxel` are voxels by observations arrays and blocks
+#            with `layout` `observation` are observations by voxels arrays.
+#     - `starts`: The index, in `voxels`, of the first voxel of each block.
+#     - `voxels`: The (flattened) indices of the voxels held in the store,
+#                 in the order they are held in the blocks.
+#     - `templateFile`: A NIFTI with the dimensions, affine and header of 
+#                       the input images.
+#     - `dir`: The directory of the store.
+#
+# ============================================================================
+def loadYStore(storeDir, inputs=None):
+
+  # Read the manifest
+  try:
+    with open(os.path.join(storeDir, 'manifest.json')) as f:
+      store = json.load(f)
+  except FileNotFoundError:
+    raise ValueError('The directory "' + storeDir + '" is not a BLMM input store (see blmm_import.py)')
+
+  # Stores made before the blocks were introduced hold a single observation
+  # major block
+  if store['version'] == 1:
+    store['layout'] = 'observation'
+    store['chunks'] = [store['data']]
+
+  # Memory map the data
+  store['Y'] = [np.load(os.path.join(storeDir, chunk), mmap_mode='r') for chunk in store['chunks']]
+  store['voxels'] = np.load(os.path.join(storeDir, store['inds']))
+  store['templateFile'] = os.path.join(storeDir, store['template'])
+  store['dir'] = storeDir
+
+  # Check the data is what the manifest says it is
+  nvox = [Y.shape[store['layout']=='observation'] for Y in store['Y']]
+  nobs = [Y.shape[store['layout']=='voxel'] for Y in store['Y']]
+  if np.sum(nvox) != len(store['voxels']) or np.any(np.array(nobs) != store['n']):
+    raise ValueError('The input store "' + storeDir + '" is incomplete or corrupted')
+
+  store['starts'] = np.concatenate(([0], np.cumsum(nvox)[:-1])).astype(np.int64)
+
+  # The store has already been masked and thresholded, so the analysis must
+  # not ask for anything different
+  if inputs is not None:
+
+    if 'data_mask_files' in inputs:
+
+      with open(inputs['data_mask_files']) as a:
+        M_files = [line.replace('\n', '') for line in a.readlines()]
+
+      if M_files != store['data_mask_files']:
+        raise ValueError('The data_mask_files "' + inputs['data_mask_files'] + '" are not those the input store "' + 
+                         storeDir + '" was made with (see the data_mask_files in its manifest.json)')
+
+    if 'data_mask_thresh' in inputs:
+
+      if float(inputs['data_mask_thresh']) != store['data_mask_thresh']:
+        raise ValueError('The data_mask_thresh ' + str(inputs['data_mask_thresh']) + ' is not that the input store "' + 
+                         storeDir + '" was made with (' + str(store['data_mask_thresh']) + ')')
+
+  return(store)
+
+
 # ============================================================================
 #
 # The below function computes the  number of voxel blocks we have to split the
@@ -398,32 +769,11 @@ def get_amInds(am, vb=None, nvb=None):
 def numVoxelBlocks(inputs):
 
   # ----------------------------------------------------------------
-  # Number of levels and number of random effects
+  # Number of random effects and number of voxels in analysis mask
   # ----------------------------------------------------------------
-  # Random factor variables.
-  rfxmats = inputs['Z']
-
-  # Number of random effects
-  r = len(rfxmats)
-
-  # Number of random effects for each factor, q
-  nraneffs = []
-
-  # Number of levels for each factor, l
-  nlevels = []
-
-  for k in range(r):
-
-    rfxdes = loadFile(rfxmats[k]['f' + str(k+1)]['design'])
-    rfxfac = loadFile(rfxmats[k]['f' + str(k+1)]['factor'])
-
-    nraneffs = nraneffs + [rfxdes.shape[1]]
-    nlevels = nlevels + [len(np.unique(rfxfac))]
-
-  # Get number of random effects
-  nraneffs = np.array(nraneffs)
-  nlevels = np.array(nlevels)
-  q = np.sum(nraneffs*nlevels)
+  context = getRunContext(inputs)
+  q = context['q']
+  v = context['v_am']
 
   # Check if the maximum memory is saved.    
   if 'MAXMEM' in inputs:
@@ -442,42 +792,68 @@ def numVoxelBlocks(inputs):
   # look at).
   vPerBlock = MAXMEM/(10*8*(q**2))
 
-  # Read in analysis mask (if present)
-  if 'analysis_mask' in inputs:
-    am = loadFile(inputs['analysis_mask'])
-    am = am.get_data()
-  else:
+  # Work out number of voxel blocks we would need.
+  nvb = v//vPerBlock+1
 
-    # --------------------------------------------------------------
-    # Get one Y volume to make full Nifti mask
-    # --------------------------------------------------------------
+  # Return number of voxel blocks
+  return(nvb)
 
-    # Y volumes
-    with open(inputs['Y_files']) as a:
 
-      Y_files = []
-      i = 0
-      for line in a.readlines():
+# ============================================================================
+#
+# The below function computes the number of observations (input images) that
+# are to be considered by each batch job during the batch stage.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `inputs`: The inputs dictionary read from a blmm inputs cfg file.
+# - `NIFTImem`: The (maximum) memory a single input NIFTI could take in
+#               storage, in bytes.
+# - `p`: The number of fixed effects parameters.
+# - `q`: The total number of random effects.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `blksize`: The number of observations to be read in by each batch.
+#
+# ============================================================================
+def get_blksize(inputs, NIFTImem, p, q):
 
-        Y_files.append(line.replace('\n', ''))  
+  # Check if the maximum memory is saved.
+  if 'MAXMEM' in inputs:
+    MAXMEM = eval(inputs['MAXMEM'])
+  else:
+    MAXMEM = 2**32
 
-    # Load in one nifti to check NIFTI size
-    try:
-      Y0 = loadFile(Y_files[0])
-    except Exception as error:
-      raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
+  # Check if we are in streaming mode
+  if 'batchStreaming' in inputs and inputs['batchStreaming']:
 
-    # Get mask of ones
-    am = np.ones(Y0.shape)
+    # In streaming mode Y is never held in memory. Instead we keep the
+    # running X'Y and Y'Y sums, n_sv and the id of each voxel's missingness
+    # pattern (p+3 values per voxel, allowing the same again for 
+    # temporaries). Z'Y is moved to disk if it does not fit in memory (see
+    # `blmm_batch.py`), so it does not count towards this. For each 
+    # observation we only add to the tree of missingness patterns, which 
+    # holds at most one value per voxel (we budget a full NIFTI per
+    # observation to leave a safe overhead for the unique designs).
+    blksize = int(np.floor((MAXMEM - 2*(p+3)*NIFTImem)/NIFTImem))
 
-  # Work out number of non-zero voxels in analysis mask
-  v = np.sum(am!=0)
+  else:
 
-  # Work out number of voxel blocks we would need.
-  nvb = v//vPerBlock+1
+    # Similar to blksize in SwE, we divide by 8 times the size of a nifti
+    # to work out how many blocks we use. We also divide though everything
+    # by the number of parameters in the analysis.
+    blksize = int(np.floor(MAXMEM/8/NIFTImem/p))
 
-  # Return number of voxel blocks
-  return(nvb)
+  return(blksize)
 
 
 # ============================================================================
@@ -517,3 +893,224 @@ def pracNumVoxelBlocks(inputs):
 
   # Return number of voxel blocks
   return(nvb)
+
+
+# ============================================================================
+#
+# The below function builds the "run context"; a dictionary containing the
+# metadata which every stage of the pipeline needs and would otherwise have to
+# re-derive from the inputs (by reading in the input NIFTIs, random effects
+# design and factor files, contrasts and analysis mask). The run context is
+# built once by `blmm_setup.py` and saved (see `saveRunContext`) so that later
+# stages can simply load it (see `getRunContext`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `inputs`: The inputs dictionary read from a blmm inputs cfg file.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `context`: A dictionary with the following fields:
+#     - `dim`: The dimensions of the input NIFTI images.
+#     - `affine`: The affine of the input NIFTI images.
+#     - `header`: The header of the (first) input NIFTI image.
+#     - `n`: The number of input NIFTI images.
+#     - `nraneffs`: The number of random effects for each factor.
+#     - `nlevels`: The number of levels for each factor.
+#     - `p`: The number of fixed effects parameters.
+#     - `q`: The total number of random effects.
+#     - `contrasts`: A list of the contrast vectors/matrices, as numpy
+#                    arrays.
+#     - `amInds`: The (flattened) indices of the analysis mask (see
+#                 `get_amInds`).
+#     - `v_am`: The number of non-zero voxels in the analysis mask.
+#
+# ============================================================================
+def buildRunContext(inputs):
+
+  context = dict()
+
+  # ----------------------------------------------------------------
+  # NIFTI dimensions, affine and header
+  # ----------------------------------------------------------------
+  # If the input images have been imported (see `blmm_import.py`), the
+  # store records them
+  if 'Y_store' in inputs:
+
+    store = loadYStore(inputs['Y_store'], inputs)
+    Y_files = store['Y_files']
+    Y0 = loadFile(store['templateFile'])
+
+  else:
+
+    with open(inputs['Y_files']) as a:
+
+      Y_files = []
+      for line in a.readlines():
+
+        Y_files.append(line.replace('\n', ''))
+
+    # Load in one nifti to check NIFTI size
+    try:
+      Y0 = loadFile(Y_files[0])
+    except Exception as error:
+      raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
+
+  context['dim'] = Y0.shape
+  context['affine'] = Y0.affine
+  context['header'] = Y0.header
+  context['n'] = len(Y_files)
+
+  # ----------------------------------------------------------------
+  # Number of levels and number of random effects
+  # ----------------------------------------------------------------
+  # Random factor variables.
+  rfxmats = inputs['Z']
+
+  # Number of random effects
+  r = len(rfxmats)
+
+  # Number of random effects for each factor, q
+  nraneffs = []
+
+  # Number of levels for each factor, l
+  nlevels = []
+
+  for k in range(r):
+
+    rfxdes = loadFile(rfxmats[k]['f' + str(k+1)]['design'])
+    rfxfac = loadFile(rfxmats[k]['f' + str(k+1)]['factor'])
+
+    nraneffs = nraneffs + [rfxdes.shape[1]]
+    nlevels = nlevels + [len(np.unique(rfxfac))]
+
+  # Get number of random effects
+  context['nraneffs'] = np.array(nraneffs)
+  context['nlevels'] = np.array(nlevels)
+  context['q'] = np.sum(context['nraneffs']*context['nlevels'])
+
+  # ----------------------------------------------------------------
+  # Contrasts and number of fixed effects parameters
+  # ----------------------------------------------------------------
+  context['contrasts'] = []
+  for i in range(0,len(inputs['contrasts'])):
+
+    L = str2vec(inputs['contrasts'][i]['c' + str(i+1)]['vector'])
+    context['contrasts'] = context['contrasts'] + [np.array(L)]
+
+  context['p'] = context['contrasts'][0].shape[0]
+
+  # ----------------------------------------------------------------
+  # Analysis mask
+  # ----------------------------------------------------------------
+  if 'analysis_mask' in inputs:
+    am = loadFile(inputs['analysis_mask']).get_data()
+  else:
+    am = np.ones(context['dim'])
+
+  context['amInds'] = get_amInds(am)
+  context['v_am'] = np.sum(am!=0)
+
+  return(context)
+
+
+# Run contexts which have already been loaded by this process, by output
+# directory, alongside the modification time of the file they were loaded
+# from
+runContexts = dict()
+
+
+# ============================================================================
+#
+# The below function builds the run context (see `buildRunContext`) and saves
+# it to the `tmp` folder of the output directory, so that later stages of the
+# pipeline can load it (see `getRunContext`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `inputs`: The inputs dictionary read from a blmm inputs cfg file.
+# - `context` (optional): The run context, if it has already been built.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `context`: The run context.
+#
+# ============================================================================
+def saveRunContext(inputs, context=None):
+
+  # Build the run context
+  if context is None:
+    context = buildRunContext(inputs)
+
+  # Save it
+  fname = os.path.join(inputs['outdir'], 'tmp', 'blmm_context.pkl')
+  with open(fname, 'wb') as f:
+    pickle.dump(context, f)
+
+  # Record it for this process
+  runContexts[inputs['outdir']] = (os.stat(fname).st_mtime_ns, context)
+
+  return(context)
+
+
+# ============================================================================
+#
+# The below function returns the run context (see `buildRunContext`), as
+# saved by `blmm_setup.py`. The run context is only read from file the first
+# time it is needed by a process, or if the file has since been replaced
+# (e.g. because setup has been run again for a new analysis in the same 
+# output directory). An error is raised if setup has not saved it.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `inputs`: The inputs dictionary read from a blmm inputs cfg file.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following output:
+#
+# ----------------------------------------------------------------------------
+#
+# - `context`: The run context.
+#
+# ============================================================================
+def getRunContext(inputs):
+
+  # Output directory
+  OutDir = inputs['outdir']
+
+  fname = os.path.join(OutDir, 'tmp', 'blmm_context.pkl')
+
+  # Check the run context has been saved
+  try:
+    mtime = os.stat(fname).st_mtime_ns
+  except FileNotFoundError:
+    raise ValueError('The run context "' + fname + '" does not exist, blmm_setup.py must be run first')
+
+  # Check if we have already loaded this run context
+  if OutDir not in runContexts or runContexts[OutDir][0] != mtime:
+
+    with open(fname, 'rb') as f:
+      runContexts[OutDir] = (mtime, pickle.load(f))
+
+  return(runContexts[OutDir][1])
@@ -1,5 +1,8 @@
 import numpy as np
 import scipy.sparse
+import collections
+import pickle
+import os
 from scipy import stats
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -845,6 +848,192 @@ def faclev_indices2D(k, j, nlevels, nraneffs):
   return(np.arange(start, end))
 
 
+# ============================================================================
+#
+# Many of the matrices used during estimation and inference (e.g. duplication
+# matrices, permutations and the indices of each factor and level) depend
+# only on the design (i.e. on `nlevels` and `nraneffs`), not on the data, yet
+# are needed on every iteration, for every group of voxels. The below 
+# dictionary is a cache of these "design constants", shared by every stage
+# run in the same process. It holds at most `maxsize` constants, discarding
+# the least recently used constant once it is full. The number of `hits` 
+# (constants found in the cache) and `misses` (constants which had to be 
+# computed) are recorded. The cached constants are read-only arrays.
+#
+# The cache can be saved to and loaded from file (see `saveDesignCache` and
+# `loadDesignCache`), so that separate jobs do not each need to compute the 
+# same constants.
+#
+# ============================================================================
+designCache = {'maxsize': 256, 'constants': collections.OrderedDict(), 'hits': 0, 'misses': 0}
+
+
+# ============================================================================
+#
+# This function returns a design constant from the cache, computing it (and
+# adding it to the cache) if it is not already there.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `name`: The name of the constant (e.g. 'dupMatT').
+# - `fn`: The function which computes the constant.
+# - `args`: The arguments to `fn`. These must be integers or vectors of 
+#           integers (e.g. `nlevels`); together with `name` they identify the
+#           constant.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `constant`: The constant, i.e. `fn(*args)`.
+#
+# ============================================================================
+def designConstant(name, fn, *args):
+
+  # Work out the key for this constant (arrays are not hashable)
+  key = (name,) + tuple(tuple(np.asarray(arg).ravel().tolist()) if np.ndim(arg) > 0 else int(arg) for arg in args)
+
+  constants = designCache['constants']
+
+  if key in constants:
+
+    # Mark as most recently used
+    designCache['hits'] = designCache['hits'] + 1
+    constants.move_to_end(key)
+
+  else:
+
+    designCache['misses'] = designCache['misses'] + 1
+    constant = fn(*args)
+
+    # Constants are shared, so make sure they are not modified
+    if isinstance(constant, np.ndarray):
+      constant.flags.writeable = False
+
+    constants[key] = constant
+
+    # Remove the least recently used constant if the cache is full
+    if len(constants) > designCache['maxsize']:
+      constants.popitem(last=False)
+
+  return(constants[key])
+
+
+# ============================================================================
+#
+# The below functions return commonly used design constants, via the cache:
+#
+#  - `dupMatT2D(n)`: The transpose of the (dense) duplication matrix of size
+#                    n^2 by n(n+1)/2 (see `dupMat2D`).
+#  - `cachedPermOfIkKkI2D(k1,k2,n1,n2)`: The permutation given by 
+#                                        `permOfIkKkI2D`.
+#  - `faclevs_indices2D(k, nlevels, nraneffs)`: The indices of the columns of
+#                                               Z for every level of factor k,
+#                                               as an array with one row per
+#                                               level (i.e. row j is given by
+#                                               `faclev_indices2D(k, j, ...)`).
+#
+# ============================================================================
+def dupMatT2D(n):
+
+  return(designConstant('dupMatT', lambda n: np.asarray(dupMat2D(n).todense()).transpose(), n))
+
+
+def cachedPermOfIkKkI2D(k1,k2,n1,n2):
+
+  return(designConstant('permOfIkKkI', permOfIkKkI2D, k1, k2, n1, n2))
+
+
+def faclevs_indices2D(k, nlevels, nraneffs):
+
+  def allLevels(k, nlevels, nraneffs):
+
+    # Work out the starting point of the indices for factor k
+    start = np.concatenate((np.array([0]), np.cumsum(nlevels*nraneffs)))[k]
+
+    return(start + np.arange(nlevels[k]*nraneffs[k]).reshape(nlevels[k], nraneffs[k]))
+
+  return(designConstant('faclevs', allLevels, k, np.asarray(nlevels), np.asarray(nraneffs)))
+
+
+# ============================================================================
+#
+# The below function returns the hit rate of the design constants cache.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `stats`: A string describing the number of hits and misses.
+#
+# ============================================================================
+def designCacheStats():
+
+  hits = designCache['hits']
+  misses = designCache['misses']
+
+  if hits + misses > 0:
+    rate = 100*hits/(hits + misses)
+  else:
+    rate = 0
+
+  return('Design constants cache: ' + str(hits) + ' hit(s), ' + str(misses) + ' miss(es) (' + 
+         '{:.1f}'.format(rate) + '% hit rate, ' + str(len(designCache['constants'])) + ' constant(s) held)')
+
+
+# ============================================================================
+#
+# The below functions save the design constants cache to, and load it from,
+# a file. Saving writes to a temporary file first, so that a job loading the
+# cache never sees a partially written file. Loading adds the saved 
+# constants to those already in the cache.
+#
+# ----------------------------------------------------------------------------
+#
+# These functions take the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `fname`: The file to save the cache to, or load it from.
+#
+# ============================================================================
+def saveDesignCache(fname):
+
+  tmpname = fname + '.' + str(os.getpid()) + '.part'
+
+  with open(tmpname, 'wb') as f:
+    pickle.dump(list(designCache['constants'].items()), f)
+
+  os.replace(tmpname, fname)
+
+
+def loadDesignCache(fname):
+
+  with open(fname, 'rb') as f:
+    constants = pickle.load(f)
+
+  for key, constant in constants:
+
+    if key not in designCache['constants']:
+
+      if isinstance(constant, np.ndarray):
+        constant.flags.writeable = False
+
+      designCache['constants'][key] = constant
+
+  # Make sure we haven't exceeded the maximum size
+  while len(designCache['constants']) > designCache['maxsize']:
+    designCache['constants'].popitem(last=False)
+
+
 # ============================================================================
 #
 # The below function returns the OLS estimator for \beta, given by:
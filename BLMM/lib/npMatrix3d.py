@@ -1,7 +1,7 @@
 import numpy as np
 import scipy.sparse
 from scipy import stats
-from BLMM.lib.npMatrix2d import faclev_indices2D, fac_indices2D, permOfIkKkI2D, dupMat2D
+from BLMM.lib.npMatrix2d import faclev_indices2D, fac_indices2D, permOfIkKkI2D, dupMat2D, faclevs_indices2D, dupMatT2D, cachedPermOfIkKkI2D
 from BLMM.lib.fileio import loadFile
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -408,11 +408,14 @@ def initDk3D(k, ZtZ, Zte, sigma2, nlevels, nraneffs, dupMatTdict):
     # Initalize D to zeros
     invSig2ZteetZminusZtZ = np.zeros((Zte.shape[0],nraneffs[k],nraneffs[k]))
 
+    # Indices for every level of factor k
+    Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
     # First we work out the derivative we require.
     for j in np.arange(nlevels[k]):
       
       # Indices for factor k level j
-      Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+      Ikj = Ikjs[j]
 
       # This can also be performed faster in the one factor, multiple random effect
       # case by using only the diagonal blocks of DinvIplusZtZD 
@@ -450,11 +453,14 @@ def initDk3D(k, ZtZ, Zte, sigma2, nlevels, nraneffs, dupMatTdict):
   # case by using only the diagonal blocks of DinvIplusZtZD 
   elif r == 1 and nraneffs[0] > 1:
 
+    # Indices for every level of factor k
+    Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
     # Sum of Z_(k,j)'Z_(k,j) kron Z_(k,j)'Z_(k,j), as for the one factor model
     # off diagonal blocks cancel to zero
     for j in np.arange(nlevels[k]):
 
-      Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+      Ikj = Ikjs[j]
 
       # Work out Z_(k, j)'Z_(k, j)
       ZkjtZkj = ZtZ[:,:,Ikj]
@@ -475,13 +481,16 @@ def initDk3D(k, ZtZ, Zte, sigma2, nlevels, nraneffs, dupMatTdict):
 
   else:
 
+    # Indices for every level of factor k
+    Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
     # Double sum of Z_(k,i)'Z_(k,j) kron Z_(k,i)'Z_(k,j)
     for j in np.arange(nlevels[k]):
 
       for i in np.arange(nlevels[k]):
         
-        Iki = faclev_indices2D(k, i, nlevels, nraneffs)
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+        Iki = Ikjs[i]
+        Ikj = Ikjs[j]
 
         # Work out Z_(k, j)'Z_(k, j)
         ZkitZkj = ZtZ[np.ix_(np.arange(ZtZ.shape[0]),Iki,Ikj)]
@@ -606,6 +615,9 @@ def makeDnnd3D(D):
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `logdet` (optional, keyword only): The log determinant of I+Z'ZD,
+#                                      ln|I+Z'ZD|, if this has already been
+#                                      computed (see `get_DinvIplusZtZD3D`).
 #
 # ----------------------------------------------------------------------------
 #
@@ -617,7 +629,7 @@ def makeDnnd3D(D):
 #          the above notation).
 #
 # ============================================================================
-def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml=False, XtX=0, XtiVX=0):
+def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, reml=False, XtX=0, XtiVX=0, *, logdet=None):
 
   # Number of random effects and number of voxels
   r = len(nlevels)
@@ -634,9 +646,14 @@ def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, r
 
       n = n.reshape(sigma2.shape)
 
+  # The log determinant may already have been computed
+  if logdet is not None:
+
+    logdet = logdet.reshape(ete.shape[0])
+
   # If we have only one factor and one random effect computation can be
   # sped up a lot
-  if r == 1 and nraneffs[0]==1:
+  elif r == 1 and nraneffs[0]==1:
     
     # Work out the diagonal entries of I+Z'ZD (we assume ZtZ is already just the
     # diagonal elements in this use case)
@@ -696,6 +713,10 @@ def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, r
   # case by using only the diagonal blocks of DinvIplusZtZD. 
   elif r == 1 and nraneffs[0] > 1:
 
+    # q0, l0
+    q0 = nraneffs[0]
+    l0 = nlevels[0]
+
     # Reshape DinvIplusZtZD appropriately
     DinvIplusZtZDZte = DinvIplusZtZD.transpose(0,2,1).reshape(v,l0,q0,q0)
 
@@ -756,6 +777,13 @@ def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, r
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `returnLogdet` (optional): If true, the log determinant of I+Z'ZD is also
+#                              returned. This is computed from the same
+#                              factorisation as D(I+Z'ZD)^(-1) and can be
+#                              passed to `llh3D`.
+# - `schur` (optional): If true, and there are multiple random factors, D(I+
+#                       Z'ZD)^(-1) is computed by block elimination (see
+#                       `schurDinvIplusZtZD3D`) rather than directly.
 #
 # ----------------------------------------------------------------------------
 #
@@ -767,9 +795,25 @@ def llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD,D, Ddict, nlevels, nraneffs, r
 #                    single random factor single random effect model 
 #                    DinvIplusZtZD will only hold the diagonal elements of
 #                    D(I+Z'ZD)^(-1)
+# - `logdet`: The log determinant of I+Z'ZD for every voxel (only returned if
+#             `returnLogdet` is true).
+#
+# ----------------------------------------------------------------------------
+#
+# Developer note: In the one random factor, multiple random effect case, I+Z'ZD
+# is block diagonal, with one q0 by q0 block, I+Z'Z_jD_0, for each level j. As
+# D_0 is non-negative definite, it can be written as D_0=LL', giving:
+#
+#         D_0(I+Z'Z_jD_0)^(-1) = L(I+L'Z'Z_jL)^(-1)L'
+#                  |I+Z'Z_jD_0| = |I+L'Z'Z_jL|
+#
+# where I+L'Z'Z_jL is positive definite. Each block is therefore factorised
+# once, by Cholesky decomposition, rather than inverted with a pseudo inverse.
+# If D_0 is not non-negative definite, or the decomposition fails, the pseudo
+# inverse is used instead.
 #
 # ============================================================================
-def get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs):
+def get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs, returnLogdet=False, schur=False):
 
   # Work out how many factors we're looking at
   r = len(nlevels)
@@ -789,6 +833,10 @@ def get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs):
     # need the diagonal elements)
     DinvIplusZtZD = Ddict[0].reshape(v,1)/(1+DiagZtZD)
 
+    # Log determinant of the diagonal matrix I+Z'ZD
+    if returnLogdet:
+      logdet = np.sum(np.log(1+DiagZtZD),axis=1).reshape(v)
+
   # If one factor and one random effect, Z'Z is block diagonal
   elif r == 1 and nraneffs[0]>1:
 
@@ -796,23 +844,288 @@ def get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs):
     q0 = nraneffs[0]
     l0 = q//q0
 
-    # Get I+Z'ZD
-    IplusZtZD = np.eye(q0) + ZtZ.transpose(0,2,1).reshape(ZtZ.shape[0], l0, q0, q0) @ Ddict[0].reshape(v,1,q0,q0)
+    # Blocks of Z'Z (one for each level)
+    ZtZblocks = ZtZ.transpose(0,2,1).reshape(ZtZ.shape[0], l0, q0, q0)
+
+    try:
+
+      # Get L, such that D_0=LL' (see developer note)
+      eigvals, eigvecs = np.linalg.eigh(Ddict[0])
+
+      # Check D_0 is non-negative definite (up to rounding)
+      if np.any(eigvals < -1e-10*np.maximum(1,np.abs(eigvals).max(axis=1,keepdims=True))):
+        raise np.linalg.LinAlgError('D is not non-negative definite')
+
+      L = (eigvecs*np.sqrt(np.maximum(eigvals,0)).reshape(v,1,q0)).reshape(v,1,q0,q0)
+
+      # Get I+L'Z'ZL and its Cholesky factor, C
+      IplusLtZtZL = np.eye(q0) + L.transpose(0,1,3,2) @ ZtZblocks @ L
+      IplusLtZtZL = 0.5*(IplusLtZtZL+IplusLtZtZL.transpose(0,1,3,2))
+      C = np.linalg.cholesky(IplusLtZtZL)
+
+      # Get D(I+Z'ZD)^(-1) = (C^(-1)L')'(C^(-1)L') 
+      CinvLt = np.linalg.solve(C, np.broadcast_to(L.transpose(0,1,3,2), C.shape))
+      DinvIplusZtZD = CinvLt.transpose(0,1,3,2) @ CinvLt
 
-    # Get D(I+Z'ZD)^(-1)
-    DinvIplusZtZD = Ddict[0].reshape(v,1,q0,q0) @ np.linalg.pinv(IplusZtZD)
+      # Log determinant of I+Z'ZD, from the diagonal of C
+      if returnLogdet:
+        logdet = 2*np.sum(np.log(np.diagonal(C, axis1=2, axis2=3)), axis=(1,2))
 
-    # Force symmetry
-    DinvIplusZtZD = 0.5*(DinvIplusZtZD+DinvIplusZtZD.transpose(0,1,3,2)) 
+    except np.linalg.LinAlgError:
+
+      # Get I+Z'ZD
+      IplusZtZD = np.eye(q0) + ZtZblocks @ Ddict[0].reshape(v,1,q0,q0)
+
+      # Get D(I+Z'ZD)^(-1)
+      DinvIplusZtZD = Ddict[0].reshape(v,1,q0,q0) @ np.linalg.pinv(IplusZtZD)
+
+      # Force symmetry
+      DinvIplusZtZD = 0.5*(DinvIplusZtZD+DinvIplusZtZD.transpose(0,1,3,2)) 
+
+      # Log determinant of I+Z'ZD, summed across levels
+      if returnLogdet:
+        logdet = np.linalg.slogdet(IplusZtZD)
+        logdet = np.sum(logdet[0]*logdet[1], axis=1).reshape(v)
 
     # Reshape to flattened form
     DinvIplusZtZD = DinvIplusZtZD.reshape(v,l0*q0,q0).transpose(0,2,1)    
 
   else:
 
-    DinvIplusZtZD = forceSym3D(np.linalg.solve(np.eye(q) + D @ ZtZ, D))
+    DinvIplusZtZD = None
+
+    # Use block elimination, if requested (see `schurDinvIplusZtZD3D`)
+    if schur:
+      try:
+        DinvIplusZtZD, logdet = schurDinvIplusZtZD3D(Ddict, ZtZ, nlevels, nraneffs)
+      except np.linalg.LinAlgError:
+        DinvIplusZtZD = None
+
+    if DinvIplusZtZD is None:
+
+      # Get I+DZ'Z
+      IplusDZtZ = np.eye(q) + D @ ZtZ
+
+      DinvIplusZtZD = forceSym3D(np.linalg.solve(IplusDZtZ, D))
+
+      # Log determinant of I+DZ'Z (which equals that of I+Z'ZD)
+      if returnLogdet:
+        logdet = np.linalg.slogdet(IplusDZtZ)
+        logdet = (logdet[0]*logdet[1]).reshape(v)
+
+  if returnLogdet:
+    return(DinvIplusZtZD, logdet)
+  else:
+    return(DinvIplusZtZD)
+
+
+# ============================================================================
+#
+# The below function calculates D(I+Z'ZD)^(-1) and the log determinant of 
+# I+Z'ZD for designs with multiple random factors, without factorising the
+# q by q matrix I+Z'ZD directly. As D is block diagonal and non-negative
+# definite, it can be written as D=LL', where L is block diagonal with 
+# blocks L_k (D_k=L_kL_k'). This gives:
+#
+#         D(I+Z'ZD)^(-1) = L(I+L'Z'ZL)^(-1)L' = LA^(-1)L'
+#                 |I+Z'ZD| = |I+L'Z'ZL| = |A|
+#
+# The random effects are then split into those of the factor with the most
+# random effects in total, f (e.g. subjects), and those of the remaining 
+# factors, g (e.g. sites). As each observation belongs to only one level of
+# f, the block of A for f, A_ff, is block diagonal, with one q_f by q_f 
+# block per level. A^(-1) and |A| are therefore given by block elimination:
+#
+#       S = A_gg - A_gf A_ff^(-1) A_fg   (the Schur complement of A_ff)
+#
+#       (A^(-1))_gg = S^(-1)
+#       (A^(-1))_fg = -A_ff^(-1) A_fg S^(-1)
+#       (A^(-1))_ff = A_ff^(-1) + A_ff^(-1) A_fg S^(-1) A_gf A_ff^(-1)
+#
+#       |A| = |A_ff||S|
+#
+# Only the small blocks of A_ff and the matrix S (which is of the size of
+# the remaining factors' random effects) are factorised, each once, by
+# Cholesky decomposition (their inverses and log determinants are both
+# obtained from the Cholesky factors), reducing the cost
+# for each voxel from O(q^3) to O(q^2 q_g), where q_g is the number of 
+# random effects for the remaining factors.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `Ddict`: a dictionary in which entry `k` is a 3D array of the kth diagonal 
+#            block of D for every voxel.
+# - `ZtZ`: Z transpose multiplied by Z (can be spatially varying or non
+#          -spatially varying).
+# - `nlevels`: A vector containing the number of levels for each factor, e.g.
+#              `nlevels=[3,4]` would mean the first factor has 3 levels and
+#              the second factor has 4 levels.
+# - `nraneffs`: A vector containing the number of random effects for each
+#               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
+#               random effects and the second factor has 1 random effect.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `DinvIplusZtZD`: The product D(I+Z'ZD)^(-1).
+# - `logdet`: The log determinant of I+Z'ZD for every voxel.
+#
+# ----------------------------------------------------------------------------
+#
+# Developer note: A `LinAlgError` is raised if any D_k is not non-negative
+# definite, in which case `get_DinvIplusZtZD3D` falls back to the direct
+# computation.
+#
+# ============================================================================
+def schurDinvIplusZtZD3D(Ddict, ZtZ, nlevels, nraneffs):
+
+  # Number of voxels and random effects
+  v = Ddict[0].shape[0]
+  q = ZtZ.shape[-1]
+
+  # Indices of the random effects for each factor
+  Dinds = np.insert(np.cumsum(nlevels*nraneffs),0,0)
+
+  # The factor with the most random effects is eliminated first
+  f = np.argmax(nlevels*nraneffs)
+  qf = nraneffs[f]
+  lf = nlevels[f]
+  Indsf = np.arange(Dinds[f],Dinds[f+1])
+  Indsg = np.setdiff1d(np.arange(q),Indsf)
+  qg = len(Indsg)
+
+  # --------------------------------------------------------------------------
+  # Work out L_k, such that D_k=L_kL_k', for each factor
+  # --------------------------------------------------------------------------
+  Ldict = dict()
+  for k in np.arange(len(nraneffs)):
+
+    eigvals, eigvecs = np.linalg.eigh(Ddict[k])
+
+    # Check D_k is non-negative definite (up to rounding)
+    if np.any(eigvals < -1e-10*np.maximum(1,np.abs(eigvals).max(axis=1,keepdims=True))):
+      raise np.linalg.LinAlgError('D is not non-negative definite')
+
+    Ldict[k] = eigvecs*np.sqrt(np.maximum(eigvals,0)).reshape(v,1,nraneffs[k])
+
+  # L for factor f
+  Lf = Ldict[f].reshape(v,1,qf,qf)
+
+  # L for the remaining factors (block diagonal)
+  Lg = np.zeros((v,qg,qg))
+  counter = 0
+  for k in np.arange(len(nraneffs)):
+    if k != f:
+      for j in np.arange(nlevels[k]):
+        Lg[:,counter:(counter+nraneffs[k]),counter:(counter+nraneffs[k])] = Ldict[k]
+        counter = counter + nraneffs[k]
+
+  # --------------------------------------------------------------------------
+  # Blocks of A=I+L'Z'ZL
+  # --------------------------------------------------------------------------
+  # Diagonal blocks of A_ff, one for each level of factor f
+  Blocksf = Indsf.reshape(lf,qf)
+  Aff = np.eye(qf) + Lf.transpose(0,1,3,2) @ ZtZ[:,Blocksf[:,:,None],Blocksf[:,None,:]] @ Lf
+  Aff = 0.5*(Aff + Aff.transpose(0,1,3,2))
+
+  # A_fg, split by level of factor f
+  Afg = Lf.transpose(0,1,3,2) @ ZtZ[:,Indsf,:][:,:,Indsg].reshape(ZtZ.shape[0],lf,qf,qg) @ Lg.reshape(v,1,qg,qg)
+
+  # A_gg
+  Agg = np.eye(qg) + Lg.transpose(0,2,1) @ ZtZ[:,Indsg,:][:,:,Indsg] @ Lg
+
+  # --------------------------------------------------------------------------
+  # Block elimination
+  # --------------------------------------------------------------------------
+  # Cholesky factors of the blocks of A_ff
+  Cff = np.linalg.cholesky(Aff)
+
+  # A_ff^(-1) (blockwise), from its Cholesky factors, and A_ff^(-1)A_fg
+  Cffinv = invLowerTri3D(Cff)
+  Affinv = Cffinv.swapaxes(-1,-2) @ Cffinv
+  AffinvAfg = Affinv @ Afg
+
+  # Schur complement of A_ff, its Cholesky factor and its inverse
+  S = Agg - np.einsum('vjab,vjac->vbc', Afg, AffinvAfg)
+  S = 0.5*(S + S.transpose(0,2,1))
+  CS = np.linalg.cholesky(S)
+  CSinv = invLowerTri3D(CS)
+  Sinv = CSinv.transpose(0,2,1) @ CSinv
+
+  # Log determinant of A
+  logdet = 2*np.sum(np.log(np.diagonal(Cff, axis1=2, axis2=3)), axis=(1,2)) + \
+           2*np.sum(np.log(np.diagonal(CS, axis1=1, axis2=2)), axis=1)
+
+  # Blocks of A^(-1)
+  AffinvAfg = AffinvAfg.reshape(v,lf*qf,qg)
+  Ainvfg = -AffinvAfg @ Sinv
+  Ainvff = -Ainvfg @ AffinvAfg.transpose(0,2,1)
+  Ainvff = Ainvff.reshape(v,lf,qf,lf,qf)
+  Ainvff[:,np.arange(lf),:,np.arange(lf),:] = Ainvff[:,np.arange(lf),:,np.arange(lf),:] + Affinv.transpose(1,0,2,3)
+
+  # --------------------------------------------------------------------------
+  # D(I+Z'ZD)^(-1) = LA^(-1)L'
+  # --------------------------------------------------------------------------
+  DinvIplusZtZD = np.zeros((v,q,q))
+
+  # Block for factor f
+  DinvIplusZtZDff = np.einsum('vab,vjbkc,vdc->vjakd', Ldict[f], Ainvff, Ldict[f])
+  DinvIplusZtZD[:,Indsf[:,None],Indsf[None,:]] = DinvIplusZtZDff.reshape(v,lf*qf,lf*qf)
+
+  # Blocks between factor f and the remaining factors
+  DinvIplusZtZDfg = (Lf @ Ainvfg.reshape(v,lf,qf,qg)).reshape(v,lf*qf,qg) @ Lg.transpose(0,2,1)
+  DinvIplusZtZD[:,Indsf[:,None],Indsg[None,:]] = DinvIplusZtZDfg
+  DinvIplusZtZD[:,Indsg[:,None],Indsf[None,:]] = DinvIplusZtZDfg.transpose(0,2,1)
+
+  # Block for the remaining factors
+  DinvIplusZtZD[:,Indsg[:,None],Indsg[None,:]] = forceSym3D(Lg @ Sinv @ Lg.transpose(0,2,1))
+
+  return(DinvIplusZtZD, logdet)
+
+
+# ============================================================================
+#
+# This function inverts a stack of lower triangular matrices (e.g. Cholesky
+# factors) by forward substitution, so that no further factorisation of the
+# matrices is needed.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `L`: An array of lower triangular matrices, with the matrices along the
+#        last two axes.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `Linv`: The inverses of the matrices in `L` (which are also lower
+#           triangular).
+#
+# ============================================================================
+def invLowerTri3D(L):
+
+  # Work out L^(-1) one row at a time, using LL^(-1)=I
+  Linv = np.zeros(L.shape)
+  for i in np.arange(L.shape[-1]):
 
-  return(DinvIplusZtZD)
+    Linv[...,i,:] = -np.einsum('...j,...jk->...k', L[...,i,:i], Linv[...,:i,:])
+    Linv[...,i,i] = Linv[...,i,i] + 1
+    Linv[...,i,:] = Linv[...,i,:]/L[...,i,i:(i+1)]
+
+  return(Linv)
 
 # ============================================================================
 # The below function calculates the derivative of the log likelihood with
@@ -1100,10 +1413,13 @@ def get_dldDk3D(k, nlevels, nraneffs, ZtZ, Zte, sigma2, DinvIplusZtZD, ZtZmat=No
       # Instantiate to zeros
       ZtZmat = np.zeros((ZtZ.shape[0],nraneffs[k],nraneffs[k]))
 
+      # Indices for every level of factor k
+      Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
       for j in np.arange(nlevels[k]):
 
         # Get the indices for the kth factor jth level
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+        Ikj = Ikjs[j]
 
         # Work out Z_(k,j)'Z_(k,j)
         ZtZterm = ZtZ[np.ix_(np.arange(ZtZ.shape[0]),Ikj,Ikj)]
@@ -1201,11 +1517,14 @@ def get_dldDk3D(k, nlevels, nraneffs, ZtZ, Zte, sigma2, DinvIplusZtZD, ZtZmat=No
       # Invert X'V^(-1)X
       iXtiVX = np.linalg.inv(XtiVX)
 
+      # Indices for every level of factor k
+      Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
       # For each level j we need to add a term
       for j in np.arange(nlevels[k]):
 
         # Get the indices for the kth factor jth level
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+        Ikj = Ikjs[j]
 
         Z_kjtZ = ZtZ[:,Ikj,:]
         Z_kjtX = ZtX[:,Ikj,:]
@@ -1466,10 +1785,13 @@ def get_covdldDkdsigma23D(k, sigma2, nlevels, nraneffs, ZtZ, DinvIplusZtZD, dupM
       # Instantiate to zeros
       ZtZmat = np.zeros((ZtZ.shape[0],nraneffs[k],nraneffs[k]))
 
+      # Indices for every level of factor k
+      Ikjs = faclevs_indices2D(k, nlevels, nraneffs)
+
       for j in np.arange(nlevels[k]):
 
         # Get the indices for the kth factor jth level
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
+        Ikj = Ikjs[j]
 
         # Work out Z_(k,j)'Z_(k,j)
         ZtZterm = ZtZ[np.ix_(np.arange(ZtZ.shape[0]),Ikj,Ikj)]
@@ -1813,6 +2135,138 @@ def getConvergedIndices(convergedBeforeIt, convergedDuringIt):
   return(indices_ConAfterIt, indices_notConAfterIt, indices_conDuringIt, local_converged, local_notconverged)
 
 
+# ============================================================================
+#
+# The estimation methods in `est3d.py` remove voxels from the arrays they
+# update as soon as they converge, so that no work is spent updating voxels
+# which have already converged. Reallocating every array each time this
+# happens would mean copying all of the voxels which are left, so instead,
+# the voxels which have not yet converged are moved into the rows of those
+# which have, and the arrays are viewed up to the number of voxels left. The
+# arrays are only reallocated (and the memory of the converged voxels freed)
+# once enough of their rows are unused. The below dictionary records how
+# often this happens, so that the cost of the copying can be measured; it is
+# added to by every call to the estimation methods and may be reset by the
+# caller.
+#
+#  - `iterations`: The number of iterations performed.
+#  - `compactions`: The number of times the arrays were reallocated.
+#  - `bytes`: The number of bytes copied whilst removing voxels from the
+#             arrays.
+#  - `wasted`: The number of converged voxels which were still updated,
+#              summed over iterations.
+#
+# ============================================================================
+compactionStats = {'iterations': 0, 'compactions': 0, 'bytes': 0, 'wasted': 0}
+
+
+# ============================================================================
+#
+# This function decides whether the arrays used during estimation should be
+# reallocated when voxels are removed from them, rather than having voxels
+# moved within them.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `nkeep`: The number of voxels which are to be kept in the arrays.
+# - `allocated`: The number of rows allocated to the arrays, or `None` if the
+#                arrays have not yet been reallocated (in which case they may
+#                belong to the caller and must not be written to).
+# - `compact`: The fraction of the allocated rows which must be unused before
+#              the arrays are reallocated. If this is 0, the arrays are
+#              reallocated every time a voxel converges.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `compactNow`: True if the arrays should be reallocated.
+#
+# ============================================================================
+def compactNow(nkeep, allocated, compact):
+
+  # Arrays which may belong to the caller are always copied
+  if allocated is None:
+    return(True)
+
+  # Check whether enough rows are unused to be worth freeing
+  return(allocated - nkeep >= compact*allocated)
+
+
+# ============================================================================
+#
+# This function removes voxels from a set of arrays used during estimation,
+# keeping only the given voxels (i.e. the given rows of the arrays). Arrays which do not vary with voxel (e.g. the product matrices for a
+# design which is not spatially varying) and `None` values are returned
+# unchanged. The number of bytes copied is recorded in `compactionStats`.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `keep`: The (sorted) indices of the voxels to keep, relative to the list
+#           of voxels currently held in the arrays.
+# - `arrays`: The arrays to compact, each with voxels along the first axis.
+# - `inPlace` (optional): If True, the kept voxels after the first
+#                         `len(keep)` rows are moved into the rows of the
+#                         removed voxels before them, and views of the
+#                         first `len(keep)` rows are returned (so the
+#                         order of the voxels changes, and any list of the
+#                         voxels held must be compacted in the same way).
+#                         Otherwise, the kept voxels are copied, in order,
+#                         to new arrays. Default: False.
+#
+# ----------------------------------------------------------------------------
+#
+# It returns as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `compacted`: A list of the compacted arrays, in the order given.
+#
+# ============================================================================
+def compactRows(keep, *arrays, inPlace=False):
+
+  # Rows of removed voxels which kept voxels are moved into, and the rows
+  # they are moved from
+  if inPlace:
+    nkeep = len(keep)
+    moveTo = np.setdiff1d(np.arange(nkeep), keep[keep<nkeep], assume_unique=True)
+    moveFrom = keep[keep>=nkeep]
+
+  compacted = []
+
+  for array in arrays:
+
+    # Only arrays which vary with voxel are compacted
+    if hasattr(array, "ndim") and array.ndim > 0 and array.shape[0] > 1:
+
+      if inPlace:
+
+        # The rows moved from are never written to, so arrays which share
+        # memory can safely be moved more than once
+        array[moveTo] = array[moveFrom]
+        compactionStats['bytes'] = compactionStats['bytes'] + len(moveTo)*(array.nbytes//array.shape[0])
+        array = array[:nkeep]
+
+      else:
+
+        array = array[keep]
+        compactionStats['bytes'] = compactionStats['bytes'] + array.nbytes
+
+    compacted.append(array)
+
+  return(compacted)
+
+
 # ============================================================================
 # 
 # This function converts a 3D matrix partitioned into blocks into a 3D matrix 
@@ -2157,7 +2611,7 @@ def sumAijKronBij3D(A, B, pttn, perm=None):
 
   # This matrix only needs be calculated once
   if perm is None:
-    perm = permOfIkKkI2D(n2,n1,n2,n1) 
+    perm = cachedPermOfIkKkI2D(n2,n1,n2,n1) 
 
   # Convert to vecb format
   atilde = mat2vecb3D(A,pttn)
@@ -2235,6 +2689,8 @@ def get_resms3D(YtX, YtY, XtX, beta, n, p):
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
 #
 # ----------------------------------------------------------------------------
 #
@@ -2245,7 +2701,7 @@ def get_resms3D(YtX, YtY, XtX, beta, n, p):
 # - `covB`: The covariance of the beta estimates.
 #
 # ============================================================================
-def get_covB3D(XtiVX, sigma2, nraneffs):
+def get_covB3D(XtiVX, sigma2, nraneffs, iXtiVX=None):
 
     # Number of random factors r
     r = len(nraneffs)
@@ -2259,7 +2715,10 @@ def get_covB3D(XtiVX, sigma2, nraneffs):
             sigma2 = sigma2.reshape(sigma2.shape[0])
 
     # Work out cov(B)
-    covB = np.linalg.inv(XtiVX)
+    if iXtiVX is None:
+        covB = np.linalg.inv(XtiVX)
+    else:
+        covB = iXtiVX
 
     # Calculate sigma^2(X'V^{-1}X)^(-1)
     covB = np.einsum('i,ijk->ijk',sigma2,covB)
@@ -2286,6 +2745,8 @@ def get_covB3D(XtiVX, sigma2, nraneffs):
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
 #
 # ----------------------------------------------------------------------------
 #
@@ -2296,7 +2757,7 @@ def get_covB3D(XtiVX, sigma2, nraneffs):
 # - `varLB`: The (usually scalar) variance of L\beta.
 #
 # ============================================================================
-def get_varLB3D(L, XtiVX, sigma2, nraneffs):
+def get_varLB3D(L, XtiVX, sigma2, nraneffs, iXtiVX=None):
 
     # Reshape n if necessary
     if isinstance(sigma2,np.ndarray):
@@ -2307,7 +2768,7 @@ def get_varLB3D(L, XtiVX, sigma2, nraneffs):
             sigma2 = sigma2.reshape(sigma2.shape[0])
 
     # Work out var(LB) = L'(X'V^{-1}X)^{-1}L
-    varLB = L @ get_covB3D(XtiVX, sigma2, nraneffs) @ L.transpose()
+    varLB = L @ get_covB3D(XtiVX, sigma2, nraneffs, iXtiVX) @ L.transpose()
 
     # Return result
     return(varLB)
@@ -2378,6 +2839,8 @@ def get_R23D(L, F, df):
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
 #
 # ----------------------------------------------------------------------------
 #
@@ -2388,7 +2851,7 @@ def get_R23D(L, F, df):
 # - `T`: A matrix of T statistics.
 #
 # ============================================================================
-def get_T3D(L, XtiVX, beta, sigma2, nraneffs):
+def get_T3D(L, XtiVX, beta, sigma2, nraneffs, iXtiVX=None):
 
     # Work out the rank of L
     rL = np.linalg.matrix_rank(L)
@@ -2397,7 +2860,7 @@ def get_T3D(L, XtiVX, beta, sigma2, nraneffs):
     LB = L @ beta
 
     # Work out se(T)
-    varLB = get_varLB3D(L, XtiVX, sigma2, nraneffs)
+    varLB = get_varLB3D(L, XtiVX, sigma2, nraneffs, iXtiVX)
 
     # Work out T
     T = LB/np.sqrt(varLB)
@@ -2425,6 +2888,8 @@ def get_T3D(L, XtiVX, beta, sigma2, nraneffs):
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
 #
 # ----------------------------------------------------------------------------
 #
@@ -2435,7 +2900,7 @@ def get_T3D(L, XtiVX, beta, sigma2, nraneffs):
 # - `F`: A matrix of F statistics.
 #
 # ============================================================================
-def get_F3D(L, XtiVX, betahat, sigma2, nraneffs):
+def get_F3D(L, XtiVX, betahat, sigma2, nraneffs, iXtiVX=None):
 
     # Work out the rank of L
     rL = np.linalg.matrix_rank(L)
@@ -2444,7 +2909,7 @@ def get_F3D(L, XtiVX, betahat, sigma2, nraneffs):
     LB = L @ betahat
 
     # Work out se(F)
-    varLB = get_varLB3D(L, XtiVX, sigma2, nraneffs)
+    varLB = get_varLB3D(L, XtiVX, sigma2, nraneffs, iXtiVX)
 
     # Work out F
     F = LB.transpose(0,2,1) @ np.linalg.inv(varLB) @ LB/rL
@@ -2572,6 +3037,10 @@ def F2P3D(F, L, df_denom, minlog):
 #                    single random factor single random effect model 
 #                    DinvIplusZtZD will only hold the diagonal elements of
 #                    D(I+Z'ZD)^(-1)
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
+# - `iInfoMat` (optional): The inverse of the Fisher information matrix of
+#                          \theta, if it has already been computed.
 #
 # ----------------------------------------------------------------------------
 #
@@ -2582,7 +3051,7 @@ def F2P3D(F, L, df_denom, minlog):
 # - `df`: The spatially varying Sattherthwaithe degrees of freedom estimate.
 #
 # ============================================================================
-def get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs): 
+def get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs, iXtiVX=None, iInfoMat=None): 
 
     # Reshape sigma2 if necessary
     sigma2 = sigma2.reshape(sigma2.shape[0])
@@ -2598,20 +3067,37 @@ def get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
     # L is rL in rank
     rL = np.linalg.matrix_rank(L)
 
-    # Initialize empty sum.
-    sum_swdf_adj = np.zeros(sigma2.shape)
+    # The rows of L share the same inverse of X'V^{-1}X
+    if iXtiVX is None:
+        iXtiVX = np.linalg.inv(XtiVX)
+
+    # First rL rows of L
+    Lr = L[:rL,:]
+
+    # Get S^2 (= Var(l\beta)) for each row, l, of L
+    S2 = np.einsum('i,ij->ij', sigma2, np.einsum('cj,ijk,ck->ic', Lr, iXtiVX, Lr))
+
+    # Get derivative of S^2 for every row of L at once (one column per row)
+    dS2 = get_dS23D(nraneffs, nlevels, Lr, XtiVX, ZtiVX, sigma2, iXtiVX)
+
+    # Work out I^{-1}d for every row of L, using a single solve against the
+    # Fisher information matrix
+    if iInfoMat is None:
 
-    # Loop through first rL rows of L
-    for i in np.arange(rL):
+        # Get Fisher information matrix
+        InfoMat = get_InfoMat3D(DinvIplusZtZD, sigma2, n, nlevels, nraneffs, ZtZ)
 
-        # Work out the swdf for each row of L
-        swdf_row = get_swdf_T3D(L[i:(i+1),:], sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs)
+        iInfoMatdS2 = np.linalg.solve(InfoMat, dS2)
 
-        # Work out adjusted df = df/(df-2)
-        swdf_adj = swdf_row/(swdf_row-2)
+    else:
+
+        iInfoMatdS2 = iInfoMat @ dS2
 
-        # Add to running sum
-        sum_swdf_adj = sum_swdf_adj + swdf_adj.reshape(sum_swdf_adj.shape)
+    # Work out the swdf for each row of L
+    swdf_rows = 2*(S2**2)/np.einsum('ijc,ijc->ic', dS2, iInfoMatdS2)
+
+    # Work out adjusted df = df/(df-2) and sum over rows
+    sum_swdf_adj = np.sum(swdf_rows/(swdf_rows-2), axis=1)
 
     # Work out final df
     df = 2*sum_swdf_adj/(sum_swdf_adj-rL)
@@ -2660,6 +3146,10 @@ def get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
 #                    single random factor single random effect model 
 #                    DinvIplusZtZD will only hold the diagonal elements of
 #                    D(I+Z'ZD)^(-1)
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
+# - `iInfoMat` (optional): The inverse of the Fisher information matrix of
+#                          \theta, if it has already been computed.
 #
 # ----------------------------------------------------------------------------
 #
@@ -2670,7 +3160,7 @@ def get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
 # - `df`: The spatially varying Sattherthwaithe degrees of freedom estimate.
 #
 # ============================================================================
-def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs): 
+def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs, iXtiVX=None, iInfoMat=None): 
 
     # Reshape sigma2 if necessary
     sigma2 = sigma2.reshape(sigma2.shape[0])
@@ -2684,16 +3174,22 @@ def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
             n = n.reshape(sigma2.shape)
 
     # Get S^2 (= Var(L\beta))
-    S2 = get_varLB3D(L, XtiVX, sigma2, nraneffs)
+    S2 = get_varLB3D(L, XtiVX, sigma2, nraneffs, iXtiVX)
     
     # Get derivative of S^2
-    dS2 = get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2)
-
-    # Get Fisher information matrix
-    InfoMat = get_InfoMat3D(DinvIplusZtZD, sigma2, n, nlevels, nraneffs, ZtZ)
+    dS2 = get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2, iXtiVX)
 
     # Calculate df estimator
-    df = 2*(S2**2)/(dS2.transpose(0,2,1) @ np.linalg.solve(InfoMat, dS2))
+    if iInfoMat is None:
+
+        # Get Fisher information matrix
+        InfoMat = get_InfoMat3D(DinvIplusZtZD, sigma2, n, nlevels, nraneffs, ZtZ)
+
+        df = 2*(S2**2)/(dS2.transpose(0,2,1) @ np.linalg.solve(InfoMat, dS2))
+
+    else:
+
+        df = 2*(S2**2)/(dS2.transpose(0,2,1) @ iInfoMat @ dS2)
 
     # Return df
     return(df)
@@ -2716,7 +3212,8 @@ def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
 # - `nraneffs`: A vector containing the number of random effects for each
 #               factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #               random effects and the second factor has 1 random effect.
-# - `L`: A contrast vector.
+# - `L`: A contrast vector. If L has several rows, the derivative of 
+#        var(l\beta) is given for each row l of L.
 # - `XtiVX`: The matrix X'V^{-1}X.
 # - `ZtiVX`: The matrix Z'V^{-1}X.
 # - `DinvIplusZtZD`: The product D(I+Z'ZD)^(-1). If we are looking at a 
@@ -2724,6 +3221,8 @@ def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
 #                    DinvIplusZtZD will only hold the diagonal elements of
 #                    D(I+Z'ZD)^(-1)
 # - `sigma2`: The fixed effects variance estimate.
+# - `iXtiVX` (optional): The inverse of X'V^{-1}X, if it has already been
+#                        computed (e.g. when evaluating several contrasts).
 #
 # ----------------------------------------------------------------------------
 #
@@ -2731,10 +3230,11 @@ def get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nleve
 #
 # ----------------------------------------------------------------------------
 #
-# - `dS2`: The derivative of var(L\beta) with respect to \theta.
+# - `dS2`: The derivative of var(L\beta) with respect to \theta, with one
+#          column for each row of L.
 #
 # ============================================================================
-def get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2):
+def get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2, iXtiVX=None):
 
   # Number of random effects, r
   r = len(nraneffs)
@@ -2745,16 +3245,23 @@ def get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2):
   # Number of fixed effects p
   p = XtiVX.shape[-1]
 
+  # Number of rows of L
+  nL = L.shape[0]
+
   # New empty array for differentiating S^2 wrt (sigma2, vech(D1),...vech(Dr)).
-  dS2 = np.zeros((v, 1+np.int32(np.sum(nraneffs*(nraneffs+1)/2)),1))
+  dS2 = np.zeros((v, 1+np.int32(np.sum(nraneffs*(nraneffs+1)/2)),nL))
 
   # Work out indices for each start of each component of vector 
   # i.e. [dS2/dsigm2, dS2/vechD1,...dS2/vechDr]
   DerivInds = np.int32(np.cumsum(nraneffs*(nraneffs+1)/2) + 1)
   DerivInds = np.insert(DerivInds,0,1)
 
-  # Work of derivative wrt to sigma^2
-  dS2dsigma2 = L @ np.linalg.pinv(XtiVX) @ L.transpose()
+  # Inverse of X'V^{-1}X
+  if iXtiVX is None:
+    iXtiVX = np.linalg.pinv(XtiVX)
+
+  # Work of derivative wrt to sigma^2 (the diagonal of L(X'V^{-1}X)^{-1}L')
+  dS2dsigma2 = np.einsum('ij,vjk,ik->vi', L, iXtiVX, L)
 
   # Add to dS2
   dS2[:,0:1] = dS2dsigma2.reshape(dS2[:,0:1].shape)
@@ -2765,80 +3272,39 @@ def get_dS23D(nraneffs, nlevels, L, XtiVX, ZtiVX, sigma2):
   if r == 1 and nraneffs[0]==1:
 
     # Obtain ZtX(XtiVX)^(-1)L'
-    ZtiVXinvXtiVXLt = ZtiVX @ (np.linalg.inv(XtiVX) @ L.transpose())
+    ZtiVXinvXtiVXLt = ZtiVX @ (iXtiVX @ L.transpose())
 
     # Get the squared elements of Z'X(X'V^(-1)X)^(-1)L'. These are the terms in the
     # sum of the kronecker product.
     kronTerms = (ZtiVXinvXtiVXLt)**2
 
     # Get the derivative by summing the kronecker product terms
-    dS2dvechDk = np.einsum('i,ij->ij',sigma2, np.sum(kronTerms, axis=1)).reshape((v,1,1)) 
+    dS2dvechDk = np.einsum('i,ij->ij',sigma2, np.sum(kronTerms, axis=1)).reshape((v,1,nL)) 
 
     # Add to dS2
     dS2[:,DerivInds[0]:DerivInds[1]] = dS2dvechDk.reshape(dS2[:,DerivInds[0]:DerivInds[1]].shape)
 
-  # This can also be performed faster in the one factor, multiple random effect
-  # case by using only the diagonal blocks of DinvIplusZtZD 
-  elif r == 1 and nraneffs[0] > 1:
-
-    # Get (X'V^{-1}X)^{-1}L'
-    iXtiVXLt = np.linalg.inv(XtiVX) @ L.transpose()
-
-    # Now we need to work out ds2dVech(Dk)
-    for k in np.arange(len(nraneffs)):
-
-      # Initialize an empty zeros matrix
-      dS2dvechDk = np.zeros((np.int32(nraneffs[k]*(nraneffs[k]+1)/2),1))#...
-
-      for j in np.arange(nlevels[k]):
-
-        # Get the indices for this level and factor.
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
-                
-        # Work out Z_(k,j)'V^{-1}X
-        ZkjtiVX = ZtiVX[:,Ikj,:]
-
-        # Work out the term to put into the kronecker product
-        # K = Z_(k,j)'V^{-1}X(X'V^{-1})^{-1}L'
-        K = ZkjtiVX @ iXtiVXLt
-        
-        # Sum terms
-        dS2dvechDk = dS2dvechDk + dupMat2D(nraneffs[k]).toarray().transpose() @ mat2vec3D(kron3D(K,K.transpose(0,2,1)))
-
-      # Multiply by sigma^2
-      dS2dvechDk = np.einsum('i,ijk->ijk',sigma2,dS2dvechDk)
-
-      # Add to dS2
-      dS2[:,DerivInds[k]:DerivInds[k+1]] = dS2dvechDk.reshape(dS2[:,DerivInds[k]:DerivInds[k+1]].shape)
-
   else:
 
-    # Get (X'V^{-1}X)^{-1}L'
-    iXtiVXLt = np.linalg.inv(XtiVX) @ L.transpose()
+    # Obtain Z'V^{-1}X(X'V^{-1}X)^(-1)L'
+    ZtiVXinvXtiVXLt = ZtiVX @ (iXtiVX @ L.transpose())
+
+    # Work out the indices in Z'V^{-1}X where each factor starts
+    Zinds = np.insert(np.cumsum(nlevels*nraneffs),0,0)
 
     # Now we need to work out ds2dVech(Dk)
     for k in np.arange(len(nraneffs)):
 
-      # Initialize an empty zeros matrix
-      dS2dvechDk = np.zeros((np.int32(nraneffs[k]*(nraneffs[k]+1)/2),1))#...
+      # The rows for factor k, split into blocks for each level j, i.e. the 
+      # terms K_j = Z_(k,j)'V^{-1}X(X'V^{-1})^{-1}L'
+      K = ZtiVXinvXtiVXLt[:,Zinds[k]:Zinds[k+1],:].reshape(v,nlevels[k],nraneffs[k],nL)
 
-      for j in np.arange(nlevels[k]):
-
-        # Get the indices for this level and factor.
-        Ikj = faclev_indices2D(k, j, nlevels, nraneffs)
-                
-        # Work out Z_(k,j)'V^{-1}X
-        ZkjtiVX = ZtiVX[:,Ikj,:]
-
-        # Work out the term to put into the kronecker product
-        # K = Z_(k,j)'V^{-1}X(X'V^{-1})^{-1}L'
-        K = ZkjtiVX @ iXtiVXLt
-        
-        # Sum terms
-        dS2dvechDk = dS2dvechDk + dupMat2D(nraneffs[k]).toarray().transpose() @ mat2vec3D(kron3D(K,K.transpose(0,2,1)))
+      # Sum vec(K_jK_j') over levels j, for each column of K_j (as K_jK_j' 
+      # is symmetric the order of vectorisation does not matter)
+      vecKKt = np.einsum('vjac,vjbc->vabc',K,K).reshape(v,nraneffs[k]**2,nL)
 
-      # Multiply by sigma^2
-      dS2dvechDk = np.einsum('i,ijk->ijk',sigma2,dS2dvechDk)
+      # Multiply by sigma^2 and the transposed duplication matrix
+      dS2dvechDk = np.einsum('i,ijk->ijk',sigma2,dupMatT2D(nraneffs[k]) @ vecKKt)
 
       # Add to dS2
       dS2[:,DerivInds[k]:DerivInds[k+1]] = dS2dvechDk.reshape(dS2[:,DerivInds[k]:DerivInds[k+1]].shape)
@@ -2896,7 +3362,7 @@ def get_InfoMat3D(DinvIplusZtZD, sigma2, n, nlevels, nraneffs, ZtZ):
     dupMatTdict = dict()
     for i in np.arange(len(nraneffs)):
 
-        dupMatTdict[i] = np.asarray(dupMat2D(nraneffs[i]).todense()).transpose()
+        dupMatTdict[i] = dupMatT2D(nraneffs[i])
 
     # Index variables
     # ------------------------------------------------------------------------------
@@ -12,11 +12,12 @@ import sys
 import os
 import shutil
 import yaml
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 np.set_printoptions(threshold=np.nan)
 from BLMM.lib.fileio import *
 import scipy.sparse
-import pandas as pd
-from BLMM.lib.npMatrix3d import flattenZtZ
 
 # ====================================================================================
 #
@@ -82,39 +83,47 @@ def main(*args):
     # Output directory
     OutDir = inputs['outdir']
 
+    # Load the run context
+    context = getRunContext(inputs)
+
     # Get number of fixed effects parameters
-    L1 = str2vec(inputs['contrasts'][0]['c' + str(1)]['vector'])
-    L1 = np.array(L1)
-    p = L1.shape[0]
-    del L1
+    p = context['p']
 
-    # Y volumes
-    with open(inputs['Y_files']) as a:
+    # If the input images have been imported (see `blmm_import.py`) we read
+    # them from the store rather than from the NIFTIs
+    if 'Y_store' in inputs:
 
-        Y_files = []
-        i = 0
-        for line in a.readlines():
+        store = loadYStore(inputs['Y_store'], inputs)
+        Y_files = store['Y_files']
 
-            Y_files.append(line.replace('\n', ''))
+    else:
 
-    # Load in one nifti to check NIFTI size
-    try:
-        Y0 = loadFile(Y_files[0])
-    except Exception as error:
-        raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
+        store = None
+
+        # Y volumes
+        with open(inputs['Y_files']) as a:
+
+            Y_files = []
+            i = 0
+            for line in a.readlines():
+
+                Y_files.append(line.replace('\n', ''))
 
-    # Read in some data as a default nifti
-    d0 = Y0.get_data()
+        # Load in one nifti to check NIFTI size
+        try:
+            Y0 = loadFile(Y_files[0])
+        except Exception as error:
+            raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
 
     # Get q
-    q = int(inputs["q"])
+    q = context['q']
 
     # Get the maximum memory a NIFTI could take in storage. 
-    NIFTImem = sys.getsizeof(np.zeros(d0.shape,dtype='uint64'))
+    NIFTImem = sys.getsizeof(np.zeros(context['dim'],dtype='uint64'))
 
-    # Similar to blksize in SwE, we divide by 8 times the size of a nifti
-    # to work out how many blocks we use.
-    blksize = int(np.floor(MAXMEM/8/NIFTImem/p))
+    # Work out how many observations each batch holds (this must match the
+    # number used by `blmm_setup.py`).
+    blksize = get_blksize(inputs, NIFTImem, p, q)
 
     # Reduce X to X for this block.
     X = loadFile(inputs['X'])
@@ -129,6 +138,14 @@ def main(*args):
     # Number of levels for each factor, l
     nlevels = []
 
+    # Column indices and values of the non-zero elements of Z, for each row
+    # of Z (i.e. for each observation in this block)
+    Zcols = []
+    Zvals = []
+
+    # Index of the first column of Z for the current factor
+    Zoffset = 0
+
     # Read in each factor
     for i in range(0,r):
 
@@ -139,44 +156,46 @@ def main(*args):
         # Read the random effects design in
         Zi_design = loadFile(inputs['Z'][i]['f' + str(i+1)]['design'])
 
-        # Number of random effects and number of levels
-        nraneffs = nraneffs + [Zi_design.shape[1]]
-        nlevels = nlevels + [len(np.unique(Zi_factor))]
+        # Get the (zero-indexed) level each observation belongs to
+        levels, Zi_level = np.unique(Zi_factor, return_inverse=True)
+        Zi_level = Zi_level.reshape(len(Zi_factor))
 
         # Number of levels for factor i
-        l_i = np.amax(Zi_factor)
+        l_i = len(levels)
 
         # Number of parameters for factor i
         q_i = Zi_design.shape[1]
 
-        # One hot encode the factor vector
-        Zi_factor = pd.get_dummies(pd.DataFrame(Zi_factor)[0]).values
+        # Number of random effects and number of levels
+        nraneffs = nraneffs + [q_i]
+        nlevels = nlevels + [l_i]
 
         # Reduce to block.
         Zi_design = Zi_design[(blksize*(batchNo-1)):min((blksize*batchNo),len(Y_files))]
-        Zi_factor = Zi_factor[(blksize*(batchNo-1)):min((blksize*batchNo),len(Y_files))]
-
-        # Repeat Zi_factor for each parameter
-        Zi = np.repeat(Zi_factor, q_i,axis=1).astype(np.float64)
+        Zi_level = Zi_level[(blksize*(batchNo-1)):min((blksize*batchNo),len(Y_files))]
 
-        # Fill the one values with the design
-        Zi[Zi==1]=Zi_design.reshape(Zi[Zi==1].shape)
+        # The observations for level j of factor i occupy columns 
+        # Zoffset + j*q_i, ..., Zoffset + (j+1)*q_i - 1 of Z, where they take
+        # the values given by the design.
+        Zcols = Zcols + [Zoffset + Zi_level.reshape(len(Zi_level),1)*q_i + np.arange(q_i)]
+        Zvals = Zvals + [Zi_design.astype(np.float64)]
 
-        # Concatenate Z's Horizontally
-        if i == 0:
+        # Move on to the columns for the next factor
+        Zoffset = Zoffset + l_i*q_i
 
-            Z = Zi
-
-        else:
-
-            Z = np.hstack((Z,Zi))
+    # Construct Z. Every row of Z contains the same number of non-zero
+    # elements (one for each random effect of each factor), so we store Z 
+    # as a sparse matrix which holds exactly the column indices and values
+    # above.
+    Z = sparseZ(np.hstack(Zcols), np.hstack(Zvals), Zoffset)
 
     # Get number of random effects and number of levels
     nraneffs = np.array(nraneffs)
     nlevels = np.array(nlevels)
 
-    # Mask volumes (if they are given)
-    if 'data_mask_files' in inputs:
+    # Mask volumes (if they are given, the store has already been masked
+    # with them, see `loadYStore`)
+    if 'data_mask_files' in inputs and store is None:
 
         # Rrad in mask files, making sure to avoid the newline characters
         with open(inputs['data_mask_files']) as a:
@@ -211,92 +230,112 @@ def main(*args):
         # There is not a mask for each Y as there are no masks at all!
         M_files = []
 
-    # Mask threshold for Y (if given)
-    if 'data_mask_thresh' in inputs:
+    # Mask threshold for Y (if given, the store has already been thresholded
+    # with it)
+    if 'data_mask_thresh' in inputs and store is None:
         M_t = float(inputs['data_mask_thresh'])
     else:
         M_t = None
 
-    # Mask volumes (if they are given)
+    # Analysis mask indices (if an analysis mask is given)
     if 'analysis_mask' in inputs:
-
-        # Load the file and check it's shape is 3d (as oppose to 4d with a 4th dimension
-        # of 1)
-        M_a = loadFile(inputs['analysis_mask']).get_data()
-        M_a = M_a.reshape((M_a.shape[0],M_a.shape[1],M_a.shape[2]))
-
+        amInds = context['amInds']
     else:
-
-        # Else set to None
-        M_a = None
+        amInds = None
 
     # Reduce Y_files to only Y files for this block
     Y_files = Y_files[(blksize*(batchNo-1)):min((blksize*batchNo),len(Y_files))]
     
-    # Verify input
-    verifyInput(Y_files, M_files, Y0)
+    if store is None:
 
-    # Obtain Y, M (essentially the array Y!=0) n_sv and Mmap.
-    # This mask is just for voxels with no studies present.
-    Y, n_sv, M, Mmap = obtainY(Y_files, M_files, M_t, M_a)
+        # Verify input
+        verifyInput(Y_files, M_files, Y0)
 
-    # Work out voxel specific designs
-    MX = applyMask(X, M)
-    MZ = applyMask(Z, M) 
+    else:
+
+        # The observations for this block
+        store['rows'] = range(blksize*(batchNo-1), min(blksize*batchNo, store['n']))
+
+    # Number of input volumes to read ahead of the current one (if given)
+    if 'prefetch' in inputs:
+        prefetch = int(inputs['prefetch'])
+    else:
+        prefetch = 0
 
-    # Get X'Y, Z'Y and Y'Y. 
+    # Get X'Y, Z'Y and Y'Y.
     # ------------------------------------------------------------------
     # Developer note: For these product matrices we do not need to worry
-    # about missing rows in X and Z. This is as the corresponding 
-    # elements in Y should already be set to 0 and, as such, won't have 
+    # about missing rows in X and Z. This is as the corresponding
+    # elements in Y should already be set to 0 and, as such, won't have
     # any affect on these products.
     # ------------------------------------------------------------------
+    if 'batchStreaming' in inputs and inputs['batchStreaming']:
+
+        # In streaming mode each observation is folded into X'Y, Z'Y,
+        # Y'Y and n_sv as soon as it is read, so Y is never constructed
+        # in full. We also obtain M (the unique columns of the array 
+        # Y!=0) and Mmap here.
+        # 
+        # Z'Y is accumulated with one row per random effect (i.e. as 
+        # (Z'Y)'), so that each observation only touches the rows for its
+        # own levels. If this does not comfortably fit in memory it is kept
+        # on disk instead.
+        if amInds is not None:
+            v_am = len(amInds)
+        else:
+            v_am = int(np.prod(context['dim']))
+        if 4*8*q*v_am > MAXMEM:
+            ZtYfile = os.path.join(OutDir,"tmp","ZtY_b" + str(batchNo) + ".acc.npy")
+        else:
+            ZtYfile = None
 
-    # We are careful how we compute X'Y and Z'Y, in case either p or q
-    # is large. We save these "chunk by chunk" as memory map objects just
-    # in case they don't fit in working memory (this is only usually a
-    # large issue for very large designs).
-    memorySafeAtB(Z.reshape(1,Z.shape[0],Z.shape[1]),Y,MAXMEM,"ZtY",inputs)
-    memorySafeAtB(X.reshape(1,X.shape[0],X.shape[1]),Y,MAXMEM,"XtY",inputs)
-    memorySafeAtB(Y,Y,MAXMEM,"YtY",inputs)
-
-    # In a spatially varying design XtX has dimensions n by p by p. We
-    # reshape to n by p^2 so that we can save as a csv.
-    XtX = MX.transpose(0,2,1) @ MX
-    XtX = XtX.reshape([XtX.shape[0], XtX.shape[1]*XtX.shape[2]])
+        XtY, ZtY, YtY, n_sv, M, Mmap = accumulateY(Y_files, M_files, M_t, amInds, X, Z, prefetch, store, ZtYfile)
 
-    # In a spatially varying design ZtX has dimensions n by q by p. We
-    # reshape to n by q*p so that we can save as a csv.
-    ZtX = MZ.transpose(0,2,1) @ MX
-    ZtX = ZtX.reshape([ZtX.shape[0], ZtX.shape[1]*ZtX.shape[2]])
+        # Save the product matrices "chunk by chunk" as memory map objects.
+        memorySafeAtB(None,ZtY.transpose(),MAXMEM,"ZtY",inputs,batchNo)
+        memorySafeAtB(None,XtY.transpose(),MAXMEM,"XtY",inputs,batchNo)
+        memorySafeAtB(None,YtY,MAXMEM,"YtY",inputs,batchNo)
+        del XtY, ZtY, YtY
 
-    # In a spatially varying design ZtZ has dimensions n by q by q. 
-    ZtZ = MZ.transpose(0,2,1) @ MZ
+        # Remove the on-disk Z'Y (if there is one)
+        if ZtYfile is not None:
+            os.remove(ZtYfile)
 
-    # If we are looking at the one random factor one random effect model
-    # we only need record the diagonal of ZtZ
-    if r == 1 and nraneffs[0]==1:
+    else:
 
-        # Cut Z'Z down to diagonal elements only.
-        ZtZ = np.einsum('ijj->ij',ZtZ)
+        # Obtain Y, M (essentially the array Y!=0) n_sv and Mmap.
+        # This mask is just for voxels with no studies present.
+        Y, n_sv, M, Mmap = obtainY(Y_files, M_files, M_t, amInds, prefetch, store)
 
-        # We reshape to n by q^2 so that we can save as a csv.
-        ZtZ = ZtZ.reshape([ZtZ.shape[0], nlevels[0]])
-    
-    # If we are looking at the one random factor multiple random effect model
-    # we only need record the diagonal blocks of ZtZ
-    elif r == 1 and nraneffs[0]>1:
+        # We are careful how we compute X'Y and Z'Y, in case either p or q
+        # is large. We save these "chunk by chunk" as memory map objects just
+        # in case they don't fit in working memory (this is only usually a
+        # large issue for very large designs).
+        memorySafeAtB(Z,Y,MAXMEM,"ZtY",inputs,batchNo)
+        memorySafeAtB(X.reshape(1,X.shape[0],X.shape[1]),Y,MAXMEM,"XtY",inputs,batchNo)
+        memorySafeAtB(Y,Y,MAXMEM,"YtY",inputs,batchNo)
+        del Y
 
-        # Cut Z'Z down to diagonal elements only.
-        ZtZ = flattenZtZ(ZtZ, nlevels[0], nraneffs[0])
+    # Work out voxel specific designs
+    MX = applyMask(X, M)
 
-        # We reshape to n by q*q0 so that we can save as a csv.
-        ZtZ = ZtZ.reshape([ZtZ.shape[0], ZtZ.shape[1]*ZtZ.shape[2]])
+    # In a spatially varying design XtX has dimensions n by p by p. We
+    # reshape to n by p^2 so that we can save as a csv.
+    XtX = MX.transpose(0,2,1) @ MX
+    XtX = XtX.reshape([XtX.shape[0], XtX.shape[1]*XtX.shape[2]])
+    del MX
 
-    else:
+    # In a spatially varying design ZtX has dimensions n by q by p. We
+    # reshape to n by q*p so that we can save as a csv.
+    ZtX = sparseZtX(Z, X, M)
 
-        # We reshape to n by q^2 so that we can save as a csv.
-        ZtZ = ZtZ.reshape([ZtZ.shape[0], ZtZ.shape[1]*ZtZ.shape[2]])
+    # In a spatially varying design ZtZ has dimensions n by q by q. If we
+    # are looking at the one random factor one random effect model we only 
+    # record the diagonal of ZtZ (n by q) and if we are looking at the one
+    # random factor multiple random effect model we only record the diagonal
+    # blocks of ZtZ (n by q0 by q, see `flattenZtZ`). We reshape to n by
+    # q^2, n by q and n by q*q0, respectively, so that we can save as a csv.
+    ZtZ = sparseZtZ(Z, M, r, nraneffs)
 
     # Record product matrices X'X, Y'Y, Z'X and Z'Z.
     np.save(os.path.join(OutDir,"tmp","XtX" + str(batchNo)), 
@@ -308,8 +347,8 @@ def main(*args):
 
     # Get map of number of observations at voxel.
     n_sv = nib.Nifti1Image(n_sv,
-                           Y0.affine,
-                           header=Y0.header)
+                           context['affine'],
+                           header=context['header'])
     nib.save(n_sv, os.path.join(OutDir,'tmp',
                     'blmm_vox_n_batch'+ str(batchNo) + '.nii'))
 
@@ -317,8 +356,8 @@ def main(*args):
     # using an integer representing the order in which X'X, Z'X and Z'Z 
     # appear in the `XtX.npy`, `ZtX.npy` and `ZtZ.npy` files respectively.
     Mmap = nib.Nifti1Image(Mmap,
-                           Y0.affine,
-                           header=Y0.header)
+                           context['affine'],
+                           header=context['header'])
     nib.save(Mmap, os.path.join(OutDir,'tmp',
                     'blmm_vox_uniqueM_batch'+ str(batchNo) + '.nii'))
 
@@ -344,7 +383,6 @@ def main(*args):
 def verifyInput(Y_files, M_files, Y0):
 
     # Obtain information about zero-th observation
-    d0 = Y0.get_data()
     Y0aff = Y0.affine
 
     # Initial checks for NIFTI compatability for Y.
@@ -437,6 +475,181 @@ def applyMask(X,M):
     return MX
 
 
+# ============================================================================
+#
+# The below function constructs the random effects design matrix, Z, as a
+# sparse (CSR) matrix. Each row of Z has one non-zero element for every random
+# effect of every factor, whose column is determined by the level of the
+# factor the observation belongs to. Z is therefore given by the column
+# indices and values of these elements, for each row.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Zcols`: An (n by k) array of the columns of the non-zero elements of 
+#             each row of Z.
+#  - `Zvals`: An (n by k) array of the values of the non-zero elements of
+#             each row of Z.
+#  - `q`: The number of columns of Z.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Z`: The random effects design matrix, as an (n by q) sparse matrix.
+#
+# ============================================================================
+def sparseZ(Zcols, Zvals, q):
+
+    # Number of rows of Z and non-zero elements per row
+    n = Zcols.shape[0]
+    k = Zcols.shape[1]
+
+    # Construct Z in CSR format
+    Z = scipy.sparse.csr_matrix((Zvals.reshape(n*k), Zcols.reshape(n*k), 
+                                 np.arange(0, n*k+1, k)), shape=(n, q))
+
+    return(Z)
+
+
+# ============================================================================
+#
+# The below function computes Z'X for every unique mask, i.e. for every
+# column of M, using the sparsity of Z. This is equivalent to (but much
+# cheaper than) computing MZ'MX, where MZ and MX are the outputs of 
+# `applyMask`.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Z`: The (n by q) sparse random effects design matrix.
+#  - `X`: The (n by p) fixed effects design matrix.
+#  - `M`: The (n by v) array of unique masks (essentially the array Y!=0).
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ZtX`: Z'X for each column of M, reshaped to v by q*p.
+#
+# ============================================================================
+def sparseZtX(Z, X, M):
+
+    # Work out dimensions
+    n = X.shape[0]
+    p = X.shape[1]
+    v = M.shape[1]
+    q = Z.shape[1]
+
+    # Masked X for every column of M, arranged as an n by v*p matrix
+    MX = (M.reshape(n, v, 1)*X.reshape(n, 1, p)).reshape(n, v*p)
+
+    # Compute Z'X for every column of M
+    ZtX = Z.transpose() @ MX
+    ZtX = ZtX.reshape(q, v, p).transpose(1, 0, 2)
+
+    return(ZtX.reshape(v, q*p))
+
+
+# ============================================================================
+#
+# The below function computes Z'Z for every unique mask, i.e. for every
+# column of M, using the sparsity of Z. Every element of Z'Z is a sum, over
+# observations, of products of two non-zero elements of a row of Z. We form,
+# for each observation, all such products (placed in the column of the output
+# they contribute to) and sum across observations with a single sparse
+# matrix product.
+#
+# As in the rest of BLMM, in the one random factor, one random effect model,
+# only the diagonal of Z'Z is recorded and, in the one random factor, multiple
+# random effects model only the diagonal blocks of Z'Z are recorded, in the
+# form given by `flattenZtZ`.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Z`: The (n by q) sparse random effects design matrix (see `sparseZ`).
+#  - `M`: The (n by v) array of unique masks (essentially the array Y!=0).
+#  - `r`: The number of random factors in the model.
+#  - `nraneffs`: A vector containing the number of random effects for each
+#                factor, e.g. `nraneffs=[2,1]` would mean the first factor
+#                has random effects and the second factor has 1 random
+#                effect.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ZtZ`: Z'Z for each column of M, reshaped to v by q^2 (or to v by q if
+#           r=1 and nraneffs[0]=1, or v by q0*q if r=1 and nraneffs[0]>1).
+#
+# ============================================================================
+def sparseZtZ(Z, M, r, nraneffs):
+
+    # Work out dimensions
+    n = Z.shape[0]
+    q = Z.shape[1]
+
+    # Number of non-zero elements per row of Z
+    k = Z.indptr[1]-Z.indptr[0]
+
+    # Columns and values of the non-zero elements of each row of Z
+    Zcols = Z.indices.reshape(n, k)
+    Zvals = Z.data.reshape(n, k)
+
+    # All pairs of non-zero elements in each row of Z (in the one random
+    # factor, one random effect model there is only one non-zero element per
+    # row and so we only need the diagonal)
+    cols1 = Zcols.reshape(n, k, 1)
+    cols2 = Zcols.reshape(n, 1, k)
+    vals = Zvals.reshape(n, k, 1)*Zvals.reshape(n, 1, k)
+
+    # Work out which column of the (flattened) output each product
+    # contributes to
+    if r == 1 and nraneffs[0]==1:
+
+        # Diagonal elements only
+        outCols = cols1
+        nOutCols = q
+
+    elif r == 1 and nraneffs[0]>1:
+
+        # Diagonal blocks only (in the form given by `flattenZtZ`)
+        outCols = (cols1 % nraneffs[0])*q + cols2
+        nOutCols = nraneffs[0]*q
+
+    else:
+
+        # Full Z'Z
+        outCols = cols1*q + cols2
+        nOutCols = q*q
+
+    # Each row of this (sparse) matrix contains the contributions of one
+    # observation to Z'Z
+    ZkronZ = scipy.sparse.csr_matrix((vals.reshape(n*k*k), outCols.reshape(n*k*k), 
+                                      np.arange(0, n*k*k+1, k*k)), shape=(n, nOutCols))
+
+    # Sum the contributions of the observations present for each mask
+    ZtZ = (ZkronZ.transpose() @ M.astype(np.float64)).transpose()
+
+    return(np.ascontiguousarray(ZtZ))
+
+
 # ============================================================================
 # 
 # The below function reads in the input files and thresholds and returns; Y
@@ -455,7 +668,13 @@ def applyMask(X,M):
 #  - `M_files`: A list of input NIFTI mask volumes.
 #  - `M_t`: A numerical threshold k. Any voxel with less than k input volumes
 #           present will be discarded. Can be set to None.
-#  - `M_a`: An overall analysis mask 3D numpy array. Can be set to None.
+#  - `amInds`: The (flattened) indices of the voxels in the analysis mask
+#              (see `get_amInds`). Can be set to None.
+#  - `prefetch`: The number of input volumes to read ahead of the current
+#                one (see `prefetchY`). Set to 0 to read serially.
+#  - `store`: Optional input store (see `loadYStore`), with `rows` set to
+#             the observations in `Y_files`. If given, the observations are read
+#             from the store rather than from `Y_files` (see `storeY`).
 #
 # ----------------------------------------------------------------------------
 #
@@ -470,87 +689,78 @@ def applyMask(X,M):
 #  - `Mmap`: A uniqueness map representing which voxel has which design.
 #
 # ============================================================================
-def obtainY(Y_files, M_files, M_t, M_a):
+def obtainY(Y_files, M_files, M_t, amInds, prefetch=0, store=None):
 
     # Load in one nifti to check NIFTI size
-    Y0 = loadFile(Y_files[0])
-    d = Y0.get_data()
+    if store is None:
+        Y0 = loadFile(Y_files[0])
+        dim = Y0.shape
+    else:
+        dim = tuple(store['dim'])
     
     # Get number of voxels.
-    v = np.prod(d.shape)
+    v = np.prod(dim)
 
     # Number of observations in block
     n = len(Y_files)
 
-    # Count number of observations contributing to voxels
-    n_sv = np.zeros(d.shape)
+    # We only read in the voxels in the analysis mask, we use the analysis
+    # mask here as the product matrices across all batches should have the
+    # same masking for convinience. We can apply the full mask at a later
+    # stage.
+    if amInds is not None:
+        v_am = len(amInds)
+    else:
+        v_am = v
 
-    # Read in Y
-    Y = np.zeros([n, v])
-    for i in range(0, len(Y_files)):
+    # Timings for reading versus computation
+    times = {'wait': 0, 'compute': 0}
 
-        # Read in each individual NIFTI.
-        Y_indiv = loadFile(Y_files[i])
+    # Read in Y
+    if store is None:
+        volumes = prefetchY(Y_files, M_files, M_t, prefetch, times, amInds)
+    else:
+        volumes = storeY(store, times, amInds)
 
-        # Mask Y if necesary
-        if M_files:
-        
-            # Apply mask
-            M_indiv = loadFile(M_files[i]).get_data()
-            d = np.multiply(
-                Y_indiv.get_data(),
-                M_indiv)
-        else: 
-            #Just load in Y
-            d = Y_indiv.get_data()
+    Y = np.zeros([n, v_am])
+    for i, d in volumes:
 
-        # If theres an initial threshold for the data apply it.
-        if M_t is not None:
-            d[d<M_t]=0
+        # NaN check and constructing Y array
+        Y[i, :] = np.nan_to_num(d).reshape([v_am])
 
-        if M_a is not None:
-            d[M_a==0]=0
+    # Report how long was spent waiting on input
+    printTimes(times)
 
-        # NaN check
-        d = np.nan_to_num(d)
+    # Count number of observations at each voxel
+    n_sv_am = np.count_nonzero(Y, axis=0)
 
-        # Count number of observations at each voxel
-        n_sv = n_sv + 1*(np.nan_to_num(d)!=0)
+    # Work out the voxels with data for at least one observation
+    Mask_am = n_sv_am>0
 
-        # Constructing Y array
-        Y[i, :] = d.reshape([1, v])
-    
-    # Work out mask
-    Mask = np.zeros([v])
-    Mask[np.where(np.count_nonzero(Y, axis=0)>0)[0]] = 1
+    # Work out the mask (in full volume space)
+    if amInds is not None:
+        maskInds = amInds[Mask_am]
+    else:
+        maskInds = np.flatnonzero(Mask_am)
     
     # Apply full mask to Y
-    Y_fm = Y[:, np.where(np.count_nonzero(Y, axis=0)>0)[0]]
-
-    # Apply analysis mask to Y, we use the analysis mask here as the product
-    # matrices across all batches should have the same masking for convinience
-    # We can apply the full mask at a later stage.
-    if M_a is not None:
-        Y = Y[:, np.where(M_a.reshape([v]))[0]]
+    Y_fm = Y[:, Mask_am]
 
     # Work out the mask.
     M = (Y_fm!=0)
 
-    # Get indices corresponding to the unique rows of M
-    M_df = pd.DataFrame(M.transpose())
-    M_df['id'] = M_df.groupby(M_df.columns.tolist(), sort=False).ngroup() + 1
-    unique_id_nifti = M_df['id'].values
+    # Get the unique columns of M and the id of the column each voxel had
+    M, unique_id_nifti = uniqueMasks(M)
 
     # Make a nifti which will act as a "key" telling us which voxel had which design
-    Mmap = np.zeros(Mask.shape)
-    Mmap[np.flatnonzero(Mask)] = unique_id_nifti[:]
-    Mmap = Mmap.reshape(n_sv.shape)
+    Mmap = np.zeros([v])
+    Mmap[maskInds] = unique_id_nifti[:]
+    Mmap = Mmap.reshape(dim)
 
-    # Get the unique columns of M (Care must be taken here to retain
-    # the original ordering, as unique_id_nifti is now based on said
-    # ordering)
-    _, idx = np.unique(M, axis=1, return_index=True)
-    M = M[:,np.sort(idx)]
+    # Unmask n_sv
+    n_sv = np.zeros([v])
+    n_sv[maskInds] = n_sv_am[Mask_am]
+    n_sv = n_sv.reshape(dim)
 
     # Reshape Y
     Y = Y.reshape(Y.shape[0], Y.shape[1], 1).transpose((1,0,2))
@@ -559,6 +769,605 @@ def obtainY(Y_files, M_files, M_t, M_a):
     return Y, n_sv, M, Mmap
 
 
+# ============================================================================
+#
+# The below function is the streaming counterpart of `obtainY`. Rather than
+# reading all of Y into memory, each input file is read in, masked and then
+# immediately added to running totals of X'Y, Z'Y, Y'Y and n_sv before being
+# discarded. The missingness pattern (i.e. column of the array Y!=0) of each
+# voxel is also built up one observation at a time, as an id into a tree of
+# the patterns seen so far (see `updatePatterns`), so the array Y!=0 is
+# never held either. Peak memory therefore scales with the number of voxels
+# (and, if `ZtYfile` is given, does not depend on q) rather than with the 
+# number of observations multiplied by the number of voxels.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Y_files`: A list of input NIFTI volumes.
+#  - `M_files`: A list of input NIFTI mask volumes.
+#  - `M_t`: A numerical threshold k. Any voxel with less than k input volumes
+#           present will be discarded. Can be set to None.
+#  - `amInds`: The (flattened) indices of the voxels in the analysis mask
+#              (see `get_amInds`). Can be set to None.
+#  - `X`: The fixed effects design matrix for this batch.
+#  - `Z`: The random effects design matrix for this batch, as a sparse
+#         matrix (see `sparseZ`).
+#  - `prefetch`: The number of input volumes to read ahead of the current
+#                one (see `prefetchY`). Set to 0 to read serially.
+#  - `store`: Optional input store (see `loadYStore`), with `rows` set to
+#             the observations in `Y_files`. If given, the observations are read
+#             from the store rather than from `Y_files` (see `storeY`).
+#  - `ZtYfile`: Optional file name. If given, Z'Y is accumulated in a memory
+#               mapped file of this name, rather than in memory.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `XtY`: (X'Y)' for every voxel in the analysis mask (dimension p by v).
+#  - `ZtY`: (Z'Y)' for every voxel in the analysis mask (dimension q by v).
+#  - `YtY`: Y'Y for every voxel in the analysis mask (dimension v by 1).
+#  - `n_sv`: The spatially varying number of observations (as a 3D numpy
+#            array).
+#  - `M`: The unique columns of the array Y!=0.
+#  - `Mmap`: A uniqueness map representing which voxel has which design.
+#
+# ============================================================================
+def accumulateY(Y_files, M_files, M_t, amInds, X, Z, prefetch=0, store=None, ZtYfile=None):
+
+    # Load in one nifti to check NIFTI size
+    if store is None:
+        Y0 = loadFile(Y_files[0])
+        dim = Y0.shape
+    else:
+        dim = tuple(store['dim'])
+
+    # Get number of voxels.
+    v = np.prod(dim)
+
+    # Number of observations in block
+    n = len(Y_files)
+
+    # Get the indices of the voxels in the analysis mask (we use the analysis
+    # mask here as the product matrices across all batches should have the
+    # same masking for convinience).
+    if amInds is not None:
+        readInds = amInds
+    else:
+        amInds = np.arange(v)
+        readInds = None
+
+    # Number of voxels in analysis mask
+    v_am = len(amInds)
+
+    # Running totals for the product matrices and n_sv. X'Y and Z'Y are held
+    # transposed so that each observation updates contiguous rows.
+    XtY = np.zeros([X.shape[1], v_am])
+    if ZtYfile is None:
+        ZtY = np.zeros([Z.shape[1], v_am])
+    else:
+        ZtY = open_memmap(ZtYfile, mode='w+', dtype='float64', shape=(Z.shape[1], v_am))
+    YtY = np.zeros([v_am, 1])
+    n_sv = np.zeros([v_am])
+
+    # The missingness pattern of each voxel so far (all voxels start with 
+    # the same, empty, pattern) and the tree of patterns (see 
+    # `updatePatterns`)
+    ids = np.zeros([v_am], dtype=np.int64)
+    tree = []
+
+    # Timings for reading versus computation
+    times = {'wait': 0, 'compute': 0}
+
+    if store is None:
+        volumes = prefetchY(Y_files, M_files, M_t, prefetch, times, readInds)
+    else:
+        volumes = storeY(store, times, readInds)
+
+    for i, d in volumes:
+
+        # Perform NaN check
+        y = np.nan_to_num(d.reshape([v_am])).astype(np.float64)
+        del d
+
+        # Record where we had data
+        m = (y!=0)
+        ids = updatePatterns(ids, m, tree)
+
+        # Count number of observations at each voxel
+        n_sv = n_sv + m
+
+        # Fold this observation into the running totals
+        XtY += X[i,:].reshape(X.shape[1],1)*y
+        # (Only the rows of (Z'Y)' corresponding to non-zero elements of 
+        # the i^th row of Z are affected)
+        Zinds = slice(Z.indptr[i], Z.indptr[i+1])
+        ZtY[Z.indices[Zinds],:] += Z.data[Zinds].reshape(-1,1)*y
+        YtY[:,0] += y**2
+
+    # Report how long was spent waiting on input
+    printTimes(times)
+
+    # Work out the voxels (in the analysis mask) with data for at least one
+    # observation
+    Mask_am = n_sv>0
+
+    # Get the unique columns of M and the id of the column each voxel had
+    M, unique_id_nifti = treeMasks(ids[Mask_am], tree)
+
+    # Make a nifti which will act as a "key" telling us which voxel had which design
+    Mmap = np.zeros([v])
+    Mmap[amInds[Mask_am]] = unique_id_nifti[:]
+    Mmap = Mmap.reshape(dim)
+
+    # Unmask n_sv
+    n_sv_full = np.zeros([v])
+    n_sv_full[amInds] = n_sv
+    n_sv = n_sv_full.reshape(dim)
+
+    # Return results
+    return XtY, ZtY, YtY, n_sv, M, Mmap
+
+
+# ============================================================================
+#
+# The below function extends the missingness patterns of every voxel by one
+# observation. Each voxel's pattern so far is represented by an id, into the
+# patterns seen so far. Appending the new observation to the pattern with id
+# j gives the "child" pattern 2j (no data) or 2j+1 (data), which are then
+# relabelled as 0, 1, 2,... in order. For each new pattern we record the id
+# of its "parent" and the value it appended, so that the patterns can be 
+# recovered at the end (see `treeMasks`). This costs a fixed number of 
+# passes over the voxels per observation, no matter how many patterns there
+# are.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ids`: The id of the pattern of each voxel so far.
+#  - `m`: Boolean array, the new observation is present at each voxel.
+#  - `tree`: List of (parent, value) arrays, one for each observation so 
+#            far, which the new observation is appended to.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ids`: The id of the pattern of each voxel including the new 
+#           observation.
+#
+# ============================================================================
+def updatePatterns(ids, m, tree):
+
+    # Id of each voxel's child pattern
+    child = 2*ids + m
+
+    # Relabel the children which occur
+    occurs = np.bincount(child, minlength=1)>0
+    labels = np.cumsum(occurs) - 1
+    children = np.flatnonzero(occurs)
+
+    # Record the parent of, and value appended by, each new pattern
+    tree.append((children//2, (children%2).astype(bool)))
+
+    return(labels[child])
+
+
+# ============================================================================
+#
+# The below function recovers the unique missingness patterns from the tree
+# built by `updatePatterns`, and returns them (and the id of the pattern of
+# each voxel) in the same form as `uniqueMasks`.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ids`: The id of the pattern of each voxel (see `updatePatterns`).
+#  - `tree`: The tree of patterns (see `updatePatterns`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `M_unique`: The unique columns of the array Y!=0, ordered by first
+#                appearance.
+#  - `unique_id`: The id of the column each voxel had, starting from 1.
+#
+# ============================================================================
+def treeMasks(ids, tree):
+
+    # The patterns which occur, the first voxel with each and the pattern 
+    # each voxel had
+    patterns, idx, inverse = np.unique(ids, return_index=True, return_inverse=True)
+
+    # Reorder the patterns by first appearance
+    order = np.argsort(idx)
+    rank = np.zeros(len(idx), dtype=np.int64)
+    rank[order] = np.arange(len(idx))
+    unique_id = rank[inverse.reshape(len(ids))] + 1
+
+    # Walk back up the tree to recover each pattern
+    M_unique = np.zeros([len(tree), len(patterns)], dtype=bool)
+    node = patterns[order]
+    for i in range(len(tree)-1, -1, -1):
+        parent, value = tree[i]
+        M_unique[i,:] = value[node]
+        node = parent[node]
+
+    return M_unique, unique_id
+
+
+# ============================================================================
+#
+# The below function reads in a single input volume, applies its data mask
+# (if there is one) and the initial threshold (if there is one).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Y_file`: An input NIFTI volume.
+#  - `M_file`: The corresponding input NIFTI mask volume. Can be set to None.
+#  - `M_t`: A numerical threshold k. Any voxel with less than k input volumes
+#           present will be discarded. Can be set to None.
+#  - `inds`: Optional flattened voxel indices (e.g. the analysis mask
+#            indices given by `get_amInds`). If given, only these voxels
+#            are read in.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `d`: The masked and thresholded volume, as a 3D numpy array, or, if
+#         `inds` was given, the masked and thresholded voxels with indices
+#         `inds`, as a 1D numpy array.
+#
+# ============================================================================
+def readY(Y_file, M_file, M_t, inds=None):
+
+    # If we have been given voxel indices, read in only those voxels
+    if inds is not None:
+
+        d = loadVoxels(Y_file, inds)
+
+        # Mask Y if necesary
+        if M_file is not None:
+            d = np.multiply(d, loadVoxels(M_file, inds))
+
+        # If theres an initial threshold for the data apply it.
+        if M_t is not None:
+            d[d<M_t]=0
+
+        return(d)
+
+    # Read in the NIFTI.
+    Y_indiv = loadFile(Y_file)
+
+    # Mask Y if necesary
+    if M_file is not None:
+
+        # Apply mask
+        M_indiv = loadFile(M_file).get_data()
+        d = np.multiply(
+            Y_indiv.get_data(),
+            M_indiv)
+    else:
+        #Just load in Y
+        d = Y_indiv.get_data()
+
+    # If theres an initial threshold for the data apply it.
+    if M_t is not None:
+        d[d<M_t]=0
+
+    return(d)
+
+
+# ============================================================================
+#
+# The below function is a generator which yields the input volumes of a batch
+# one at a time, in order, alongside their index. Reading and decompressing
+# the volumes (most of which are typically .nii.gz) is the dominant cost of
+# the batch stage, so, if `prefetch` is greater than 0, a pool of `prefetch`
+# threads reads the next `prefetch` volumes (and masks) in the background
+# whilst the current volume is being used. At most `prefetch` volumes are
+# held in memory in addition to the current one.
+#
+# The time spent waiting for volumes to be read and the time spent by the
+# caller between volumes are added to `times['wait']` and `times['compute']`
+# respectively.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `Y_files`: A list of input NIFTI volumes.
+#  - `M_files`: A list of input NIFTI mask volumes.
+#  - `M_t`: A numerical threshold k. Any voxel with less than k input volumes
+#           present will be discarded. Can be set to None.
+#  - `prefetch`: The number of volumes to read ahead of the current one.
+#  - `times`: A dictionary with fields `wait` and `compute`, which timings
+#             are added to.
+#  - `inds`: Optional flattened voxel indices. If given, only these voxels
+#            are read in (see `readY`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function yields:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `i`: The index of the volume in `Y_files`.
+#  - `d`: The masked and thresholded volume (see `readY`).
+#
+# ============================================================================
+def prefetchY(Y_files, M_files, M_t, prefetch, times, inds=None):
+
+    # Number of observations in block
+    n = len(Y_files)
+
+    # Work out the mask file for each volume
+    if M_files:
+        maskFiles = M_files
+    else:
+        maskFiles = [None]*n
+
+    # Read serially
+    if prefetch < 1:
+
+        for i in range(0, n):
+
+            t1 = time.time()
+            d = readY(Y_files[i], maskFiles[i], M_t, inds)
+            t2 = time.time()
+            times['wait'] += t2 - t1
+
+            yield i, d
+            times['compute'] += time.time() - t2
+
+        return
+
+    # Read ahead using a bounded pool of threads
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+
+        # Queue the first volumes
+        queue = deque()
+        for j in range(0, min(prefetch, n)):
+            queue.append(pool.submit(readY, Y_files[j], maskFiles[j], M_t, inds))
+
+        for i in range(0, n):
+
+            # Wait for the current volume
+            t1 = time.time()
+            d = queue.popleft().result()
+            t2 = time.time()
+            times['wait'] += t2 - t1
+
+            # Queue the next volume
+            j = i + prefetch
+            if j < n:
+                queue.append(pool.submit(readY, Y_files[j], maskFiles[j], M_t, inds))
+
+            yield i, d
+            times['compute'] += time.time() - t2
+
+
+# ============================================================================
+#
+# The below function is the counterpart of `prefetchY` for observations which
+# have been imported into an input store (see `blmm_import.py`). The voxels
+# are read straight from the memory mapped blocks of the store, so no NIFTIs
+# are opened or decompressed, and blocks which hold none of the requested
+# voxels are not read at all. For observation-major stores the observations
+# are read one at a time, whereas for voxel-major stores all of the
+# observations of interest are read from each block at once (so that the
+# observations of each voxel are read as one contiguous run). Voxels which
+# are requested but are not in the store had no data for any observation
+# when it was made, and are set to zero.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `store`: The input store (see `loadYStore`), with `store['rows']`
+#             optionally set to a range of the observations of interest.
+#  - `times`: A dictionary with fields `wait` and `compute`, which timings
+#             are added to.
+#  - `inds`: Optional flattened voxel indices. If given, only these voxels
+#            are returned, otherwise every voxel is.
+#
+# ----------------------------------------------------------------------------
+#
+# This function yields:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `i`: The index of the observation in `store['rows']`.
+#  - `d`: The voxels of the observation, as a 1D numpy array.
+#
+# ============================================================================
+def storeY(store, times, inds=None):
+
+    # The voxels in the store
+    voxels = store['voxels']
+
+    if inds is None:
+        inds = np.arange(np.prod(store['dim']))
+
+    # The observations of interest
+    if 'rows' in store:
+        rows = store['rows']
+    else:
+        rows = range(0, store['n'])
+
+    # Work out where each requested voxel is in the store
+    if np.array_equal(inds, voxels):
+
+        # Every voxel in the store is used, in order
+        cols = np.arange(len(voxels))
+        found = cols
+
+    else:
+
+        cols = np.minimum(np.searchsorted(voxels, inds), len(voxels)-1)
+        found = voxels[cols]==inds
+
+        # If the store was made with an analysis mask, we know nothing about
+        # the voxels outside of it
+        if store['analysis_mask'] is not None and not np.all(found):
+            raise ValueError('The analysis mask includes voxels which are not in the input store "' +
+                             store['dir'] + '" (which was made with the analysis mask "' +
+                             store['analysis_mask'] + '")')
+
+        cols = cols[found]
+        found = np.flatnonzero(found)
+
+    # Work out which voxels are read from each block, and where they go
+    blocks = []
+    for k in range(len(store['Y'])):
+
+        # The requested voxels in this block (`cols` is sorted)
+        nvox = store['Y'][k].shape[store['layout']=='observation']
+        first, last = np.searchsorted(cols, [store['starts'][k], store['starts'][k]+nvox])
+        if last > first:
+
+            # Whole blocks are sliced rather than indexed
+            blockCols = cols[first:last] - store['starts'][k]
+            if len(blockCols) == nvox:
+                blockCols = slice(None)
+
+            # The positions of the voxels in `inds`
+            blocks.append((store['Y'][k], blockCols, found[first:last]))
+
+    # The number of observations read at once
+    if store['layout'] == 'voxel':
+        group = max(len(rows), 1)
+    else:
+        group = 1
+
+    for g in range(0, len(rows), group):
+
+        t1 = time.time()
+        Yg = np.zeros((min(group, len(rows)-g), len(inds)))
+        for Y, blockCols, pos in blocks:
+
+            if store['layout'] == 'voxel':
+                Yg[:, pos] = Y[blockCols, rows[g]:(rows[g]+Yg.shape[0])].transpose()
+            else:
+                Yg[:, pos] = Y[rows[g]:(rows[g]+Yg.shape[0]), blockCols]
+        t2 = time.time()
+        times['wait'] += t2 - t1
+
+        for i in range(Yg.shape[0]):
+
+            yield g+i, Yg[i]
+
+        times['compute'] += time.time() - t2
+
+
+# ============================================================================
+#
+# The below function prints the time spent waiting on input volumes versus
+# the time spent computing, as recorded by `prefetchY`.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `times`: A dictionary with fields `wait` and `compute`.
+#
+# ============================================================================
+def printTimes(times):
+
+    print('Input I/O wait: ' + '{:.2f}'.format(times['wait']) + 's, compute: ' + '{:.2f}'.format(times['compute']) + 's')
+
+
+# ============================================================================
+#
+# The below function takes in the (n by v) array M (essentially the array
+# Y!=0) and returns the unique columns of M alongside an id for each voxel
+# telling us which of the unique columns it had. The ids start from 1 and are
+# ordered by first appearance. To do so cheaply for large numbers of voxels,
+# each column of M is packed into bits and the resulting keys are sorted.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `M`: The (n by v) boolean array Y!=0.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `M_unique`: The unique columns of M, in order of first appearance.
+#  - `unique_id`: A vector of length v, giving the (1-indexed) column of
+#                 `M_unique` that each voxel had.
+#
+# ============================================================================
+def uniqueMasks(M):
+
+    # Work out dimensions
+    n = M.shape[0]
+    v = M.shape[1]
+
+    # Pack the column of M for each voxel into bits. We pad to a whole 
+    # number of 64-bit words per voxel.
+    nwords = max((n+63)//64, 1)
+    packed = np.zeros([v, nwords*8], dtype=np.uint8)
+    packed[:,:((n+7)//8)] = np.packbits(M, axis=0).transpose()
+
+    # Each voxel's words now form a key, which is the same for two voxels if
+    # and only if they have the same column of M
+    if nwords == 1:
+        keys = packed.view(np.uint64).reshape(v)
+    else:
+        keys = packed.view(np.dtype((np.void, nwords*8))).reshape(v)
+
+    # Sort the keys to get the unique columns, the first voxel with each 
+    # unique column and the unique column each voxel had
+    _, idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # Reorder the unique columns by first appearance
+    order = np.argsort(idx)
+    rank = np.zeros(len(idx), dtype=np.int64)
+    rank[order] = np.arange(len(idx))
+    unique_id = rank[inverse.reshape(v)] + 1
+
+    # Get the unique columns of M
+    M_unique = M[:,idx[order]]
+
+    return M_unique, unique_id
+
 # ============================================================================
 #
 # Given two 3D numpy arrays, A and B, of shape (1, k1, k2) and (v, k1, k3)
@@ -570,20 +1379,30 @@ def obtainY(Y_files, M_files, M_t, M_a):
 # This function is designed with the use case of the product matrices X'Y and
 # Z'Y in mind.
 #
+# Each batch writes its own partial product "shard" for each voxel batch, 
+# named `<prodStr><voxBatch>_b<batchNo>.npy`, so that batch jobs never have
+# to wait on one another. The shards are summed across batches by the concat
+# stage (see `blmm_concat.reduceProducts`). Shards are written under a
+# temporary name and renamed once complete, so that a crashed job never
+# leaves behind a partially written shard.
+#
 # ----------------------------------------------------------------------------
 #
 # This function takes in the following inputs:
 #
 # ----------------------------------------------------------------------------
 #
-# - `A`: The (1, k1, k2) shaped matrix.
+# - `A`: The (1, k1, k2) shaped matrix. If `A` is set to None, `B` is assumed
+#        to already be the product matrix A'B, of shape (v, k2). `A` may
+#        also be given as a (k1, k2) shaped sparse matrix.
 # - `B`: The (v, k1, k3) shaped matrix.
 # - `MAXMEM`: The maximum memory allowed for usage, in bytes.
 # - `prodStr`: String representing product matrix i.e. "ZtY", "XtY",... etc.
 # - `inputs`: The inputs structure.
+# - `batchNo`: The number of the batch of observations the product is for.
 #
 # ============================================================================
-def memorySafeAtB(A,B,MAXMEM,prodStr,inputs):
+def memorySafeAtB(A,B,MAXMEM,prodStr,inputs,batchNo):
 
     # Obtain number of voxel batches for parallelization.
     pnvb = pracNumVoxelBlocks(inputs)
@@ -593,13 +1412,18 @@ def memorySafeAtB(A,B,MAXMEM,prodStr,inputs):
 
     # Record v and k3 (which is usually p or q)
     v = B.shape[0]
-    pORq = A.shape[2]
+    if A is None:
+        pORq = B.shape[1]
+    elif scipy.sparse.issparse(A):
+        pORq = A.shape[1]
+    else:
+        pORq = A.shape[2]
 
     # Loop through voxel batches (groups of voxels we wish to partition into)
     for voxBatch in range(int(pnvb)):
 
         # Get filename
-        filename = os.path.join(OutDir,"tmp",prodStr + str(voxBatch) + ".npy")
+        filename = os.path.join(OutDir,"tmp",prodStr + str(voxBatch) + "_b" + str(batchNo) + ".npy")
 
         # Get indices for this batch of voxels
         batch_inds = np.array_split(np.arange(v), pnvb)[voxBatch]
@@ -607,75 +1431,70 @@ def memorySafeAtB(A,B,MAXMEM,prodStr,inputs):
         # Number of voxels in this batch
         batch_v = len(batch_inds)
 
-        # Check if file is in use
-        fileLocked = True
-        while fileLocked:
-            try:
-                # Create lock file, so other jobs know we are writing to this file
-                f = os.open(filename + ".lock", os.O_CREAT|os.O_EXCL|os.O_RDWR)
-                fileLocked = False
-            except FileExistsError:
-                fileLocked = True
-
-        # If the memory map doesn't exist already, create it
-        if not os.path.isfile(filename):
-
-            # Create a memory-mapped .npy file with the dimensions and dtype we want
-            M = open_memmap(filename, mode='w+', dtype='float64', shape=(batch_v,pORq))
-
-            # Work out the number of voxels we can save at a time.
-            # (8 bytes per numpy float exponent multiplied by 10
-            # for a safe overhead). Here we are using batch to describe
-            # the number of voxels we want to save to each file and block
-            # to describe the number of voxels we can actually save to a file
-            # at any one given time.
-            vPerBlock = MAXMEM/(10*8*pORq)
-
-            # Work out the indices for each group of voxels for original matrix and
-            # for in file
-            voxelGroups_orig = np.array_split(batch_inds, batch_v//vPerBlock+1) # Indices from original matrix
-            voxelGroups_file = np.array_split(np.arange(batch_v), batch_v//vPerBlock+1) # Indices we write to in file
-
-            # Loop through each group of voxels saving A'B for those voxels
-            for vb in range(int(batch_v//vPerBlock+1)):
-
-                if A.shape[0]==1:
-                    M[voxelGroups_file[vb],:]=(A.transpose(0,2,1) @ B[voxelGroups_orig[vb],:,:]).reshape(len(voxelGroups_orig[vb]),pORq)
-                else:
-                    M[voxelGroups_file[vb],:]=(A.transpose(0,2,1)[voxelGroups_orig[vb],:,:] @ B[voxelGroups_orig[vb],:,:]).reshape(len(voxelGroups_orig[vb]),pORq)
-                
-
-        # Otherwise we add to the memory map that does exist
-        else:
+        # Create a memory-mapped .npy file with the dimensions and dtype we want
+        M = open_memmap(filename + ".part", mode='w+', dtype='float64', shape=(batch_v,pORq))
+
+        # Work out the number of voxels we can save at a time.
+        # (8 bytes per numpy float exponent multiplied by 10
+        # for a safe overhead). Here we are using batch to describe
+        # the number of voxels we want to save to each file and block
+        # to describe the number of voxels we can actually save to a file
+        # at any one given time.
+        vPerBlock = MAXMEM/(10*8*pORq)
+
+        # Work out the indices for each group of voxels for original matrix and
+        # for in file
+        voxelGroups_orig = np.array_split(batch_inds, batch_v//vPerBlock+1) # Indices from original matrix
+        voxelGroups_file = np.array_split(np.arange(batch_v), batch_v//vPerBlock+1) # Indices we write to in file
+
+        # Loop through each group of voxels saving A'B for those voxels
+        for vb in range(int(batch_v//vPerBlock+1)):
+
+            M[voxelGroups_file[vb],:]=blockAtB(A,B,voxelGroups_orig[vb])
 
-            # Load in the file but in memory map mode
-            M = np.load(filename,mmap_mode='r+')
-            M = M.reshape((batch_v,pORq))
-
-            # Work out the number of voxels we can save at a time.
-            # (8 bytes per numpy float exponent multiplied by 10
-            # for a safe overhead)
-            vPerBlock = MAXMEM/(10*8*pORq)
-
-            # Work out the indices for each group of voxels for original matrix and
-            # for in file
-            voxelGroups_orig = np.array_split(batch_inds, batch_v//vPerBlock+1) # Indices from original matrix
-            voxelGroups_file = np.array_split(np.arange(batch_v), batch_v//vPerBlock+1) # Indices we write to in file
-            
-            # Loop through each group of voxels saving A'B for those voxels
-            for vb in range(int(batch_v//vPerBlock+1)):
-                if A.shape[0]==1:
-                    M[voxelGroups_file[vb],:]=M[voxelGroups_file[vb],:]+(A.transpose(0,2,1) @ B[voxelGroups_orig[vb],:,:]).reshape(len(voxelGroups_orig[vb]),pORq)
-                else:
-                    M[voxelGroups_file[vb],:]=M[voxelGroups_file[vb],:]+(A.transpose(0,2,1)[voxelGroups_orig[vb],:,:] @ B[voxelGroups_orig[vb],:,:]).reshape(len(voxelGroups_orig[vb]),pORq)
-                
         # Delete M from memory (important!)
+        M.flush()
         del M
 
-        # Delete lock file, so other jobs know they can now write to the
-        # file
-        os.remove(filename + ".lock")
-        os.close(f)
+        # The shard is complete
+        os.replace(filename + ".part", filename)
+
+# ============================================================================
+#
+# The below function returns the product A'B (as computed by `memorySafeAtB`)
+# for a subset of voxels, reshaped to (number of voxels, k2).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `A`: The (1, k1, k2) or (v, k1, k2) shaped matrix, the (k1, k2) shaped
+#        sparse matrix, or None if `B` is already the product A'B.
+# - `B`: The (v, k1, k3) shaped matrix (or (v, k2) shaped product A'B if `A`
+#        is None).
+# - `inds`: The indices of the voxels of interest.
+#
+# ============================================================================
+def blockAtB(A,B,inds):
+
+    # B is already the product matrix
+    if A is None:
+        return(B[inds,:])
+
+    # A is a sparse matrix, shared by all voxels
+    if scipy.sparse.issparse(A):
+        return((A.transpose() @ B[inds,:,0].transpose()).transpose())
+
+    # Work out k2 (which is usually p or q)
+    pORq = A.shape[2]
+
+    if A.shape[0]==1:
+        return((A.transpose(0,2,1) @ B[inds,:,:]).reshape(len(inds),pORq))
+    else:
+        return((A.transpose(0,2,1)[inds,:,:] @ B[inds,:,:]).reshape(len(inds),pORq))
+
 
 if __name__ == "__main__":
     main()
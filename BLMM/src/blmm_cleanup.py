@@ -10,12 +10,16 @@ import glob
 import shutil
 import yaml
 import time
+from concurrent.futures import ThreadPoolExecutor
 np.set_printoptions(threshold=np.nan)
+from BLMM.lib.fileio import getRunContext
 
 # ====================================================================================
 #
-# This file is the cleanup stage of the BLMM pipeline. It simply deletes any remaining
-# files that are no longer needed.
+# This file is the cleanup stage of the BLMM pipeline. It assembles the output NIFTI
+# images from the compact "shards" written by each results job (see
+# `addBlockToShard` in `fileio.py`) and then deletes any remaining files that are no
+# longer needed.
 #
 # ------------------------------------------------------------------------------------
 #
@@ -43,6 +47,11 @@ def main(ipath):
     # --------------------------------------------------------------------------------
     OutDir = inputs['outdir']
 
+    # --------------------------------------------------------------------------------
+    # Assemble the output NIFTIs
+    # --------------------------------------------------------------------------------
+    assembleShards(inputs, getRunContext(inputs))
+
     # --------------------------------------------------------------------------------
     # Clean up files
     # --------------------------------------------------------------------------------
@@ -69,4 +78,168 @@ def main(ipath):
     print('')
     print('---------------------------------------------------------------------------')
     print('')
-    print('Check results in: ', OutDir)
\ No newline at end of file
+    print('Check results in: ', OutDir)
+
+
+# ============================================================================
+#
+# The below function assembles every output NIFTI which the results jobs have
+# written shards for. Only the shards listed in the manifests of the results
+# jobs of this run (see `flushOutputSink` in `fileio.py`) are used, so any 
+# shards left behind by an earlier run are never assembled, and every shard
+# listed must exist. The NIFTIs are assembled in parallel, each being written
+# to disk only once, using as many threads as there are cores, or as many 
+# NIFTIs as fit in the memory limit (`MAXMEM`), whichever is fewer.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `inputs`: The inputs dictionary read from a blmm inputs cfg file.
+#  - `context`: The run context (see `buildRunContext` in `fileio.py`).
+#
+# ============================================================================
+def assembleShards(inputs, context):
+
+    # Output directory
+    OutDir = inputs['outdir']
+
+    # Check if the maximum memory is saved.    
+    if 'MAXMEM' in inputs:
+        MAXMEM = eval(inputs['MAXMEM'])
+    else:
+        MAXMEM = 2**32
+
+    # The voxel batches the results jobs were run for
+    if 'voxelBatching' in inputs and inputs['voxelBatching']:
+        with open(os.path.join(OutDir, 'nvb.txt')) as f:
+            vbs = range(1, int(f.readline())+1)
+    else:
+        vbs = [-1]
+
+    # Read the shards written by each results job, checking they are there
+    shards = dict()
+    for vb in vbs:
+
+        manifest = os.path.join(OutDir,"tmp","blmm_shards_vb" + str(vb) + ".txt")
+        if not os.path.isfile(manifest):
+            raise ValueError('The results job for voxel batch ' + str(vb) + ' did not complete ("' + manifest + '" is missing)')
+
+        with open(manifest) as f:
+            for line in f.readlines():
+
+                shard = line.replace('\n', '')
+                if not os.path.isfile(shard):
+                    raise ValueError('The output shard "' + shard + '" is missing')
+
+                # Group the shards by the NIFTI they are for
+                shardDir = os.path.dirname(shard)
+                shards[shardDir] = shards.get(shardDir, set()) | {shard}
+
+    if not shards:
+        return
+
+    t1 = time.time()
+
+    # The NIFTIs we have shards for, in order
+    shardDirs = sorted(shards)
+
+    # Each NIFTI is held in memory (as float64), alongside a copy whilst it
+    # is saved
+    niftiMem = 0
+    for shardDir in shardDirs:
+        dim = np.load(os.path.join(shardDir, 'dim.npy'))
+        niftiMem = max(niftiMem, 2*8*int(np.prod(dim)))
+
+    # Number of threads to use
+    nthreads = max(1, min(os.cpu_count(), len(shardDirs), MAXMEM//niftiMem))
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+
+        # Assemble each NIFTI (and raise any errors)
+        nshards = list(pool.map(lambda shardDir: assembleNifti(OutDir, shardDir, sorted(shards[shardDir]), context), shardDirs))
+
+    t2 = time.time()
+
+    # Report timings
+    print('Assembled ' + str(len(shardDirs)) + ' output images from ' + str(sum(nshards)) +
+          ' shards, using ' + str(nthreads) + ' thread(s), in ' + '{:.2f}'.format(t2-t1) + 's')
+
+
+# ============================================================================
+#
+# The below function assembles one output NIFTI from its shards. If the NIFTI
+# already exists (e.g. the mask, which is made during concatenation, or the
+# outputs of a previous run in `diskMem` mode) the shards are written on top
+# of it.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `OutDir`: The output directory.
+#  - `shardDir`: The directory holding the shards for the NIFTI.
+#  - `shards`: The shards to assemble, in the order they should be applied.
+#  - `context`: The run context (see `buildRunContext` in `fileio.py`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `nshards`: The number of shards read.
+#
+# ============================================================================
+def assembleNifti(OutDir, shardDir, shards, context):
+
+    # The NIFTI we are assembling
+    fname = os.path.join(OutDir, os.path.basename(shardDir) + '.nii')
+
+    # Work out the dimensions of the NIFTI
+    dim = tuple(np.load(os.path.join(shardDir, 'dim.npy')))
+    n_vox = int(np.prod(dim[:3]))
+    if len(dim)==3:
+        n_vol = 1
+    else:
+        n_vol = int(dim[3])
+
+    # Start from the existing NIFTI, if there is one
+    if os.path.isfile(fname):
+        data = nib.load(fname).get_fdata()
+        shape = data.shape
+        data = data.reshape([n_vox, n_vol])
+    else:
+        shape = (int(dim[0]),int(dim[1]),int(dim[2]),n_vol)
+        data = np.zeros([n_vox, n_vol])
+
+    # Add each shard
+    for shard in shards:
+
+        # Volume the shard is for
+        volStr = os.path.basename(shard).split('_')[0]
+
+        # Voxel indices and values
+        shardData = np.load(shard)
+        inds = shardData[:,0].astype(np.int64)
+
+        if volStr == 'all':
+            data[inds,:] = shardData[:,1:]
+        else:
+            data[inds,int(volStr)] = shardData[:,1]
+
+    # Store floating point data, even if the input images do not
+    hdr = context['header']
+    if hdr.get_data_dtype().kind != 'f':
+        hdr = hdr.copy()
+        hdr.set_data_dtype(np.float64)
+
+    # Save the NIFTI
+    nifti = nib.Nifti1Image(data.reshape(shape), context['affine'], header=hdr)
+    nib.save(nifti, fname)
+
+    return(len(shards))
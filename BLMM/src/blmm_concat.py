@@ -7,9 +7,10 @@ from numpy.lib.format import open_memmap
 import nibabel as nib
 import sys
 import os
-import glob
 import shutil
 import yaml
+import time
+from concurrent.futures import ThreadPoolExecutor
 np.set_printoptions(threshold=np.nan)
 from BLMM.lib.npMatrix3d import *
 from BLMM.lib.npMatrix2d import *
@@ -21,13 +22,17 @@ import BLMM.src.blmm_estimate as blmm_estimate
 #
 # This file is the third stage of the BLMM pipeline. This stage calculates n_sv for
 # the whole model and the overall mask. This file used to contain concatenation of the
-# product matrices. However, for X'Y, Z'Y and Y'Y this now happens in the batch stage.
+# product matrices. However, for X'Y, Z'Y and Y'Y each batch now writes its own
+# partial products ("shards") and this stage only sums the shards across batches (see
+# `reduceProducts`).
 #
-# Currently, the product matrices Z'Z, Z'X and X'X are not concatenated as we have
-# only recorded the unique instances of these matrices during the batch stage,
-# instead of an instance for each voxel and concatenating these turns out to be both
-# less memory efficient and less time efficient than leaving them in their current
-# form.
+# The product matrices Z'Z, Z'X and X'X are not concatenated as we have only
+# recorded the unique instances of these matrices during the batch stage, instead of
+# an instance for each voxel and concatenating these turns out to be both less memory
+# efficient and less time efficient than leaving them in their current form. Instead,
+# we work out which combination of batch designs each voxel had and sum the unique
+# instances for each combination, once, so that the results stage need only look up
+# the product matrices for each voxel (see `globalUniqueMasks` and `sumUniqueAtB`).
 #
 # ------------------------------------------------------------------------------------
 #
@@ -80,56 +85,44 @@ def main(ipath):
     # --------------------------------------------------------------------------------
     OutDir = inputs['outdir']
 
-    # Random factor variables.
-    rfxmats = inputs['Z']
+    # Metadata shared by every stage of the pipeline (worked out once, during
+    # setup)
+    context = getRunContext(inputs)
 
     # Number of random effects
-    r = len(rfxmats)
+    r = len(inputs['Z'])
 
-    # Number of random effects for each factor, q
-    nraneffs = []
-
-    # Number of levels for each factor, l
-    nlevels = []
-
-    for k in range(r):
-
-        rfxdes = loadFile(rfxmats[k]['f' + str(k+1)]['design'])
-        rfxfac = loadFile(rfxmats[k]['f' + str(k+1)]['factor'])
-
-        nraneffs = nraneffs + [rfxdes.shape[1]]
-        nlevels = nlevels + [len(np.unique(rfxfac))]
+    # Number of random effects and levels for each factor
+    nraneffs = context['nraneffs']
+    nlevels = context['nlevels']
 
     # Get number of random effects
-    nraneffs = np.array(nraneffs)
-    nlevels = np.array(nlevels)
-    q = np.sum(nraneffs*nlevels)
+    q = context['q']
 
     # Get number of unique random effects
     q_u = np.sum(nraneffs*(nraneffs+1)//2)
     
-    # Get number of parameters
-    L1 = str2vec(inputs['contrasts'][0]['c' + str(1)]['vector'])
-    L1 = np.array(L1)
-    p = L1.shape[0]
-    del L1, rfxdes, rfxfac
+    # Get number of fixed effects parameters
+    p = context['p']
     
-    # Read in the nifti size and work out number of voxels.
-    with open(inputs['Y_files']) as a:
-        nifti_path = a.readline().replace('\n', '')
-        nifti = loadFile(nifti_path)
-
-    NIFTIsize = nifti.shape
+    # Work out number of voxels.
+    NIFTIsize = context['dim']
     v = int(np.prod(NIFTIsize))
 
+    # Work out number of batchs
+    with open(os.path.join(OutDir,'nb.txt')) as f:
+        n_b = int(f.readline())
+
+    # --------------------------------------------------------------------------------
+    # Sum the partial X'Y, Z'Y and Y'Y products output by each batch
+    # --------------------------------------------------------------------------------
+    reduceProducts(OutDir, pracNumVoxelBlocks(inputs), n_b, MAXMEM)
+
     # --------------------------------------------------------------------------------
     # Get n (number of observations) and n_sv (spatially varying number of
     # observations)
     # --------------------------------------------------------------------------------
 
-    # Work out number of batchs
-    n_b = len(glob.glob(os.path.join(OutDir,"tmp","blmm_vox_n_batch*")))
-
     # Read in n (spatially varying)
     nmapb  = loadFile(os.path.join(OutDir,"tmp", "blmm_vox_n_batch1.nii"))
     n_sv = nmapb.get_data()# Read in uniqueness Mask file
@@ -149,15 +142,14 @@ def main(ipath):
         
     # Save nmap
     nmap = nib.Nifti1Image(n_sv,
-                           nifti.affine,
-                           header=nifti.header)
+                           context['affine'],
+                           header=context['header'])
     nib.save(nmap, os.path.join(OutDir,'blmm_vox_n.nii'))
     n_sv = n_sv.reshape(v, 1)
     del nmap
 
     # Get ns.
-    X = loadFile(inputs['X'])
-    n = X.shape[0]
+    n = context['n']
 
     # --------------------------------------------------------------------------------
     # Create Mask
@@ -218,22 +210,9 @@ def main(ipath):
     # small percentage of voxels.
     Mask[n_sv<=p+1]=0
 
-    if 'analysis_mask' in inputs:
-
-        amask_path = inputs["analysis_mask"]
-        
-        # Read in the mask nifti.
-        amask = loadFile(amask_path).get_data().reshape([v,1])
-
-    else:
-
-        # By default make amask ones
-        amask = np.ones([v,1])
-
-
     # Get indices for whole analysis mask. These indices are the indices we
     # have recorded for the product matrices with respect to the entire volume
-    amInds = get_amInds(amask)
+    amInds = context['amInds']
         
     # Ensure overall mask matches analysis mask
     Mask[~np.in1d(np.arange(v).reshape(v,1), amInds)]=0
@@ -244,11 +223,25 @@ def main(ipath):
                                     NIFTIsize[1],
                                     NIFTIsize[2]
                                     ),
-                              nifti.affine,
-                              header=nifti.header) 
+                              context['affine'],
+                              header=context['header']) 
     nib.save(maskmap, os.path.join(OutDir,'blmm_vox_mask.nii'))
     del maskmap
 
+    # ------------------------------------------------------------------------
+    # Combine the unique X'X, Z'X and Z'Z from each batch
+    # ------------------------------------------------------------------------
+
+    # Work out which voxels had which combination of batch designs
+    uniqueM, batchIds = globalUniqueMasks(OutDir, n_b, np.where(Mask==1)[0], v)
+    np.save(os.path.join(OutDir,"tmp","uniqueM.npy"), uniqueM)
+    del uniqueM
+
+    # Sum the batch product matrices for each combination
+    for AtBstr in ['XtX', 'ZtX', 'ZtZ']:
+        sumUniqueAtB(AtBstr, OutDir, batchIds, MAXMEM)
+    del batchIds
+
     # ------------------------------------------------------------------------
     # Work out "Ring" and "Inner" indices
     # ------------------------------------------------------------------------
@@ -303,13 +296,291 @@ def main(ipath):
 
     # Save beta map.
     dfmap = nib.Nifti1Image(df,
-                            nifti.affine,
-                            header=nifti.header) 
+                            context['affine'],
+                            header=context['header']) 
     nib.save(dfmap, os.path.join(OutDir,'blmm_vox_edf.nii'))
     del df, dfmap
 
     w.resetwarnings()
 
 
+# ============================================================================
+#
+# During the batch stage, each batch records the unique X'X, Z'X and Z'Z
+# designs it saw alongside a map telling us which voxel had which of these
+# designs (see `blmm_batch.py`). The below function combines these maps into
+# a single "global" map, telling us which combination of batch designs each
+# voxel had. The combinations are built up one batch at a time, so that only
+# one batch map need be held in memory at once.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `OutDir`: The output directory.
+#  - `n_b`: The number of batches run during the batch stage.
+#  - `inds`: The (flattened) indices of the voxels we are interested in (i.e.
+#            the voxels in the mask).
+#  - `v`: The number of voxels in the volume.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `uniqueM`: A vector of length v, giving the (1-indexed) combination of
+#               batch designs each voxel in `inds` had. Voxels not in `inds`
+#               are given the value 0.
+#  - `batchIds`: An (n_b by number of combinations) array. The (k,m)^th
+#                element is the (1-indexed) unique design the (k+1)^th batch
+#                recorded for the (m+1)^th combination (or 0 if the batch had
+#                no data for these voxels).
+#
+# ============================================================================
+def globalUniqueMasks(OutDir, n_b, inds, v):
+
+    # Before looking at any batch, all voxels have the same combination
+    ids = np.zeros(len(inds), dtype=np.int64)
+    batchIds = np.zeros([0, 1], dtype=np.int64)
+
+    for batchNo in range(1, n_b+1):
+
+        # Read in uniqueness Mask file
+        uniquenessMask = loadFile(os.path.join(OutDir,"tmp", 
+            "blmm_vox_uniqueM_batch" + str(batchNo) + ".nii")).get_data()
+        uniquenessMask = np.int64(uniquenessMask.reshape(v)[inds])
+
+        # Every pair of (previous combination, batch design) is given a 
+        # unique key
+        keys = ids*(np.amax(uniquenessMask, initial=0)+1) + uniquenessMask
+
+        # Work out the new combinations
+        _, first, newIds = np.unique(keys, return_index=True, return_inverse=True)
+
+        # Record the batch designs for each new combination
+        batchIds = np.vstack((batchIds[:, ids[first]], uniquenessMask[first]))
+        ids = newIds.reshape(len(inds))
+
+    # Make the global uniqueness map
+    uniqueM = np.zeros(v, dtype=np.int64)
+    uniqueM[inds] = ids + 1
+
+    return(uniqueM, batchIds)
+
+
+# ============================================================================
+#
+# The below function sums the unique product matrices A'B from each batch,
+# for each combination of batch designs found by `globalUniqueMasks`, giving
+# the unique product matrices for the entire analysis. These are saved as 
+# `<AtBstr>.npy`, the (m+1)^th row of which is the product matrix for voxels
+# with global uniqueness map value m+1.
+#
+# Note: This function is only designed for the product matrices; Z'X, Z'Z and
+# X'X.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `AtBstr`: A string representing which product matrix we are looking at. 
+#              i.e. "XtX" for X'X, "ZtX" for Z'X and "ZtZ" for Z'Z.
+#  - `OutDir`: The output directory.
+#  - `batchIds`: The batch designs for each combination (as output by
+#                `globalUniqueMasks`).
+#  - `MAXMEM`: The maximum memory allowed for usage, in bytes.
+#
+# ============================================================================
+def sumUniqueAtB(AtBstr, OutDir, batchIds, MAXMEM):
+
+    # Number of batches and combinations
+    n_b = batchIds.shape[0]
+    n_c = batchIds.shape[1]
+
+    # Work out the size of the (flattened) product matrix
+    AtB_batch_unique = np.load(os.path.join(OutDir,"tmp",AtBstr + "1.npy"), mmap_mode='r')
+    k = AtB_batch_unique.shape[1]
+    del AtB_batch_unique
+
+    # Create a memory-mapped .npy file for the output
+    AtB = open_memmap(os.path.join(OutDir,"tmp",AtBstr + ".npy"), mode='w+', 
+                      dtype='float64', shape=(n_c,k))
+
+    # Work out the number of combinations we can sum at a time (8 bytes per
+    # numpy float, multiplied by 10 for a safe overhead)
+    cPerBlock = int(max(MAXMEM/(10*8*k), 1))
+
+    # Cycle through batches and add together results.
+    for batchNo in range(1, n_b+1):
+
+        # Read in the unique product matrices for this batch
+        AtB_batch_unique = np.load(os.path.join(OutDir,"tmp",AtBstr + str(batchNo) + ".npy"), mmap_mode='r')
+
+        for i in range(0, n_c, cPerBlock):
+
+            # The batch design for each of these combinations
+            ids = batchIds[batchNo-1, i:(i+cPerBlock)]
+            present = np.where(ids > 0)[0]
+
+            # Add to running total
+            AtB[i + present,:] += AtB_batch_unique[ids[present]-1,:]
+
+        del AtB_batch_unique
+
+    # Delete the memory map (important!)
+    AtB.flush()
+    del AtB
+
+
+# ============================================================================
+#
+# The below function sums the partial product "shards" output by each batch
+# (see `blmm_batch.memorySafeAtB`) to give the product matrices X'Y, Z'Y and
+# Y'Y for each voxel batch. The shards are summed in a tree; at each level,
+# shards are added together in pairs, in parallel, halving the number of
+# shards remaining, until one remains for each product and voxel batch. This
+# shard is then renamed to `<prodStr><voxBatch>.npy`. The time taken to add
+# each shard is recorded and summarised. An error is raised if any batch did
+# not output its shards (e.g. because it crashed), as the products would
+# otherwise be silently incomplete.
+#
+# The shards are added using as many threads as there are CPUs available to
+# this job, and `MAXMEM` is shared between the threads.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `OutDir`: The output directory.
+#  - `pnvb`: The number of voxel batches.
+#  - `n_b`: The number of batches run during the batch stage.
+#  - `MAXMEM`: The maximum memory allowed for usage, in bytes.
+#
+# ============================================================================
+def reduceProducts(OutDir, pnvb, n_b, MAXMEM):
+
+    # Get the shards for each product and voxel batch
+    shards = {}
+    missing = []
+    for prodStr in ['XtY', 'ZtY', 'YtY']:
+        for voxBatch in range(int(pnvb)):
+
+            # The file we are reducing the shards into
+            filename = os.path.join(OutDir,"tmp",prodStr + str(voxBatch) + ".npy")
+
+            # The shards from each batch
+            shards[filename] = [os.path.join(OutDir,"tmp",prodStr + str(voxBatch) + "_b" + str(batchNo) + ".npy")
+                                for batchNo in range(1, n_b+1)]
+            missing = missing + [shard for shard in shards[filename] if not os.path.exists(shard)]
+
+    # Every batch must have output every shard
+    if missing:
+        raise ValueError('The product shards ' + ', '.join(os.path.basename(shard) for shard in missing) + 
+                         ' are missing; the batch jobs which output them must be rerun')
+
+    # Record time taken for each shard
+    times = []
+
+    t1 = time.time()
+
+    # Number of threads to use (only the CPUs this job may run on are used,
+    # and there is no point having more threads than pairs of shards)
+    if hasattr(os, 'sched_getaffinity'):
+        ncpus = len(os.sched_getaffinity(0))
+    else:
+        ncpus = os.cpu_count()
+    nthreads = max(1, min(ncpus, len(shards)*(n_b//2)))
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+
+        # Sum the shards in pairs until one remains for each file
+        while any(len(s) > 1 for s in shards.values()):
+
+            futures = []
+            for filename in shards:
+
+                # Add each odd shard to the shard before it
+                s = shards[filename]
+                for i in range(1, len(s), 2):
+                    futures.append(pool.submit(addShards, s[i-1], s[i], MAXMEM//nthreads))
+
+                # Only the even shards remain
+                shards[filename] = s[::2]
+
+            # Wait for this level of the tree to be complete
+            times = times + [f.result() for f in futures]
+
+    # Rename the remaining shards
+    for filename in shards:
+        if shards[filename]:
+            os.replace(shards[filename][0], filename)
+
+    t2 = time.time()
+
+    # Report timings
+    if times:
+        print('Reduced ' + str(len(times)) + ' product shards in ' + '{:.2f}'.format(t2-t1) +
+              's (per shard: mean ' + '{:.3f}'.format(np.mean(times)) + 's, max ' +
+              '{:.3f}'.format(np.max(times)) + 's)')
+
+
+# ============================================================================
+#
+# The below function adds one product "shard" to another, in place, in
+# managable chunks, and then deletes the shard which was added.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `fname1`: The shard which is added to.
+#  - `fname2`: The shard which is added (and then deleted).
+#  - `MAXMEM`: The maximum memory allowed for usage by this addition, in
+#              bytes.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `t`: The time taken (in seconds).
+#
+# ============================================================================
+def addShards(fname1, fname2, MAXMEM):
+
+    t1 = time.time()
+
+    # Load in both shards in memory map mode
+    S1 = np.load(fname1, mmap_mode='r+')
+    S2 = np.load(fname2, mmap_mode='r')
+
+    # Work out the number of voxels we can add at a time (8 bytes per numpy
+    # float, multiplied by 10 for a safe overhead)
+    vPerBlock = int(max(MAXMEM/(10*8*S1.shape[1]), 1))
+
+    # Add the shards
+    for i in range(0, S1.shape[0], vPerBlock):
+        S1[i:(i+vPerBlock),:] += S2[i:(i+vPerBlock),:]
+
+    # Delete the memory maps (important!)
+    S1.flush()
+    del S1, S2
+
+    # Remove the shard we just added
+    os.remove(fname2)
+
+    return(time.time()-t1)
+
+
 if __name__ == "__main__":
     main()
@@ -58,6 +58,9 @@ from BLMM.lib.est3d import *
 #  - `nraneffs`: A vector containing the number of random effects for each
 #                factor, e.g. `nraneffs=[2,1]` would mean the first factor has
 #                random effects and the second factor has 1 random effect.
+#  - `returnState` (optional): If true, the quantities computed by the estimation
+#                              method at the final estimates, which inference
+#                              needs, are returned as well (see `pSFS3D`).
 #
 # ------------------------------------------------------------------------------------
 #
@@ -68,19 +71,20 @@ from BLMM.lib.est3d import *
 # - `beta`: The fixed effects parameter estimates for each voxel.
 # - `sigma2`: The fixed effects variance estimate for each voxel.
 # - `D`: The random effects covariance matrix estimate for each voxel.
+# - `state` (optional): The quantities needed for inference at the final estimates,
+#                       or None if the estimation method does not provide them
+#                       (only returned if `returnState` is true).
 #
 # ====================================================================================
-def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels, nraneffs):
+def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels, nraneffs, returnState=False):
 
     # ----------------------------------------------------------------------
-    #  Read in one input nifti to get size, affines, etc.
+    #  Get the size, affine, etc. of the input niftis.
     # ----------------------------------------------------------------------
-    with open(inputs['Y_files']) as a:
-        nifti_path = a.readline().replace('\n', '')
-        nifti = loadFile(nifti_path)
+    context = getRunContext(inputs)
 
     # Work out the dimensions of the NIFTI images
-    NIFTIsize = nifti.shape
+    NIFTIsize = context['dim']
 
 
     # ----------------------------------------------------------------------
@@ -102,6 +106,25 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
     else:
         method='pSFS'
 
+    # Check if we are using block elimination for multiple random factors
+    if 'schur' in inputs:
+        schur = bool(inputs['schur'])
+    else:
+        schur = False
+
+    # Number of voxels estimated together when warm starting
+    if 'warmStartBlock' in inputs:
+        warmStartBlock = int(inputs['warmStartBlock'])
+    else:
+        warmStartBlock = 512
+
+    # Check if we are comparing the warm start to a cold start (this repeats
+    # the estimation for a sample of voxels, so is only for diagnostics)
+    if 'warmStartCompare' in inputs:
+        warmStartCompare = bool(inputs['warmStartCompare'])
+    else:
+        warmStartCompare = False
+
     # ----------------------------------------------------------------------
     # Preliminary useful variables
     # ---------------------------------------------------------------------- 
@@ -129,8 +152,54 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
     else:
         maxnit = 10000
 
+    # Record the copying done by the estimation method (see `compactRows`)
+    for stat in compactionStats:
+        compactionStats[stat] = 0
+
+    # Only pSFS returns the quantities needed for inference
+    state = None
+
     if method=='pSFS': # Recommended, default method
-        paramVec = pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, reml=REML, maxnit=maxnit)
+
+        # Check if we are warm starting voxels from their neighbours
+        if 'warmStart' in inputs and inputs['warmStart']:
+
+            results = warmStartpSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, REML, maxnit, inds, NIFTIsize, blockSize=warmStartBlock, schur=schur, returnState=returnState)
+            paramVec, nits, warm = results[0:3]
+            if returnState:
+                state = results[3]
+            del results
+
+            print('Mean iterations to convergence: ' + '{:.2f}'.format(np.mean(nits)) + ' (' + str(v) + ' voxels, ' + str(np.sum(warm)) + ' warm started)')
+
+            # Different voxels need different numbers of iterations, so to
+            # see what the warm start saves we compare it to a cold start on 
+            # the same (sample of) warm started voxels, if asked to
+            if warmStartCompare and np.any(warm):
+
+                sample = np.flatnonzero(warm)
+                sample = sample[np.unique(np.linspace(0, len(sample)-1, min(len(sample), 100)).astype(np.int64))]
+
+                # (This is left out of the compaction statistics)
+                savedStats = dict(compactionStats)
+                coldNits = pSFS3D(*[selectVoxels(A, sample, v) for A in (XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX)], 
+                                  nlevels, nraneffs, tol, selectVoxels(n, sample, v), reml=REML, maxnit=maxnit, 
+                                  returnNits=True, schur=schur)[1]
+                compactionStats.update(savedStats)
+
+                print('Mean iterations to convergence on ' + str(len(sample)) + ' warm started voxels: ' + 
+                      '{:.2f}'.format(np.mean(nits[sample])) + ' (warm start), ' + '{:.2f}'.format(np.mean(coldNits)) + 
+                      ' (no warm start)')
+
+        else:
+
+            results = pSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, reml=REML, maxnit=maxnit, returnNits=True, schur=schur, returnState=returnState)
+            paramVec, nits = results[0:2]
+            if returnState:
+                state = results[2]
+            del results
+
+            print('Mean iterations to convergence: ' + '{:.2f}'.format(np.mean(nits)) + ' (' + str(v) + ' voxels)')
     
     if method=='FS': 
         paramVec = FS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n)
@@ -141,6 +210,12 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
     if method=='pFS': 
         paramVec = pFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n)
 
+    # Report how much data was copied removing converged voxels
+    if compactionStats['iterations'] > 0:
+        print('Arrays reallocated ' + str(compactionStats['compactions']) + ' time(s) in ' + str(compactionStats['iterations']) +
+              ' iteration(s) (' + '{:.2f}'.format(compactionStats['bytes']/compactionStats['iterations']/1e6) + 'MB copied per iteration, ' +
+              str(compactionStats['wasted']) + ' converged voxel update(s))')
+
 
     # If running simulations we record the time used for parameter estimation
     if 'sim' in inputs:
@@ -148,7 +223,7 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
             t2 = time.time()
 
             # Output an "average estimation time nifti"
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_times.nii'), np.ones((v,1))*(t2-t1)/v, inds,volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
+            addBlockToShard(os.path.join(OutDir, 'blmm_vox_times.nii'), np.ones((v,1))*(t2-t1)/v, inds,volInd=0,dim=NIFTIsize)
 
     # ----------------------------------------------------------------------
     # Parameter outputting
@@ -166,15 +241,15 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
 
     # Output beta estimate
     beta = paramVec[:, 0:p]
-    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_beta.nii'), beta, inds,volInd=None,dim=dimBeta,aff=nifti.affine,hdr=nifti.header)        
+    addBlockToShard(os.path.join(OutDir, 'blmm_vox_beta.nii'), beta, inds,volInd=None,dim=dimBeta)        
     
     # Output sigma2 estimate
     sigma2 = paramVec[:,p:(p+1),:]
-    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_sigma2.nii'), sigma2, inds,volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
+    addBlockToShard(os.path.join(OutDir, 'blmm_vox_sigma2.nii'), sigma2, inds,volInd=0,dim=NIFTIsize)
 
     # Output unique D elements (i.e. [vech(D_1),...vech(D_r)])
     vechD = paramVec[:,(p+1):,:].reshape((v,qu))
-    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_D.nii'), vechD, inds,volInd=None,dim=dimD,aff=nifti.affine,hdr=nifti.header) 
+    addBlockToShard(os.path.join(OutDir, 'blmm_vox_D.nii'), vechD, inds,volInd=None,dim=dimD) 
 
     # Reconstruct D
     Ddict = dict()
@@ -186,4 +261,209 @@ def main(inputs, inds, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, n, nlevels,
     # Full version of D
     D = getDfromDict3D(Ddict, nraneffs, nlevels)
 
-    return(beta, sigma2, D)
\ No newline at end of file
+    if returnState:
+        return(beta, sigma2, D, state)
+    else:
+        return(beta, sigma2, D)
+
+
+# ============================================================================
+#
+# The below function performs parameter estimation using pSFS, warm starting
+# each voxel from the estimates of an already converged neighbouring voxel
+# (as neighbouring voxels tend to have very similar variance components).
+#
+# To do so, the voxels are ordered along a space filling (Morton, or "Z 
+# order") curve, which visits the image cube by cube, and estimated in 
+# blocks of `blockSize` consecutive voxels. Each block is therefore a small,
+# spatially compact, group of voxels, lying next to the blocks before it. 
+# Every voxel in a block is initialised from the closest already converged
+# voxel among its 26 immediate neighbours or, if none of them have converged
+# yet, from the closest converged voxel of the last block in which any voxels
+# converged. Voxels which stopped at `maxnit` iterations without converging
+# are never used as a starting point. Only voxels with no converged voxel to
+# start from (e.g. those of the first block) are initialised from the OLS
+# estimates, as usual.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the same inputs as `pSFS3D` (see `est3d.py`), as well
+# as:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `inds`: The (flattened) indices of the voxels being estimated.
+#  - `NIFTIsize`: The dimensions of the NIFTI images.
+#  - `blockSize` (optional): The number of voxels estimated together. Smaller
+#                            blocks give closer neighbours to start from, but
+#                            make less use of vectorisation.
+#  - `returnState` (optional): If true, the quantities needed for inference at
+#                              the final estimates are also returned (see
+#                              `pSFS3D`).
+#
+# ----------------------------------------------------------------------------
+#
+# And returns:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `paramVec`: The parameter estimates for every voxel (see `pSFS3D`).
+#  - `nits`: The number of iterations each voxel took to converge.
+#  - `warm`: A boolean vector indicating which voxels were warm started.
+#  - `state` (optional): The quantities needed for inference at the final
+#                        estimates (only returned if `returnState` is true).
+#
+# ============================================================================
+def warmStartpSFS3D(XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, tol, n, reml, maxnit, inds, NIFTIsize, blockSize=512, schur=False, returnState=False):
+
+    # Number of voxels and parameters
+    v = XtY.shape[0]
+    p = XtX.shape[1]
+    tnp = np.int32(p + 1 + np.sum(nraneffs*(nraneffs+1)//2))
+
+    # Work out the coordinates of each voxel
+    inds = inds.reshape(v)
+    dim = tuple(int(d) for d in NIFTIsize[:3])
+    coords = np.array(np.unravel_index(inds, dim)).transpose()
+
+    # Order the voxels along the Morton curve
+    order = np.argsort(mortonKeys(coords), kind='stable')
+
+    # The offsets to each voxel's neighbours, closest first
+    offsets = np.array(np.meshgrid([-1,0,1],[-1,0,1],[-1,0,1], indexing='ij')).reshape(3,27).transpose()
+    offsets = offsets[np.argsort(np.sum(offsets**2, axis=1), kind='stable')][1:]
+
+    # The voxel (i.e. row of paramVec) at each point of the image which has
+    # converged, or -1 if there isn't one
+    converged = -np.ones(int(np.prod(dim)), dtype=np.int64)
+
+    # Outputs
+    paramVec = np.zeros((v, tnp, 1))
+    nits = np.zeros(v)
+    warm = np.zeros(v, dtype=bool)
+    state = None
+
+    # The converged voxels of the last block in which any voxels converged
+    prev = None
+
+    for start in range(0, v, blockSize):
+
+        # Voxels in this block
+        vinds = order[start:start+blockSize]
+
+        # Find the closest converged neighbour of each voxel
+        source = -np.ones(len(vinds), dtype=np.int64)
+        for offset in offsets:
+
+            # Voxels still looking for a neighbour
+            need = np.flatnonzero(source < 0)
+            if len(need)==0:
+                break
+
+            # Neighbours which are inside the image
+            nbrs = coords[vinds[need]] + offset
+            inside = np.all((nbrs >= 0) & (nbrs < dim), axis=1)
+
+            source[need[inside]] = converged[np.ravel_multi_index(nbrs[inside].transpose(), dim)]
+
+        # Otherwise, use the closest converged voxel of a previous block
+        need = np.flatnonzero(source < 0)
+        if prev is not None and len(need) > 0:
+            dist = np.sum((coords[vinds[need]][:,None,:] - coords[prev][None,:,:])**2, axis=2)
+            source[need] = prev[np.argmin(dist, axis=1)]
+
+        # Initial values from neighbouring voxels
+        warm[vinds] = source >= 0
+        init = np.nan*np.zeros((len(vinds), tnp))
+        init[warm[vinds],:] = paramVec[source[warm[vinds]],:,0]
+
+        # Estimate the parameters
+        results = pSFS3D(*[selectVoxels(A, vinds, v) for A in (XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX)], 
+                         nlevels, nraneffs, tol, selectVoxels(n, vinds, v), reml=reml, 
+                         maxnit=maxnit, init=init, returnNits=True,
+                         schur=schur, returnState=returnState)
+        paramVec[vinds,:,:], nits[vinds] = results[0], results[1]
+
+        # Put this block's state in with the others
+        if returnState:
+
+            if state is None:
+                state = {key: np.empty((v,)+value.shape[1:]) for key, value in results[2].items()}
+
+            for key in state:
+                state[key][vinds] = results[2][key]
+
+        del results
+
+        # Record the converged voxels for the next blocks (voxels which
+        # reached `maxnit` are stopped after `maxnit+1` iterations, whether
+        # or not they converged)
+        done = vinds[nits[vinds] <= maxnit]
+        converged[inds[done]] = done
+        if len(done) > 0:
+            prev = done
+
+    if returnState:
+        return(paramVec, nits, warm, state)
+    else:
+        return(paramVec, nits, warm)
+
+
+# ============================================================================
+#
+# The below function returns the position of each voxel along the Morton (or
+# "Z order") curve, given by interleaving the bits of its coordinates.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `coords`: The (v by 3) coordinates of the voxels.
+#
+# ----------------------------------------------------------------------------
+#
+# And returns:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `keys`: The position of each voxel along the curve.
+#
+# ============================================================================
+def mortonKeys(coords):
+
+    coords = coords.astype(np.int64)
+    keys = np.zeros(coords.shape[0], dtype=np.int64)
+
+    # (21 bits per axis fit in a 64-bit key)
+    for b in range(21):
+        for axis in range(3):
+            keys |= ((coords[:,axis] >> b) & 1) << (3*b + axis)
+
+    return(keys)
+
+
+# ============================================================================
+#
+# The below function returns the given voxels of a (possibly spatially
+# varying) array. Arrays which are not spatially varying are returned as
+# they are.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `A`: The array (or scalar).
+#  - `vinds`: The indices of the voxels of interest.
+#  - `v`: The number of voxels.
+#
+# ============================================================================
+def selectVoxels(A, vinds, v):
+
+    if hasattr(A, "ndim") and A.ndim > 0 and A.shape[0] == v and v > 1:
+        return(A[vinds,...])
+    else:
+        return(A)
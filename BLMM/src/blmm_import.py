@@ -0,0 +1,268 @@
+import warnings as w
+# This warning is caused by numpy updates and should
+# be ignored for now.
+w.simplefilter(action = 'ignore', category = FutureWarning)
+import numpy as np
+from numpy.lib.format import open_memmap
+import nibabel as nib
+import sys
+import os
+import json
+import time
+import yaml
+from BLMM.lib.fileio import loadFile, get_amInds
+from BLMM.src.blmm_batch import verifyInput, prefetchY, printTimes
+
+# ====================================================================================
+#
+# This file imports the input images of an analysis into an "input store", so that
+# they only need to be read and decompressed once, no matter how many models are
+# fitted to them. The input images (`Y_files`) are read in, their data masks
+# (`data_mask_files`) and threshold (`data_mask_thresh`) are applied and the voxels
+# in the analysis mask (`analysis_mask`) are saved to the store directory. If no
+# analysis mask is given, only the voxels with data for at least one observation
+# are saved. The saved voxels are split into blocks of `Y_store_block` voxels, and
+# each block is saved to its own file, `Y_<block>.npy`, which the batch stage
+# memory maps and reads without decoding any NIFTIs. By default, each block is
+# saved voxel-major (i.e. as a voxels by observations array, so the observations
+# of a voxel are contiguous on disk), but it may instead be saved observation-major
+# (i.e. as an observations by voxels array, so the voxels of an observation are
+# contiguous on disk) by setting `Y_store_layout` to `observation`.
+#
+# Alongside the blocks, the store directory contains:
+#
+#  - `inds.npy`: The (flattened) indices of the saved voxels, in the order they
+#                are saved in the blocks.
+#  - `template.nii.gz`: An empty NIFTI with the dimensions, affine and header of the
+#                       input images.
+#  - `manifest.json`: A description of the store, including the inputs it was made
+#                     from. The manifest is written last, so a store without a
+#                     manifest is incomplete.
+#
+# To use the store, `Y_store` should be set to the store directory in the `inputs`
+# yml file, in place of `Y_files`. The data masks, threshold and analysis mask used
+# at import have already been applied to the store, so analyses which use it need
+# not give `data_mask_files` or `data_mask_thresh`, and must give the same ones
+# as the store if they do (see `loadYStore` in `fileio.py`).
+#
+# ------------------------------------------------------------------------------------
+#
+# The code takes the following inputs:
+#
+#  - `ipath`: Path to an `inputs` yml file, following the same formatting guidelines
+#             as `blmm_config.yml`. Only `Y_files`, `data_mask_files`,
+#             `data_mask_thresh`, `analysis_mask`, `prefetch` and `MAXMEM` are used
+#             (relative paths are taken to be relative to the present working
+#             directory), along with the following optional fields, which are
+#             specific to importing:
+#               - `Y_store_layout`: `voxel` (default) or `observation` (see above).
+#               - `Y_store_block`: The number of voxels in each block. Default:
+#                                  2**15.
+#               - `Y_store_dtype`: `float64` (default) or `float32`. Storing the
+#                                  observations in single precision halves the
+#                                  size of the store, but the observations are
+#                                  then rounded to single precision, so the
+#                                  results differ slightly from those obtained
+#                                  from `Y_files`.
+#  - `storeDir`: The directory to save the store in.
+#
+# ====================================================================================
+def main(ipath, storeDir):
+
+    t0 = time.time()
+
+    with open(ipath, 'r') as stream:
+        inputs = yaml.load(stream,Loader=yaml.FullLoader)
+
+    # Y volumes
+    with open(os.path.abspath(inputs['Y_files'])) as a:
+
+        Y_files = []
+        for line in a.readlines():
+
+            Y_files.append(line.replace('\n', ''))
+
+    # Number of observations
+    n = len(Y_files)
+
+    # Load in one nifti to check NIFTI size
+    try:
+        Y0 = loadFile(Y_files[0])
+    except Exception as error:
+        raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
+
+    # Mask volumes (if they are given)
+    if 'data_mask_files' in inputs:
+
+        with open(os.path.abspath(inputs['data_mask_files'])) as a:
+
+            M_files = []
+            for line in a.readlines():
+
+                M_files.append(line.replace('\n', ''))
+
+        if len(M_files) > n:
+            raise ValueError('Too many data_masks specified!')
+        elif len(M_files) < n:
+            raise ValueError('Too few data_masks specified!')
+
+    else:
+
+        M_files = []
+
+    # Mask threshold for Y (if given)
+    if 'data_mask_thresh' in inputs:
+        M_t = float(inputs['data_mask_thresh'])
+    else:
+        M_t = None
+
+    # Number of input volumes to read ahead of the current one (if given)
+    if 'prefetch' in inputs:
+        prefetch = int(inputs['prefetch'])
+    else:
+        prefetch = 0
+
+    # How the store is laid out
+    if 'Y_store_layout' in inputs:
+        layout = inputs['Y_store_layout']
+    else:
+        layout = 'voxel'
+
+    if layout not in ('voxel', 'observation'):
+        raise ValueError('Y_store_layout must be "voxel" or "observation", not "' + str(layout) + '"')
+
+    if 'Y_store_block' in inputs:
+        blockSize = int(eval(str(inputs['Y_store_block'])))
+    else:
+        blockSize = 2**15
+
+    if 'Y_store_dtype' in inputs:
+        dtype = inputs['Y_store_dtype']
+    else:
+        dtype = 'float64'
+
+    if dtype not in ('float64', 'float32'):
+        raise ValueError('Y_store_dtype must be "float64" or "float32", not "' + str(dtype) + '"')
+
+    # Check if the maximum memory is saved.
+    if 'MAXMEM' in inputs:
+        MAXMEM = eval(inputs['MAXMEM'])
+    else:
+        MAXMEM = 2**32
+
+    # Verify input
+    verifyInput(Y_files, M_files, Y0)
+
+    # Timings for reading versus computation
+    times = {'wait': 0, 'compute': 0}
+
+    # --------------------------------------------------------------------------------
+    # Work out which voxels to save
+    # --------------------------------------------------------------------------------
+    if 'analysis_mask' in inputs:
+
+        inds = get_amInds(loadFile(os.path.abspath(inputs['analysis_mask'])).get_data())
+
+    else:
+
+        # Without an analysis mask, we need a first pass through the images to
+        # find the voxels which have data for at least one observation
+        present = np.zeros(int(np.prod(Y0.shape)), dtype=bool)
+        for i, d in prefetchY(Y_files, M_files, M_t, prefetch, times):
+            present |= (np.nan_to_num(d).reshape(-1)!=0)
+
+        inds = np.flatnonzero(present)
+
+    # --------------------------------------------------------------------------------
+    # Save the observations
+    # --------------------------------------------------------------------------------
+    os.makedirs(storeDir, exist_ok=True)
+
+    # Remove the manifest of any previous store, so this one is never
+    # mistaken for being complete before it is
+    if os.path.exists(os.path.join(storeDir, 'manifest.json')):
+        os.remove(os.path.join(storeDir, 'manifest.json'))
+
+    # The first and last (plus one) saved voxels of each block
+    starts = np.arange(0, max(len(inds), 1), blockSize)
+    ends = np.minimum(starts + blockSize, len(inds))
+    chunks = ['Y_' + str(k) + '.npy' for k in range(len(starts))]
+
+    # The blocks are written under a temporary name and renamed once they are
+    # complete
+    Y = []
+    for k in range(len(starts)):
+
+        nvox = int(ends[k]-starts[k])
+        shape = (nvox, n) if layout == 'voxel' else (n, nvox)
+        Y.append(open_memmap(os.path.join(storeDir, chunks[k] + '.part'), mode='w+',
+                             dtype=dtype, shape=shape))
+
+    # Writing one observation at a time to a voxel-major block would touch
+    # every page of the block, so the observations are gathered into groups
+    # of as many as fit in memory and each group is written at once
+    if layout == 'voxel':
+        group = int(max(1, min(n, MAXMEM // (8*max(len(inds), 1)))))
+    else:
+        group = 1
+
+    buf = np.zeros((group, len(inds)))
+    for i, d in prefetchY(Y_files, M_files, M_t, prefetch, times, inds):
+
+        # NaN check
+        buf[i % group,:] = np.nan_to_num(d).reshape([len(inds)])
+
+        # Write the group once it is full (or the observations run out)
+        if (i % group == group-1) or (i == n-1):
+
+            first = i - (i % group)
+            for k in range(len(starts)):
+
+                block = buf[:(i-first+1), starts[k]:ends[k]]
+                if layout == 'voxel':
+                    Y[k][:, first:(i+1)] = block.transpose()
+                else:
+                    Y[k][first:(i+1), :] = block
+
+    for k in range(len(starts)):
+        Y[k].flush()
+    del Y
+    for chunk in chunks:
+        os.replace(os.path.join(storeDir, chunk + '.part'), os.path.join(storeDir, chunk))
+
+    # Save the voxel indices
+    np.save(os.path.join(storeDir, 'inds.npy'), inds)
+
+    # Save a template NIFTI, so the analysis never needs to open the inputs
+    # (the outputs are saved with its header, so this must match the inputs)
+    template = nib.Nifti1Image(np.zeros(Y0.shape, dtype=Y0.get_data_dtype()), Y0.affine, header=Y0.header)
+    nib.save(template, os.path.join(storeDir, 'template.nii.gz'))
+
+    # Write the manifest
+    manifest = {'version': 2,
+                'n': n,
+                'dim': [int(d) for d in Y0.shape],
+                'dtype': dtype,
+                'layout': layout,
+                'block': blockSize,
+                'chunks': chunks,
+                'inds': 'inds.npy',
+                'template': 'template.nii.gz',
+                'Y_files': Y_files,
+                'data_mask_files': M_files if M_files else None,
+                'data_mask_thresh': M_t,
+                'analysis_mask': os.path.abspath(inputs['analysis_mask']) if 'analysis_mask' in inputs else None}
+
+    with open(os.path.join(storeDir, 'manifest.json.part'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(storeDir, 'manifest.json.part'), os.path.join(storeDir, 'manifest.json'))
+
+    # Report how long was spent waiting on input
+    printTimes(times)
+
+    print('Imported ' + str(n) + ' image(s), ' + str(len(inds)) + ' voxel(s) each, into ' +
+          storeDir + ' in ' + '{:.2f}'.format(time.time()-t0) + 's')
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
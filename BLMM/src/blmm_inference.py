@@ -56,18 +56,20 @@ from BLMM.lib.fileio import *
 #           Z'Z.
 #  - `n`: The number of observations (can be spatially varying or non-spatially 
 #         varying). 
+#  - `state` (optional): The quantities computed by the estimation method at the
+#                        final estimates (see `pSFS3D`). If given, these are used
+#                        rather than recomputed, and are removed from `state` so 
+#                        that they are freed once inference is done.
 #
 # ====================================================================================
-def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ):
+def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, state=None):
 
     # ----------------------------------------------------------------------
-    #  Read in one input nifti to get size, affines, etc.
+    #  Get the size, affine, etc. of the input niftis.
     # ----------------------------------------------------------------------
-    with open(inputs['Y_files']) as a:
-        nifti_path = a.readline().replace('\n', '')
-        nifti = loadFile(nifti_path)
+    context = getRunContext(inputs)
 
-    NIFTIsize = nifti.shape
+    NIFTIsize = context['dim']
 
     # ----------------------------------------------------------------------
     # Input variables
@@ -82,6 +84,9 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
     else:
         minlog=-323.3062153431158
 
+    # Work out which maps to output and which quantities are needed for them
+    outputs, needed = planOutputs(inputs)
+
     # ----------------------------------------------------------------------
     # Preliminary useful variables
     # ---------------------------------------------------------------------- 
@@ -114,10 +119,14 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
         # Add Dk to the dict
         Ddict[k] = D[:,Dinds[k]:(Dinds[k]+nraneffs[k]),Dinds[k]:(Dinds[k]+nraneffs[k])]
 
+    # Check if we are using block elimination for multiple random factors
+    schur = 'schur' in inputs and bool(inputs['schur'])
+
     # Miscellaneous matrix variables
-    DinvIplusZtZD = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs)
-    Zte = ZtY - (ZtX @ beta)
-    ete = ssr3D(YtX, YtY, XtX, beta)
+    if state is not None:
+        DinvIplusZtZD, logdet = state.pop('DinvIplusZtZD'), state.pop('logdet')
+    elif 'DinvIplusZtZD' in needed:
+        DinvIplusZtZD, logdet = get_DinvIplusZtZD3D(Ddict, D, ZtZ, nlevels, nraneffs, returnLogdet=True, schur=schur)
 
     # REML (currently only exists as a backdoor option as is not much 
     # practical use in the high n setting)
@@ -126,75 +135,87 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
     # --------------------------------------------------------------------------
     # Get XtiVX and ZtiVX
     # --------------------------------------------------------------------------
-    # This can be performed faster in the one factor, one random effect case by
-    # using only the diagonal elements of DinvIplusZtZD 
-    if r == 1 and nraneffs[0] == 1:
+    if 'XtiVX' in needed or 'ZtiVX' in needed:
 
-        # Multiply by Z'X
-        DinvIplusZtZDZtX = np.einsum('ij,ijk->ijk', DinvIplusZtZD, ZtX)
+        # This can be performed faster in the one factor, one random effect case by
+        # using only the diagonal elements of DinvIplusZtZD 
+        if r == 1 and nraneffs[0] == 1:
 
-    # This can also be performed faster in the one factor, multiple random effect
-    # case by using only the diagonal blocks of DinvIplusZtZD 
-    elif r == 1 and nraneffs[0] > 1:
+            # Multiply by Z'X
+            DinvIplusZtZDZtX = np.einsum('ij,ijk->ijk', DinvIplusZtZD, ZtX)
 
-        # Reshape DinvIplusZtZD appropriately
-        DinvIplusZtZDZtX = DinvIplusZtZD.transpose(0,2,1).reshape(v,l0,q0,q0)
+        # This can also be performed faster in the one factor, multiple random effect
+        # case by using only the diagonal blocks of DinvIplusZtZD 
+        elif r == 1 and nraneffs[0] > 1:
 
-        # Multiply by ZtX
-        DinvIplusZtZDZtX = DinvIplusZtZDZtX @ ZtX.reshape(ZtX.shape[0],l0,q0,p)    
+            # Reshape DinvIplusZtZD appropriately
+            DinvIplusZtZDZtX = DinvIplusZtZD.transpose(0,2,1).reshape(v,l0,q0,q0)
 
-    else:
+            # Multiply by ZtX
+            DinvIplusZtZDZtX = DinvIplusZtZDZtX @ ZtX.reshape(ZtX.shape[0],l0,q0,p)    
 
-        # Multiply by Z'X
-        DinvIplusZtZDZtX = DinvIplusZtZD @ ZtX
+        else:
 
+            # Multiply by Z'X
+            DinvIplusZtZDZtX = DinvIplusZtZD @ ZtX
 
-    # It is useful to get ZtiVX at this point as we need it for dldS but we have all
-    # the building blocks here
-    if r == 1 and nraneffs[0]==1:
 
-        # Get Z'V^{-1}X
-        ZtiVX = ZtX - np.einsum('ij,ijk->ijk', ZtZ, DinvIplusZtZDZtX)
+    # ZtiVX is only needed for the Sattherthwaite degrees of freedom, but we have 
+    # all the building blocks here
+    if 'ZtiVX' in needed:
 
-    elif r == 1 and nraneffs[0] > 1:
+        if r == 1 and nraneffs[0]==1:
 
-        # Reshape DinvIplusZtZD appropriately
-        #DinvIplusZtZDZtX = DinvIplusZtZDZtX.transpose((0,2,1)).reshape(v,l0,q0,p)
+            # Get Z'V^{-1}X
+            ZtiVX = ZtX - np.einsum('ij,ijk->ijk', ZtZ, DinvIplusZtZDZtX)
 
-        # Multiply by ZtZ and DinvIplusZtZDZtX
-        ZtZDinvIplusZtZDZtX = ZtZ.transpose(0,2,1).reshape(ZtZ.shape[0],l0,q0,q0) @ DinvIplusZtZDZtX
-        ZtZDinvIplusZtZDZtX = ZtZDinvIplusZtZDZtX.reshape(v,q0*l0,p)
+        elif r == 1 and nraneffs[0] > 1:
 
-        # Get Z'V^{-1}X
-        ZtiVX = ZtX - ZtZDinvIplusZtZDZtX
+            # Multiply by ZtZ and DinvIplusZtZDZtX
+            ZtZDinvIplusZtZDZtX = ZtZ.transpose(0,2,1).reshape(ZtZ.shape[0],l0,q0,q0) @ DinvIplusZtZDZtX
+            ZtZDinvIplusZtZDZtX = ZtZDinvIplusZtZDZtX.reshape(v,q0*l0,p)
 
-        # Reshape appropriately
-        DinvIplusZtZDZtX = DinvIplusZtZDZtX.reshape(v,q0*l0,p)
+            # Get Z'V^{-1}X
+            ZtiVX = ZtX - ZtZDinvIplusZtZDZtX
 
-        # delete unnecessary variable
-        del ZtZDinvIplusZtZDZtX
+            # delete unnecessary variable
+            del ZtZDinvIplusZtZDZtX
 
-    else:
+        else:
 
-        # Get Z'V^{-1}X
-        ZtiVX = ZtX - ZtZ @ DinvIplusZtZDZtX
+            # Get Z'V^{-1}X
+            ZtiVX = ZtX - ZtZ @ DinvIplusZtZDZtX
 
 
-    # Work out X'V^(-1)X and X'V^(-1)Y by dimension reduction formulae
-    XtiVX = XtX - DinvIplusZtZDZtX.transpose((0,2,1)) @ ZtX
+    if 'XtiVX' in needed:
+
+        # Reshape appropriately
+        if r == 1 and nraneffs[0] > 1:
+            DinvIplusZtZDZtX = DinvIplusZtZDZtX.reshape(v,q0*l0,p)
+
+        # Work out X'V^(-1)X and X'V^(-1)Y by dimension reduction formulae
+        XtiVX = XtX - DinvIplusZtZDZtX.transpose((0,2,1)) @ ZtX
 
 
     # ----------------------------------------------------------------------
     # Calculate log-likelihood
     # ---------------------------------------------------------------------- 
+    if 'llh' in outputs:
 
-    # Output log likelihood
-    if not REML:
-        llh = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD, D, Ddict, nlevels, nraneffs, REML, XtX, XtiVX) - (0.5*(n)*np.log(2*np.pi))
-    else:
-        llh = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD, D, Ddict, nlevels, nraneffs, REML, XtX, XtiVX) - (0.5*(n-p)*np.log(2*np.pi))
-        
-    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_llh.nii'), llh, inds,volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
+        # Residual terms
+        if state is not None:
+            Zte, ete = state.pop('Zte'), state.pop('ete')
+        else:
+            Zte = ZtY - (ZtX @ beta)
+            ete = ssr3D(YtX, YtY, XtX, beta)
+
+        # Output log likelihood
+        if not REML:
+            llh = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD, D, Ddict, nlevels, nraneffs, REML, XtX, XtiVX, logdet=logdet) - (0.5*(n)*np.log(2*np.pi))
+        else:
+            llh = llh3D(n, ZtZ, Zte, ete, sigma2, DinvIplusZtZD, D, Ddict, nlevels, nraneffs, REML, XtX, XtiVX, logdet=logdet) - (0.5*(n-p)*np.log(2*np.pi))
+            
+        addBlockToShard(os.path.join(OutDir, 'blmm_vox_llh.nii'), llh, inds,volInd=0,dim=NIFTIsize)
 
     # ----------------------------------------------------------------------
     # Calculate residual mean squares = e'e/(n - p)
@@ -206,29 +227,28 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
     #             expression for more general methods
     #
     # ----------------------------------------------------------------------
-    if "resms" in inputs:
-        if inputs["resms"]==1:    
-            resms = get_resms3D(YtX, YtY, XtX, beta,n,p).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_resms.nii'), resms, inds,volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
+    if 'resms' in outputs:
+        resms = get_resms3D(YtX, YtY, XtX, beta,n,p).reshape(v)
+        addBlockToShard(os.path.join(OutDir, 'blmm_vox_resms.nii'), resms, inds,volInd=0,dim=NIFTIsize)
         
+    # ----------------------------------------------------------------------
+    # Invert X'V^{-1}X once. Every contrast (and cov(beta)) is evaluated 
+    # using this inverse.
+    # ----------------------------------------------------------------------
+    if 'iXtiVX' in needed:
+        iXtiVX = np.linalg.inv(XtiVX)
 
     # ----------------------------------------------------------------------
     # Calculate beta covariance maps (Optionally output)
     # ----------------------------------------------------------------------
-
-    if "OutputCovB" in inputs:
-        OutputCovB = inputs["OutputCovB"]
-    else:
-        OutputCovB = True
-
-    if OutputCovB:
+    if 'cov' in outputs:
 
         # Dimension of cov(beta) NIFTI
         dimCov = (NIFTIsize[0],NIFTIsize[1],NIFTIsize[2],p**2)
 
         # Work out cov(beta)
-        covB = get_covB3D(XtiVX, sigma2, nraneffs).reshape(v, p**2)
-        addBlockToNifti(os.path.join(OutDir, 'blmm_vox_cov.nii'), covB, inds,volInd=None,dim=dimCov,aff=nifti.affine,hdr=nifti.header)
+        covB = get_covB3D(XtiVX, sigma2, nraneffs, iXtiVX).reshape(v, p**2)
+        addBlockToShard(os.path.join(OutDir, 'blmm_vox_cov.nii'), covB, inds,volInd=None,dim=dimCov)
         del covB
 
     # ----------------------------------------------------------------------
@@ -242,14 +262,40 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
     for i in range(0,c):
 
         # Read in contrast vector
-        L = str2vec(inputs['contrasts'][i]['c' + str(i+1)]['vector'])
-        L = np.array(L)
+        L = context['contrasts'][i]
 
         if L.ndim == 1:
             nt = nt + 1
         else:
             nf = nf + 1
 
+    # Invert the Fisher information matrix once, it is shared by the degrees
+    # of freedom estimates of every contrast
+    if c > 0 and 'iInfoMat' in needed:
+        iInfoMat = np.linalg.inv(get_InfoMat3D(DinvIplusZtZD, sigma2.reshape(v), n, nlevels, nraneffs, ZtZ))
+    else:
+        iInfoMat = None
+
+    # Stack the T contrasts, so that L\beta, s.e.(L\beta) and T can be 
+    # worked out for all of them at once
+    if nt > 0:
+
+        # Stacked T contrasts
+        LT = np.array([context['contrasts'][i] for i in range(0,c) if context['contrasts'][i].ndim == 1]).reshape(nt,p)
+
+        # Work out L\beta for every T contrast
+        if 'LB' in needed:
+            LTbeta = (LT @ beta).reshape(v,nt)
+
+        # Work out s.e.(L\beta) for every T contrast, from the diagonal of
+        # L cov(beta) L'
+        if 'seLB' in needed:
+            seLTB = np.sqrt(np.einsum('ij,vjk,ik->vi', LT, get_covB3D(XtiVX, sigma2, nraneffs, iXtiVX), LT))
+
+        # Work out T for every T contrast
+        if 'T' in needed:
+            LTT = LTbeta/seLTB
+
     # Current number for contrast (T and F)
     current_nt = 0
     current_nf = 0
@@ -258,8 +304,7 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
     for i in range(0,c):
 
         # Read in contrast vector
-        L = str2vec(inputs['contrasts'][i]['c' + str(i+1)]['vector'])
-        L = np.array(L)
+        L = context['contrasts'][i]
     
         # Work out if it is a T or an F contrast NTS: FIX THIS
         if L.ndim == 1:
@@ -276,25 +321,32 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
             # Work out the dimension of the T-stat-related volumes
             dimT = (NIFTIsize[0],NIFTIsize[1],NIFTIsize[2],nt)
 
-            # Work out L\beta
-            Lbeta = L @ beta
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_con.nii'), Lbeta, inds,volInd=current_nt,dim=dimT,aff=nifti.affine,hdr=nifti.header)
+            # Output L\beta
+            if 'con' in outputs:
+                Lbeta = LTbeta[:,current_nt]
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_con.nii'), Lbeta, inds,volInd=current_nt,dim=dimT)
 
-            # Work out s.e.(L\beta)
-            seLB = np.sqrt(get_varLB3D(L, XtiVX, sigma2, nraneffs).reshape(v))
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conSE.nii'), seLB, inds,volInd=current_nt,dim=dimT,aff=nifti.affine,hdr=nifti.header)
+            # Output s.e.(L\beta)
+            if 'conSE' in outputs:
+                seLB = seLTB[:,current_nt]
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_conSE.nii'), seLB, inds,volInd=current_nt,dim=dimT)
 
             # Calculate sattherwaite estimate of the degrees of freedom of this statistic
-            swdfc = get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conT_swedf.nii'), swdfc, inds,volInd=current_nt,dim=dimT,aff=nifti.affine,hdr=nifti.header)
+            if 'swdf' in needed:
+                swdfc = get_swdf_T3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs, iXtiVX, iInfoMat).reshape(v)
+                if 'conT_swedf' in outputs:
+                    addBlockToShard(os.path.join(OutDir, 'blmm_vox_conT_swedf.nii'), swdfc, inds,volInd=current_nt,dim=dimT)
 
-            # Obtain and output T statistic
-            Tc = get_T3D(L, XtiVX, beta, sigma2, nraneffs).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conT.nii'), Tc, inds,volInd=current_nt,dim=dimT,aff=nifti.affine,hdr=nifti.header)
+            # Output T statistic
+            if 'conT' in outputs or 'conTlp' in outputs:
+                Tc = LTT[:,current_nt]
+                if 'conT' in outputs:
+                    addBlockToShard(os.path.join(OutDir, 'blmm_vox_conT.nii'), Tc, inds,volInd=current_nt,dim=dimT)
 
             # Obatin and output p-values
-            pc = T2P3D(Tc,swdfc,minlog)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conTlp.nii'), pc, inds,volInd=current_nt,dim=dimT,aff=nifti.affine,hdr=nifti.header)
+            if 'conTlp' in outputs:
+                pc = T2P3D(Tc,swdfc,minlog)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_conTlp.nii'), pc, inds,volInd=current_nt,dim=dimT)
 
             # Record that we have seen another T contrast
             current_nt = current_nt + 1
@@ -308,20 +360,131 @@ def main(inputs, nraneffs, nlevels, inds, beta, D, sigma2, n, XtX, XtY, XtZ, YtX
             dimF = (NIFTIsize[0],NIFTIsize[1],NIFTIsize[2],nf)
 
             # Calculate sattherthwaite degrees of freedom for the inner.
-            swdfc = get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conF_swedf.nii'), swdfc, inds,volInd=current_nf,dim=dimF,aff=nifti.affine,hdr=nifti.header)
+            if 'swdf' in needed:
+                swdfc = get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs, iXtiVX, iInfoMat).reshape(v)
+                if 'conF_swedf' in outputs:
+                    addBlockToShard(os.path.join(OutDir, 'blmm_vox_conF_swedf.nii'), swdfc, inds,volInd=current_nf,dim=dimF)
 
             # Calculate F statistic.
-            Fc=get_F3D(L, XtiVX, betahat, sigma2, nraneffs).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conF.nii'), Fc, inds,volInd=current_nf,dim=dimF,aff=nifti.affine,hdr=nifti.header)
+            if 'F' in needed:
+                Fc=get_F3D(L, XtiVX, beta, sigma2, nraneffs, iXtiVX).reshape(v)
+                if 'conF' in outputs:
+                    addBlockToShard(os.path.join(OutDir, 'blmm_vox_conF.nii'), Fc, inds,volInd=current_nf,dim=dimF)
 
             # Work out p for this contrast
-            pc = F2P3D(Fc, L, swdfc, minlog).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conFlp.nii'), pc, inds,volInd=current_nf,dim=dimF,aff=nifti.affine,hdr=nifti.header)
+            if 'conFlp' in outputs:
+                pc = F2P3D(Fc, L, swdfc, minlog).reshape(v)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_conFlp.nii'), pc, inds,volInd=current_nf,dim=dimF)
 
             # Calculate partial R2 masked for ring.
-            R2 = get_R23D(L, Fc, swdfc).reshape(v)
-            addBlockToNifti(os.path.join(OutDir, 'blmm_vox_conR2.nii'), R2, inds,volInd=current_nf,dim=dimF,aff=nifti.affine,hdr=nifti.header)
+            if 'conR2' in outputs:
+                R2 = get_R23D(L, Fc, swdfc).reshape(v)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_conR2.nii'), R2, inds,volInd=current_nf,dim=dimF)
 
             # Record that we have seen another F contrast
             current_nf = current_nf + 1
+
+
+# ============================================================================
+#
+# The below dictionary gives, for every output map of the inference stage and
+# every quantity computed along the way, the quantities it is computed from.
+# Output maps are named as in the output files, e.g. `conTlp` for 
+# `blmm_vox_conTlp.nii`.
+#
+# ============================================================================
+inferenceDependencies = {
+    # Output maps
+    'llh': ['XtiVX', 'DinvIplusZtZD'],
+    'resms': [],
+    'cov': ['iXtiVX'],
+    'con': ['LB'],
+    'conSE': ['seLB'],
+    'conT': ['T'],
+    'conT_swedf': ['swdf'],
+    'conTlp': ['T', 'swdf'],
+    'conF': ['F'],
+    'conF_swedf': ['swdf'],
+    'conFlp': ['F', 'swdf'],
+    'conR2': ['F', 'swdf'],
+    # Quantities
+    'LB': [],
+    'seLB': ['iXtiVX'],
+    'T': ['LB', 'seLB'],
+    'F': ['iXtiVX'],
+    'swdf': ['iXtiVX', 'ZtiVX', 'iInfoMat'],
+    'iInfoMat': ['DinvIplusZtZD'],
+    'iXtiVX': ['XtiVX'],
+    'XtiVX': ['DinvIplusZtZD'],
+    'ZtiVX': ['DinvIplusZtZD'],
+    'DinvIplusZtZD': []}
+
+# The output maps, in the order they are listed in the README
+outputMaps = ['llh', 'resms', 'cov', 'con', 'conSE', 'conT', 'conT_swedf', 'conTlp', 
+              'conF', 'conF_swedf', 'conFlp', 'conR2']
+
+
+# ============================================================================
+#
+# The below function works out which maps the inference stage should output
+# and, using `inferenceDependencies`, every quantity which must be computed
+# to produce them. If the `outputs` field is given in the inputs, only the
+# maps listed there are output. Otherwise every map is output, except 
+# `resms` (unless `resms` is set to `1`) and `cov` (if `OutputCovB` is set 
+# to `False`).
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `inputs`: The contents of the `inputs.yml` file, loaded using the `yaml` 
+#             python package.
+#
+# ----------------------------------------------------------------------------
+#
+# And gives the following outputs:
+#
+# ----------------------------------------------------------------------------
+#
+# - `outputs`: The set of maps to output.
+# - `needed`: The set of maps and quantities which must be computed.
+#
+# ============================================================================
+def planOutputs(inputs):
+
+    if 'outputs' in inputs:
+
+        # The maps requested (with or without the `blmm_vox_` prefix)
+        outputs = set(str(o).replace('blmm_vox_','').replace('.nii','') for o in inputs['outputs'])
+
+        # Check the maps requested exist
+        unknown = sorted(outputs.difference(outputMaps))
+        if unknown:
+            raise ValueError('Unknown output(s) ' + ', '.join(unknown) + '. Outputs must be from: ' + ', '.join(outputMaps))
+
+    else:
+
+        outputs = set(outputMaps)
+
+        # Residual mean squares are only output if asked for
+        if not ('resms' in inputs and inputs['resms']==1):
+            outputs.remove('resms')
+
+        # Covariance maps can be turned off
+        if 'OutputCovB' in inputs and not inputs['OutputCovB']:
+            outputs.remove('cov')
+
+    # Work out everything the maps depend on
+    needed = set()
+    toVisit = list(outputs)
+    while toVisit:
+
+        quantity = toVisit.pop()
+
+        if quantity not in needed:
+            needed.add(quantity)
+            toVisit = toVisit + inferenceDependencies[quantity]
+
+    return(outputs, needed)
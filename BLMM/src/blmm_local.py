@@ -0,0 +1,210 @@
+import warnings as w
+# This warning is caused by numpy updates and should
+# be ignored for now.
+w.simplefilter(action = 'ignore', category = FutureWarning)
+import sys
+import os
+import shutil
+import yaml
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# The stages are imported from `src`, as in the cluster scripts, so the BLMM
+# directory must be on the path.
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),'..'))
+
+# ====================================================================================
+#
+# This file runs the whole BLMM pipeline on a single machine, without `fsl_sub`. The
+# stages of the pipeline (setup, batch, concat, results and cleanup) are run, in
+# order, on a pool of worker processes. The batch jobs and the results jobs (one per
+# voxel batch) are each run concurrently. Each job calls the `main` function of its
+# stage directly, so the interpreter and imports are only paid for once per worker
+# rather than once per job. The wall time of each stage is printed as it completes.
+#
+# ------------------------------------------------------------------------------------
+#
+# The code takes the following inputs:
+#
+#  - `ipath`: Path to an `inputs` yml file, following the same formatting guidelines
+#             as `blmm_config.yml`. As with `blmm_cluster.sh`, the file is copied to
+#             `inputs.yml` in the output directory, which is then used by every
+#             stage.
+#  - `nworkers` (optional): The number of worker processes to use. By default, the
+#                           number of cores divided by `ncores`.
+#  - `ncores` (optional): The number of cores each worker may use (e.g. for numpy's
+#                         linear algebra). By default, 1.
+#
+# ====================================================================================
+def main(ipath, nworkers=None, ncores=1):
+
+    # --------------------------------------------------------------------------------
+    # Work out the core budget for each worker
+    # --------------------------------------------------------------------------------
+    ncores = int(ncores)
+    if nworkers is None:
+        nworkers = max(1, os.cpu_count()//ncores)
+    nworkers = int(nworkers)
+
+    # The workers inherit these when they are started (this must happen before
+    # they import numpy).
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(ncores)
+
+    # --------------------------------------------------------------------------------
+    # Make output directory and copy the inputs file into it
+    # --------------------------------------------------------------------------------
+    ipath = os.path.abspath(ipath)
+    with open(ipath, 'r') as stream:
+        inputs = yaml.load(stream,Loader=yaml.FullLoader)
+
+    OutDir = os.path.abspath(inputs['outdir'])
+    if not os.path.isdir(OutDir):
+        os.makedirs(OutDir)
+
+    # Make a copy of the inputs file, if the user touches the cfg file this will not
+    # mess with anything now.
+    inputs_path = os.path.join(OutDir, 'inputs.yml')
+    if ipath != inputs_path:
+        shutil.copy(ipath, inputs_path)
+
+    print('Running BLMM locally with ' + str(nworkers) + ' workers, each using ' +
+          str(ncores) + ' core(s).')
+
+    t0 = time.time()
+
+    # Workers are started fresh (rather than forked) so that they pick up the
+    # core budget above.
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=multiprocessing.get_context('spawn')) as pool:
+
+        # ----------------------------------------------------------------------------
+        # Setup
+        # ----------------------------------------------------------------------------
+        runStage(pool, 'setup', [('setup', inputs_path)])
+
+        # Work out number of batchs
+        with open(os.path.join(OutDir, 'nb.txt')) as f:
+            n_b = int(f.readline())
+
+        # ----------------------------------------------------------------------------
+        # Batch jobs
+        # ----------------------------------------------------------------------------
+        runStage(pool, 'batch', [('batch', i, inputs_path) for i in range(1, n_b+1)])
+
+        # ----------------------------------------------------------------------------
+        # Concatenation
+        # ----------------------------------------------------------------------------
+        runStage(pool, 'concat', [('concat', inputs_path)])
+
+        # ----------------------------------------------------------------------------
+        # Results jobs
+        # ----------------------------------------------------------------------------
+        # Reread the inputs, in case setup has updated them
+        with open(inputs_path, 'r') as stream:
+            inputs = yaml.load(stream,Loader=yaml.FullLoader)
+
+        # Check if we are in voxel batch mode
+        if 'voxelBatching' in inputs and inputs['voxelBatching']:
+
+            # Work out number of voxel batches needed
+            with open(os.path.join(OutDir, 'nvb.txt')) as f:
+                nvb = int(f.readline())
+
+            runStage(pool, 'results', [('results', inputs_path, str(i)) for i in range(1, nvb+1)])
+
+        else:
+
+            runStage(pool, 'results', [('results', inputs_path, '-1')])
+
+        # ----------------------------------------------------------------------------
+        # Cleanup
+        # ----------------------------------------------------------------------------
+        runStage(pool, 'cleanup', [('cleanup', inputs_path)])
+
+    print('Total time: ' + '{:.2f}'.format(time.time()-t0) + 's')
+
+
+# ============================================================================
+#
+# The below function runs every job of one stage of the pipeline on the pool
+# of workers, waits for them all to complete and prints the wall time of the
+# stage. Any error raised by a job is raised here.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `pool`: The pool of worker processes.
+#  - `stage`: The name of the stage.
+#  - `jobs`: A list of jobs, each given as a tuple of arguments to `runJob`.
+#
+# ============================================================================
+def runStage(pool, stage, jobs):
+
+    t1 = time.time()
+
+    # Submit the jobs and wait for them all to complete
+    futures = [pool.submit(runJob, *job) for job in jobs]
+    jobTimes = [f.result() for f in futures]
+
+    t2 = time.time()
+
+    print('Stage ' + stage + ': ' + str(len(jobs)) + ' job(s) in ' + '{:.2f}'.format(t2-t1) +
+          's (per job: max ' + '{:.2f}'.format(max(jobTimes)) + 's)')
+
+
+# ============================================================================
+#
+# The below function runs a single job of the pipeline in a worker process,
+# by calling the `main` function of the relevant stage.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `stage`: The name of the stage (e.g. 'batch').
+#  - `args`: The arguments to the `main` function of the stage.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `jobTime`: The time taken to run the job (excluding any imports).
+#
+# ============================================================================
+def runJob(stage, *args):
+
+    # Import the stage (only slow the first time in each worker)
+    if stage == 'setup':
+        from src import blmm_setup as module
+    elif stage == 'batch':
+        from src import blmm_batch as module
+    elif stage == 'concat':
+        from src import blmm_concat as module
+    elif stage == 'results':
+        from src import blmm_results as module
+    elif stage == 'cleanup':
+        from src import blmm_cleanup as module
+
+    # Stages may change directory, so make sure each job starts in the same one
+    pwd = os.getcwd()
+
+    t1 = time.time()
+
+    try:
+        module.main(*args)
+    finally:
+        os.chdir(pwd)
+
+    return(time.time()-t1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -85,46 +85,28 @@ def main(ipath, vb):
     with open(os.path.join(OutDir,'nb.txt')) as f:
         n_b = int(f.readline())
 
-    # Random factor variables.
-    rfxmats = inputs['Z']
+    # Metadata shared by every stage of the pipeline (worked out once, during
+    # setup)
+    context = getRunContext(inputs)
 
     # Number of random effects
-    r = len(rfxmats)
+    r = len(inputs['Z'])
 
-    # Number of random effects for each factor, q
-    nraneffs = []
-
-    # Number of levels for each factor, l
-    nlevels = []
-
-    for k in range(r):
-
-        rfxdes = loadFile(rfxmats[k]['f' + str(k+1)]['design'])
-        rfxfac = loadFile(rfxmats[k]['f' + str(k+1)]['factor'])
-
-        nraneffs = nraneffs + [rfxdes.shape[1]]
-        nlevels = nlevels + [len(np.unique(rfxfac))]
+    # Number of random effects and levels for each factor
+    nraneffs = context['nraneffs']
+    nlevels = context['nlevels']
 
     # Get number of random effects
-    nraneffs = np.array(nraneffs)
-    nlevels = np.array(nlevels)
-    q = np.sum(nraneffs*nlevels)
+    q = context['q']
 
     # Get number of unique random effects
     q_u = np.sum(nraneffs*(nraneffs+1)//2)
     
     # Get number of fixed effects parameters
-    L1 = str2vec(inputs['contrasts'][0]['c' + str(1)]['vector'])
-    L1 = np.array(L1)
-    p = L1.shape[0]
-    del L1
+    p = context['p']
     
-    # Read in the nifti size and work out number of voxels.
-    with open(inputs['Y_files']) as a:
-        nifti_path = a.readline().replace('\n', '')
-        nifti = loadFile(nifti_path)
-
-    NIFTIsize = nifti.shape
+    # Work out number of voxels.
+    NIFTIsize = context['dim']
     v = int(np.prod(NIFTIsize))
 
     # --------------------------------------------------------------------------------
@@ -136,8 +118,7 @@ def main(ipath, vb):
     n_sv = loadFile(os.path.join(OutDir,'blmm_vox_n.nii')).get_data().reshape([v,1])
 
     # Get ns.
-    X = loadFile(inputs['X'])
-    n = X.shape[0]
+    n = context['n']
 
     # --------------------------------------------------------------------------------
     # Read Mask 
@@ -146,21 +127,22 @@ def main(ipath, vb):
     # Read in the mask nifti.
     Mask = loadFile(os.path.join(OutDir,'blmm_vox_mask.nii')).get_data().reshape([v,1])
 
-    if 'analysis_mask' in inputs:
-
-        amask_path = inputs["analysis_mask"]
-        
-        # Read in the mask nifti.
-        amask = loadFile(amask_path).get_data().reshape([v,1])
-
-    else:
-
-        # By default make amask ones
-        amask = np.ones([v,1])
-
     # Get indices for whole analysis mask. These indices are the indices we
     # have recorded for the product matrices with respect to the entire volume
-    amInds = get_amInds(amask)
+    amInds = context['amInds']
+
+    # ------------------------------------------------------------------------
+    # Constants which depend only on the design (e.g. duplication matrices)
+    # are shared between jobs, if another job has already saved them
+    # ------------------------------------------------------------------------
+    designCacheFile = os.path.join(OutDir, 'tmp', 'blmm_design_cache.pkl')
+    if os.path.isfile(designCacheFile):
+        loadDesignCache(designCacheFile)
+
+    # ------------------------------------------------------------------------
+    # Write the outputs in the background, whilst we carry on computing
+    # ------------------------------------------------------------------------
+    startOutputSink()
 
     # ------------------------------------------------------------------------
     # Work out block of voxels we are looking at
@@ -169,7 +151,10 @@ def main(ipath, vb):
     # compute, in relation to the entire volume. If we aren't partitioning by 
     # block these will be equal to amInds
     pnvb = pracNumVoxelBlocks(inputs)
-    bamInds = get_amInds(amask, vb-1, pnvb) # Remem vb 0 indexed in py but 1 indexed in bash
+    if vb-1 >= 0: # Remem vb 0 indexed in py but 1 indexed in bash
+        bamInds = np.array_split(amInds, pnvb)[vb-1]
+    else:
+        bamInds = amInds
 
     # ------------------------------------------------------------------------
     # Split the voxels into computable groups
@@ -292,9 +277,9 @@ def main(ipath, vb):
             if v_lowrank:
 
                 # Remove low rank designs from the existing NIFTI files
-                addBlockToNifti(os.path.join(OutDir, 'blmm_vox_mask.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
-                addBlockToNifti(os.path.join(OutDir, 'blmm_vox_edf.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
-                addBlockToNifti(os.path.join(OutDir, 'blmm_vox_n.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize,aff=nifti.affine,hdr=nifti.header)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_mask.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_edf.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize)
+                addBlockToShard(os.path.join(OutDir, 'blmm_vox_n.nii'), np.zeros(v_lowrank), R_inds[lowrank_inds],volInd=0,dim=NIFTIsize)
             
                 # Remove from R_inds
                 R_inds = R_inds[fullrank_inds]
@@ -361,10 +346,13 @@ def main(ipath, vb):
             XtZ_r = ZtX_r.transpose(0,2,1)
 
             # Run parameter estimation
-            beta_r, sigma2_r, D_r = blmm_estimate.main(inputs, R_inds, XtX_r, XtY_r, XtZ_r, YtX_r, YtY_r, YtZ_r, ZtX_r, ZtY_r, ZtZ_r, n_sv_r, nlevels, nraneffs)
+            beta_r, sigma2_r, D_r, state_r = blmm_estimate.main(inputs, R_inds, XtX_r, XtY_r, XtZ_r, YtX_r, YtY_r, YtZ_r, ZtX_r, ZtY_r, ZtZ_r, n_sv_r, nlevels, nraneffs, returnState=True)
 
             # Run inference
-            blmm_inference.main(inputs, nraneffs, nlevels, R_inds, beta_r, D_r, sigma2_r, n_sv_r, XtX_r, XtY_r, XtZ_r, YtX_r, YtY_r, YtZ_r, ZtX_r, ZtY_r, ZtZ_r)
+            blmm_inference.main(inputs, nraneffs, nlevels, R_inds, beta_r, D_r, sigma2_r, n_sv_r, XtX_r, XtY_r, XtZ_r, YtX_r, YtY_r, YtZ_r, ZtX_r, ZtY_r, ZtZ_r, state=state_r)
+
+            # The state has been used up
+            del state_r
 
         if v_i:
 
@@ -374,10 +362,23 @@ def main(ipath, vb):
             XtZ_i = ZtX_i.transpose(0,2,1)
 
             # Run parameter estimation
-            beta_i, sigma2_i, D_i = blmm_estimate.main(inputs, I_inds,  XtX_i, XtY_i, XtZ_i, YtX_i, YtY_i, YtZ_i, ZtX_i, ZtY_i, ZtZ_i, n, nlevels, nraneffs)
+            beta_i, sigma2_i, D_i, state_i = blmm_estimate.main(inputs, I_inds,  XtX_i, XtY_i, XtZ_i, YtX_i, YtY_i, YtZ_i, ZtX_i, ZtY_i, ZtZ_i, n, nlevels, nraneffs, returnState=True)
 
             # Run inference
-            blmm_inference.main(inputs, nraneffs, nlevels, I_inds, beta_i, D_i, sigma2_i, n, XtX_i, XtY_i, XtZ_i, YtX_i, YtY_i, YtZ_i, ZtX_i, ZtY_i, ZtZ_i)
+            blmm_inference.main(inputs, nraneffs, nlevels, I_inds, beta_i, D_i, sigma2_i, n, XtX_i, XtY_i, XtZ_i, YtX_i, YtY_i, YtZ_i, ZtX_i, ZtY_i, ZtZ_i, state=state_i)
+
+            # The state has been used up
+            del state_i
+
+    # Wait for the outputs to be written, recording which were written so
+    # that cleanup can check they are all there
+    flushOutputSink(os.path.join(OutDir, 'tmp', 'blmm_shards_vb' + str(vb) + '.txt'))
+
+    # Save the design constants for later jobs and report how often they
+    # were reused
+    if not os.path.isfile(designCacheFile):
+        saveDesignCache(designCacheFile)
+    print(designCacheStats())
 
     w.resetwarnings()
 
@@ -385,9 +386,11 @@ def main(ipath, vb):
 # ============================================================================
 #
 # For a specified set of voxels, the below function reads in the unique 
-# product matrices A'B from each batch job, works out which voxel had which 
-# product matrix, sums the batch product matrices and returns the sum, i.e. 
-# the product matrix for the entire analysis, at each voxel.
+# product matrices A'B, summed across batches by the concat stage (see 
+# `blmm_concat.sumUniqueAtB`), and works out which voxel had which product 
+# matrix, using the global uniqueness map. The unique product matrices the
+# voxels need are read in once each and given to the voxels in a single 
+# gather.
 #
 # Note: This function is only designed for the product matrices; Z'X, Z'Z and
 # X'X.
@@ -399,11 +402,12 @@ def main(ipath, vb):
 # ----------------------------------------------------------------------------
 #
 # - `AtBstr`: A string representing which product matrix we are looking at. 
-#             i.e. "XtY" for X'Y, "ZtY" for Z'Y and "YtY" for Y'Y.
+#             i.e. "XtX" for X'X, "ZtX" for Z'X and "ZtZ" for Z'Z.
 # - `OutDir`: Output directory.
 # - `vinds`: Voxel indices; (flattened) indices representing which voxels we 
 #            are interested in looking at.
-# - `n_b`: The number of batches run during the batch stage.
+# - `n_b`: The number of batches run during the batch stage (unused, as the
+#          batches have already been summed by the concat stage).
 # - `sv`: Spatial varying boolean value. This tells us if we expect the
 #         product matrix to vary across these voxels, or whether we expect it
 #         to be the same for all of them.
@@ -422,84 +426,22 @@ def main(ipath, vb):
 # ============================================================================
 def readAndSumUniqueAtB(AtBstr, OutDir, vinds, n_b, sv):
 
-    # Work out the uniqueness mask for the spatially varying designs
-    uniquenessMask = loadFile(os.path.join(OutDir,"tmp", 
-        "blmm_vox_uniqueM_batch1.nii")).get_data()
-
-    v = np.prod(uniquenessMask.shape)
-    vcurrent = np.prod(vinds.shape)
-
-    uniquenessMask=uniquenessMask.reshape(v)
-
-    # Work out how many unique matrices there were
-    maxM = np.int32(np.amax(uniquenessMask))
+    # Read in the global uniqueness map for these voxels
+    uniquenessMask = np.load(os.path.join(OutDir,"tmp","uniqueM.npy"), mmap_mode='r')
 
     if sv:
-        # Work out the uniqueness mask inside the ring around the brain
-        uniquenessMask = uniquenessMask[vinds]
-    else:
-        # Work out the uniqueness mask value inside the inner part of the brain
-        uniquenessMask = uniquenessMask[vinds[0]] 
-
-
-    # read in XtX
-    AtB_batch_unique = np.load(
-        os.path.join(OutDir,"tmp",AtBstr+"1.npy"))
-
-    # Make zeros for outer ring of brain ZtZ, XtX, ZtX etc (remember A'B is still flattened)
-    if sv:
-        AtB = np.zeros((vcurrent, AtB_batch_unique.shape[1]))
-
-    # Fill with unique maskings
-    for m in range(1,maxM+1):
-
-        if sv:
-            # Work out Z'Z, Z'X and X'X for the ring
-            AtB[np.where(uniquenessMask==m),:] = AtB_batch_unique[(m-1),:]
 
-        # Work out Z'Z, Z'X and X'X for the inner
-        else:
-            if uniquenessMask == m:
-                AtB = AtB_batch_unique[(m-1),:]
+        # Work out which product matrices we need
+        uniqueIds, ids = np.unique(uniquenessMask[vinds], return_inverse=True)
 
-    # Cycle through batches and add together results.
-    for batchNo in range(2,(n_b+1)):
+        # Read them in and give each voxel its product matrix
+        AtB = readLinesFromNPY(os.path.join(OutDir,"tmp",AtBstr + ".npy"), uniqueIds-1)
+        AtB = AtB[ids.reshape(len(vinds)),:]
 
-        # Read in uniqueness Mask file
-        uniquenessMask = loadFile(os.path.join(OutDir,"tmp", 
-            "blmm_vox_uniqueM_batch" + str(batchNo) + ".nii")).get_data().reshape(v)
-
-        maxM = np.int32(np.amax(uniquenessMask))
-
-        if sv:
-            # Work out the uniqueness mask inside the ring around the brain
-            uniquenessMask = uniquenessMask[vinds] 
-        else:
-            # Work out the uniqueness mask value inside the inner part of the brain
-            uniquenessMask = uniquenessMask[vinds[0]] 
-
-
-        # read in XtX, ZtX, ZtZ
-        AtB_batch_unique = np.load(
-            os.path.join(OutDir,"tmp",AtBstr + str(batchNo) + ".npy"))
-
-        # Make zeros for whole nifti ZtZ, XtX, ZtX etc
-        if sv:
-            AtB_batch = np.zeros((vcurrent, AtB_batch_unique.shape[1]))
-
-        # Fill with unique maskings
-        for m in range(1,maxM+1):
-
-            if sv:
-                AtB_batch[np.where(uniquenessMask==m),:] = AtB_batch_unique[(m-1),:]
-            else:
-                # Work out Z'Z, Z'X and X'X for the inner
-                if uniquenessMask == m:
-
-                    AtB_batch = AtB_batch_unique[(m-1),:]
+    else:
 
-        # Add to running total
-        AtB = AtB + AtB_batch
+        # All voxels have the same product matrix
+        AtB = readLinesFromNPY(os.path.join(OutDir,"tmp",AtBstr + ".npy"), uniquenessMask[vinds[0]]-1)
 
     return(AtB)
 
@@ -8,7 +8,7 @@ import os
 import glob
 import shutil
 import yaml
-from BLMM.lib.fileio import loadFile, str2vec, pracNumVoxelBlocks, get_amInds, addBlockToNifti
+from BLMM.lib.fileio import pracNumVoxelBlocks, addBlockToNifti, get_blksize, buildRunContext, saveRunContext, loadYStore
 
 # ====================================================================================
 #
@@ -73,11 +73,20 @@ def main(*args):
     if ipath: 
 
         # Y files
-        if not os.path.isabs(inputs['Y_files']):
+        if 'Y_files' in inputs and not os.path.isabs(inputs['Y_files']):
 
             # Change Y in inputs
             inputs['Y_files'] = os.path.join(pwd, inputs['Y_files'])
 
+        # If an input store is specified (see `blmm_import.py`)
+        if 'Y_store' in inputs:
+
+            # Y store
+            if not os.path.isabs(inputs['Y_store']):
+
+                # Change Y store in inputs
+                inputs['Y_store'] = os.path.join(pwd, inputs['Y_store'])
+
         # If mask files are specified
         if 'data_mask_files' in inputs:
 
@@ -169,12 +178,6 @@ def main(*args):
     if os.path.exists(os.path.join(OutDir, 'tmp')):  
         shutil.rmtree(os.path.join(OutDir, 'tmp'))
 
-    # Get number of parameters
-    L1 = str2vec(inputs['contrasts'][0]['c' + str(1)]['vector'])
-    L1 = np.array(L1)
-    p = L1.shape[0]
-    del L1
-
     # Make output directory and tmp
     if not os.path.isdir(OutDir):
         os.mkdir(OutDir)
@@ -182,53 +185,40 @@ def main(*args):
         os.mkdir(os.path.join(OutDir, "tmp"))
 
     # Read in the Y_files (make sure to remove new line characters)
-    with open(inputs['Y_files']) as a:
+    if 'Y_store' in inputs:
+
+        # The store records the files it was made from (and is checked
+        # against any data masks given)
+        Y_files = loadYStore(inputs['Y_store'], inputs)['Y_files']
 
-        Y_files = []
-        i = 0
-        for line in a.readlines():
+    else:
 
-            Y_files.append(line.replace('\n', ''))
+        with open(inputs['Y_files']) as a:
 
-    # Load in one nifti to check NIFTI size
-    try:
-        Y0 = loadFile(Y_files[0])
-    except Exception as error:
-        raise ValueError('The NIFTI "' + Y_files[0] + '"does not exist')
+            Y_files = []
+            i = 0
+            for line in a.readlines():
+
+                Y_files.append(line.replace('\n', ''))
+
+    # Work out the metadata needed by every stage of the pipeline (this also
+    # checks the first NIFTI exists)
+    context = buildRunContext(inputs)
 
     # Get an estimate of the maximum memory a NIFTI could take in storage.
-    NIFTImem = sys.getsizeof(np.zeros(Y0.shape,dtype='uint64'))
+    NIFTImem = sys.getsizeof(np.zeros(context['dim'],dtype='uint64'))
 
     if NIFTImem > MAXMEM:
         raise ValueError('The NIFTI "' + Y_files[0] + '"is too large')
 
     # --------------------------------------------------------------------------------
-    # Get q and v
+    # Get p, q and v
     # --------------------------------------------------------------------------------
-    # Random factor variables.
-    rfxmats = inputs['Z']
+    # Number of fixed effects parameters
+    p = context['p']
 
     # Number of random effects
-    r = len(rfxmats)
-
-    # Number of random effects for each factor, q
-    nraneffs = []
-
-    # Number of levels for each factor, l
-    nlevels = []
-
-    for k in range(r):
-
-        rfxdes = loadFile(rfxmats[k]['f' + str(k+1)]['design'])
-        rfxfac = loadFile(rfxmats[k]['f' + str(k+1)]['factor'])
-
-        nraneffs = nraneffs + [rfxdes.shape[1]]
-        nlevels = nlevels + [len(np.unique(rfxfac))]
-
-    # Get number of random effects
-    nraneffs = np.array(nraneffs)
-    nlevels = np.array(nlevels)
-    q = np.sum(nraneffs*nlevels)
+    q = context['q']
 
     # Save q (useful to have around)
     inputs["q"] = str(q)
@@ -245,15 +235,13 @@ def main(*args):
         yaml.dump(inputs, outfile, default_flow_style=False)
 
     # Get v
-    NIFTIsize = Y0.shape
+    NIFTIsize = context['dim']
     v = int(np.prod(NIFTIsize))
 
-    # Similar to blksize in SwE, we divide by 8 times the size of a nifti
-    # to work out how many blocks we use. We also divide though everything
-    # by the number of parameters in the analysis.
-    blksize = int(np.floor(MAXMEM/8/NIFTImem/p))
-  
-    if blksize == 0:
+    # Work out how many observations each batch can hold.
+    blksize = get_blksize(inputs, NIFTImem, p, q)
+
+    if blksize <= 0:
         raise ValueError('Blocksize too small.')
 
     # Check F contrast ranks 
@@ -261,8 +249,7 @@ def main(*args):
     for i in range(0,n_c):
 
         # Read in contrast vector
-        cvec = str2vec(inputs['contrasts'][i]['c' + str(i+1)]['vector'])
-        cvec = np.array(cvec)
+        cvec = context['contrasts'][i]
 
         if cvec.ndim>1:
 
@@ -282,23 +269,8 @@ def main(*args):
             # Check if this is the first run of the disk memory code
             if not glob.glob(os.path.join(OutDir, 'blmm_vox_memmask*.nii')):
 
-                # --------------------------------------------------------------------------------
-                # Read Mask 
-                # --------------------------------------------------------------------------------
-                if 'analysis_mask' in inputs:
-
-                    amask_path = inputs["analysis_mask"]
-                    
-                    # Read in the mask nifti.
-                    amask = loadFile(amask_path).get_data().reshape([v,1])
-
-                else:
-
-                    # By default make amask ones
-                    amask = np.ones([v,1])
-
                 # Get indices for whole analysis mask. 
-                amInds = get_amInds(amask)
+                amInds = context['amInds']
 
                 # ------------------------------------------------------------------------
                 # Split the voxels into computable groups
@@ -319,7 +291,7 @@ def main(*args):
                 for cv in range(nvg):
 
                     # Save the masks for each block
-                    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_memmask'+str(cv+1)+'.nii'), np.ones(len(voxelGroups[cv])), voxelGroups[cv],volInd=0,dim=NIFTIsize,aff=Y0.affine,hdr=Y0.header)
+                    addBlockToNifti(os.path.join(OutDir, 'blmm_vox_memmask'+str(cv+1)+'.nii'), np.ones(len(voxelGroups[cv])), voxelGroups[cv],volInd=0,dim=NIFTIsize,aff=context['affine'],hdr=context['header'])
 
             # --------------------------------------------------------------------------------
             # Set the analysis mask to the first one that comes up with ls, run that and then
@@ -334,6 +306,12 @@ def main(*args):
             with open(ipath, 'w') as outfile:
                 yaml.dump(inputs, outfile, default_flow_style=False)
 
+            # The analysis mask has changed
+            context = buildRunContext(inputs)
+
+    # Save the run context for the later stages of the pipeline
+    saveRunContext(inputs, context)
+
     # If in voxel batching mode, save the number of voxel batches we need
     if 'voxelBatching' in inputs:
 
@@ -0,0 +1,323 @@
+import warnings as w
+# This warning is caused by numpy updates and should
+# be ignored for now.
+w.simplefilter(action = 'ignore', category = FutureWarning)
+import sys
+import os
+import glob
+import json
+import time
+import copy
+import traceback
+import yaml
+from BLMM.src.blmm_local import runJob
+from BLMM.lib import fileio, npMatrix2d
+
+# ====================================================================================
+#
+# This file contains a long-lived worker for the BLMM pipeline. Rather than starting
+# a fresh interpreter (and importing numpy, scipy, nibabel, etc.) for every job, any
+# number of workers can be started once and left to pull jobs from a queue directory,
+# running each one in-process. Each job is given as a "task" file in the queue
+# directory, with the extension `.task`, containing a JSON object of the form:
+#
+#     {"stage": "batch", "args": [1, "/path/to/inputs.yml"]}
+#
+# where `stage` is one of `setup`, `batch`, `concat`, `results` or `cleanup` and
+# `args` are the arguments to the `main` function of that stage (see `submitTask`).
+#
+# Each task is run with the same state as a fresh process would have; the run
+# contexts and design constants cached by earlier tasks are discarded first, as the
+# analysis in an output directory may have been set up again (by this or any other
+# worker, or by the cluster scripts) since they were cached.
+#
+# A worker claims a task by renaming it, so each task is run by exactly one worker.
+# Once the task has been run the worker renames it again, to `.done` if it succeeded,
+# or `.failed` (with the error appended) if it did not. The time taken by each task,
+# excluding start-up, is printed and recorded in the `.done` file.
+#
+# ------------------------------------------------------------------------------------
+#
+# The code takes the following inputs:
+#
+#  - `queueDir`: The queue directory.
+#  - `idleTimeout` (optional): If given, the worker stops once it has been idle (i.e.
+#                              found no tasks to run) for this many seconds.
+#                              Otherwise, the worker stops once a file named `stop`
+#                              is created in the queue directory.
+#
+# ====================================================================================
+def main(queueDir, idleTimeout=None):
+
+    if idleTimeout is not None:
+        idleTimeout = float(idleTimeout)
+
+    # Make the queue directory if it doesn't exist
+    os.makedirs(queueDir, exist_ok=True)
+
+    print('Worker ' + str(os.getpid()) + ' waiting for tasks in ' + queueDir)
+
+    # Record time spent on tasks
+    ntasks = 0
+    taskTime = 0
+    t0 = time.time()
+    lastTask = time.time()
+
+    while True:
+
+        # Check whether we have been asked to stop
+        if os.path.isfile(os.path.join(queueDir, 'stop')):
+            break
+
+        # Claim the next task
+        task = claimTask(queueDir)
+
+        if task is None:
+
+            # Check if we have been idle for too long
+            if idleTimeout is not None and time.time()-lastTask > idleTimeout:
+                break
+
+            time.sleep(0.1)
+            continue
+
+        # Run the task
+        jobTime = runTask(task)
+
+        ntasks = ntasks + 1
+        taskTime = taskTime + jobTime
+        lastTask = time.time()
+
+    print('Worker ' + str(os.getpid()) + ' ran ' + str(ntasks) + ' task(s) in ' +
+          '{:.2f}'.format(taskTime) + 's (' + '{:.2f}'.format(time.time()-t0) + 's alive)')
+
+
+# ============================================================================
+#
+# The below function adds a task to the queue directory. The task is written
+# under a temporary name and then renamed, so that workers never see a
+# partially written task.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `queueDir`: The queue directory.
+#  - `stage`: The stage of the pipeline to run (e.g. 'batch').
+#  - `args`: The arguments to the `main` function of the stage.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `taskFile`: The task file.
+#
+# ============================================================================
+def submitTask(queueDir, stage, *args):
+
+    os.makedirs(queueDir, exist_ok=True)
+
+    # Tasks are run in the order they were submitted
+    taskFile = os.path.join(queueDir, '{:.6f}'.format(time.time()) + '_' + str(os.getpid()) +
+                            '_' + stage + '.task')
+
+    with open(taskFile + '.part', 'w') as f:
+        json.dump({'stage': stage, 'args': list(args)}, f)
+    os.replace(taskFile + '.part', taskFile)
+
+    return(taskFile)
+
+
+# ============================================================================
+#
+# The below function waits for the given tasks to be run by the workers.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `taskFiles`: The task files (as returned by `submitTask`).
+#
+# ============================================================================
+def waitForTasks(taskFiles):
+
+    for taskFile in taskFiles:
+
+        while not os.path.isfile(taskFile[:-len('.task')] + '.done'):
+
+            # Check for errors
+            if os.path.isfile(taskFile[:-len('.task')] + '.failed'):
+                raise Exception('Task ' + os.path.basename(taskFile) + ' failed, see ' +
+                                taskFile[:-len('.task')] + '.failed')
+
+            time.sleep(0.1)
+
+
+# ============================================================================
+#
+# The below function claims the oldest task in the queue directory, by
+# renaming it. If another worker claims the task first, the next task is
+# tried instead.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `queueDir`: The queue directory.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `task`: The claimed task file, or None if there are no tasks waiting.
+#
+# ============================================================================
+def claimTask(queueDir):
+
+    for taskFile in sorted(glob.glob(os.path.join(queueDir, '*.task'))):
+
+        # Only one worker can rename the task
+        claimed = taskFile + '.' + str(os.getpid()) + '.running'
+        try:
+            os.rename(taskFile, claimed)
+            return(claimed)
+        except FileNotFoundError:
+            continue
+
+    return(None)
+
+
+# ============================================================================
+#
+# The below function runs a claimed task and records the outcome.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `task`: The claimed task file.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `jobTime`: The time taken to run the task.
+#
+# ============================================================================
+def runTask(task):
+
+    # The task file, without the extension added when it was claimed
+    taskFile = task[:task.rindex('.task')+len('.task')]
+
+    with open(task) as f:
+        spec = json.load(f)
+
+    # Discard anything cached by previous tasks
+    clearCaches()
+
+    t1 = time.time()
+
+    try:
+
+        # The batch stage can be given the inputs directly, saving each batch
+        # from parsing the inputs file again
+        args = spec['args']
+        if spec['stage'] == 'batch' and len(args) > 1 and isinstance(args[1], str):
+            args = [args[0], loadInputs(args[1])] + args[2:]
+
+        runJob(spec['stage'], *args)
+
+        jobTime = time.time() - t1
+
+        # Record the time taken
+        spec['time'] = jobTime
+        with open(task, 'w') as f:
+            json.dump(spec, f)
+        os.replace(task, taskFile[:-len('.task')] + '.done')
+
+        print('Task ' + os.path.basename(taskFile) + ': ' + '{:.2f}'.format(jobTime) + 's')
+
+    except Exception:
+
+        jobTime = time.time() - t1
+
+        # Record the error
+        spec['error'] = traceback.format_exc()
+        with open(task, 'w') as f:
+            json.dump(spec, f)
+        os.replace(task, taskFile[:-len('.task')] + '.failed')
+
+        print('Task ' + os.path.basename(taskFile) + ' failed after ' + '{:.2f}'.format(jobTime) + 's:')
+        print(spec['error'])
+
+    return(jobTime)
+
+
+# ============================================================================
+#
+# The below function discards the run contexts (see `fileio.getRunContext`)
+# and design constants (see `npMatrix2d.designConstant`) cached by this
+# process.
+#
+# ============================================================================
+def clearCaches():
+
+    fileio.runContexts.clear()
+
+    npMatrix2d.designCache['constants'].clear()
+    npMatrix2d.designCache['hits'] = 0
+    npMatrix2d.designCache['misses'] = 0
+
+
+# ============================================================================
+#
+# The below function reads in an inputs file, keeping the inputs in memory
+# for later tasks which use the same file. The file is only read in again if
+# it has been modified.
+#
+# ----------------------------------------------------------------------------
+#
+# This function takes in the following inputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `ipath`: Path to an `inputs` yml file.
+#
+# ----------------------------------------------------------------------------
+#
+# This function gives as outputs:
+#
+# ----------------------------------------------------------------------------
+#
+#  - `inputs`: A copy of the inputs.
+#
+# ============================================================================
+inputsCache = dict()
+
+def loadInputs(ipath):
+
+    mtime = os.path.getmtime(ipath)
+
+    if ipath not in inputsCache or inputsCache[ipath][0] != mtime:
+        with open(ipath, 'r') as stream:
+            inputsCache[ipath] = (mtime, yaml.load(stream,Loader=yaml.FullLoader))
+
+    return(copy.deepcopy(inputsCache[ipath][1]))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
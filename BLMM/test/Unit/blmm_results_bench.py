@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import time
+
+# Add BLMM to the python path (blmm_results imports from src).
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','..'))
+from BLMM.src.blmm_results import readAndSumUniqueAtB
+
+# =============================================================================
+# This file contains micro-benchmarks for functions given in the
+# blmm_results.py file.
+# =============================================================================
+
+
+# =============================================================================
+#
+# The below function is a loop based version of `readAndSumUniqueAtB`, which
+# loops over every unique design, searching for the voxels which had it. It
+# is kept here as a reference for the benchmark below.
+#
+# =============================================================================
+def readAndSumUniqueAtB_loop(AtBstr, OutDir, vinds):
+
+    # Read in the global uniqueness map for these voxels
+    uniquenessMask = np.load(os.path.join(OutDir,"tmp","uniqueM.npy"))[vinds]
+
+    maxM = np.int64(np.amax(uniquenessMask))
+
+    # Read in the summed unique product matrices
+    AtB_unique = np.load(os.path.join(OutDir,"tmp",AtBstr + ".npy"))
+
+    # Fill with unique maskings
+    AtB = np.zeros((len(vinds), AtB_unique.shape[1]))
+    for m in range(1,maxM+1):
+        AtB[np.where(uniquenessMask==m),:] = AtB_unique[(m-1),:]
+
+    return(AtB)
+
+
+# =============================================================================
+#
+# The below function benchmarks `readAndSumUniqueAtB` against the loop based
+# implementation for increasing numbers of unique designs. For each number of
+# designs, the outputs of the concat stage (the global uniqueness map and the
+# summed unique product matrices) are simulated, the time taken by both
+# implementations is printed and the outputs are checked to be equal.
+#
+# =============================================================================
+def bench_readAndSumUniqueAtB(npatterns=[10, 100, 1000, 10000], v=20000, n_b=3, k=16):
+
+    # Record whether the outputs matched
+    result = 'Passed'
+
+    print('=============================================================')
+    print('Benchmark for: readAndSumUniqueAtB')
+    print('-------------------------------------------------------------')
+    print('Voxels: ', v)
+    print('-------------------------------------------------------------')
+
+    for m in npatterns:
+
+        # Simulate the concat outputs
+        OutDir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(OutDir,"tmp"))
+
+        # Global uniqueness map (with some voxels outside the mask)
+        np.save(os.path.join(OutDir,"tmp","uniqueM.npy"), np.random.randint(0, m+1, v))
+
+        # Summed unique product matrices
+        np.save(os.path.join(OutDir,"tmp","XtX.npy"), np.random.randn(m, k))
+
+        # Only look at voxels in the mask
+        vinds = np.where(np.load(os.path.join(OutDir,"tmp","uniqueM.npy")) > 0)[0]
+
+        # Time the loop based implementation
+        t1 = time.time()
+        expected = readAndSumUniqueAtB_loop('XtX', OutDir, vinds)
+        t2 = time.time()
+
+        # Time the current implementation
+        AtB = readAndSumUniqueAtB('XtX', OutDir, vinds, n_b, True)
+        t3 = time.time()
+
+        if not np.allclose(AtB, expected):
+            result = 'Failed'
+
+        print('Designs: ', m, ', loop: ', '{:.4f}'.format(t2-t1), 's, gather: ', '{:.4f}'.format(t3-t2), 's')
+
+        shutil.rmtree(OutDir)
+
+    print('-------------------------------------------------------------')
+    print('Result: ', result)
+
+    return(result)
+
+
+if __name__ == "__main__":
+    bench_readAndSumUniqueAtB()
@@ -935,6 +935,55 @@ def test_pSFS3D():
     print('      Computation time: ', t2-t1)
 
 
+# =============================================================================
+#
+# The below function tests that the way `pSFS3D` removes converged voxels
+# from its arrays (see `compactRows` in npMatrix3d.py) does not change its
+# estimates. It does this by comparing the estimates obtained when the
+# arrays are reallocated every time a voxel converges to those obtained when
+# voxels are instead moved within the arrays, for both spatially varying and
+# non-spatially varying designs.
+#
+# =============================================================================
+def test_compact_pSFS3D():
+
+    # Generate a random mass univariate linear mixed model.
+    Y,X,Z,nlevels,nraneffs,beta,sigma2,b,D,X_sv,Z_sv,n_sv = genTestData3D(v=20)
+    XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, XtX_sv, XtY_sv, XtZ_sv, YtX_sv, YtZ_sv, ZtX_sv, ZtY_sv, ZtZ_sv = prodMats3D(Y,Z,X,Z_sv,X_sv)
+    n = Y.shape[1]
+    n_sv = n_sv.reshape(n_sv.shape[0])
+
+    # Spatially varying and non-spatially varying products
+    cases = {'Spatially Varying': (XtX_sv, XtY_sv, ZtX_sv, ZtY_sv, ZtZ_sv, XtZ_sv, YtZ_sv, YtY, YtX_sv, nlevels, nraneffs, 1e-6, n_sv),
+             'Non Spatially Varying': (XtX, XtY, ZtX, ZtY, ZtZ, XtZ, YtZ, YtY, YtX, nlevels, nraneffs, 1e-6, n)}
+
+    print('==============================================================')
+    print('Unit test for: pSFS (removing converged voxels)')
+    print('--------------------------------------------------------------')
+
+    for case in cases:
+
+        # Reallocate the arrays every time a voxel converges
+        for stat in compactionStats:
+            compactionStats[stat] = 0
+        paramVec_copy, nits_copy = pSFS3D(*cases[case], reml=True, returnNits=True, compact=0)
+
+        # Only move voxels within the arrays (after the first reallocation)
+        for stat in compactionStats:
+            compactionStats[stat] = 0
+        paramVec_move, nits_move = pSFS3D(*cases[case], reml=True, returnNits=True, compact=1)
+
+        print('      Results (' + case + '): ')
+        print('         Max difference: ', np.max(np.abs(paramVec_copy-paramVec_move)))
+        print('         Reallocations:  ', compactionStats['compactions'])
+
+        # Converged voxels are never updated, and the estimates do not depend
+        # on how they are removed
+        assert compactionStats['wasted'] == 0
+        assert np.array_equal(nits_copy, nits_move)
+        assert np.allclose(paramVec_copy, paramVec_move, rtol=1e-10, atol=1e-12)
+
+
 # =============================================================================
 #
 # The below function runs all unit tests and outputs the results.
@@ -954,6 +1003,9 @@ def run_all3D():
     # Test FS3D
     test_pSFS3D()
 
+    # Test removing converged voxels in pSFS3D
+    test_compact_pSFS3D()
+
     print('=============================================================')
 
     print('Tests completed')
@@ -931,6 +931,45 @@ def test_faclev_indices2D():
     return(result)
 
 
+# =============================================================================
+#
+# The below function tests the design constants cache (`designConstant` and
+# the functions which use it). It does this by checking the cached constants
+# against the functions they are computed by, and that a repeated request is
+# served from the cache.
+#
+# =============================================================================
+def test_designConstant():
+
+    # Test nlevels, nraneffs
+    nlevels = np.array([3,4,2,8])
+    nraneffs = np.array([1,2,3,4])
+
+    # Check the indices for every level of factor 2 against faclev_indices2D
+    Ikjs = faclevs_indices2D(2, nlevels, nraneffs)
+    testVal = all(np.array_equal(Ikjs[j], faclev_indices2D(2, j, nlevels, nraneffs)) for j in np.arange(nlevels[2]))
+
+    # Check the transposed duplication matrix
+    testVal = testVal and np.allclose(dupMatT2D(3), dupMat2D(3).toarray().transpose())
+
+    # Check a repeated request is a cache hit, returning the same constant
+    hits = designCache['hits']
+    testVal = testVal and (faclevs_indices2D(2, nlevels, nraneffs) is Ikjs) and designCache['hits'] == hits + 1
+
+    # Result
+    if testVal:
+        result = 'Passed'
+    else:
+        result = 'Failed'
+
+    print('=============================================================')
+    print('Unit test for: designConstant')
+    print('-------------------------------------------------------------')
+    print('Result: ', result)
+
+    return(result)
+
+
 # =============================================================================
 #
 # The below function tests the function `initBeta2D`. It does this by 
@@ -2612,6 +2651,16 @@ def run_all2D():
         failedTests = np.append(failedTests, name)
 
 
+    # Test designConstant
+    name = 'designConstant'
+    result = test_designConstant()
+    # Add result to arrays.
+    if result=='Passed':
+        passedTests = np.append(passedTests, name)
+    if result=='Failed':
+        failedTests = np.append(failedTests, name)
+
+
     # Test initBeta2D
     name = 'initBeta2D'
     result = test_initBeta2D()
@@ -775,7 +775,13 @@ def test_get_DinvIplusZtZD3D():
         testVal_sv = testVal_sv and np.allclose(DinvIplusZtZD_sv_test[testv,:,i*q0:(i+1)*q0],DinvIplusZtZD_sv_expected[testv,i*q0:(i+1)*q0,i*q0:(i+1)*q0])
         testVal_nsv = testVal_nsv and np.allclose(DinvIplusZtZD_nsv_test[0,:,i*q0:(i+1)*q0],DinvIplusZtZD_nsv_expected[0,i*q0:(i+1)*q0,i*q0:(i+1)*q0])
 
-    testVal_tc2 = testVal_nsv and testVal_sv
+    # Check the log determinant of I+Z'ZD (sv)
+    logdet_sv_expected = np.linalg.slogdet(np.eye(q) + D @ ZtZ_sv)
+    logdet_sv_expected = logdet_sv_expected[0]*logdet_sv_expected[1]
+    logdet_sv_test = get_DinvIplusZtZD3D(Ddict, D, ZtZ_sv_flattened, nlevels, nraneffs, returnLogdet=True)[1]
+    testVal_logdet = np.allclose(logdet_sv_test,logdet_sv_expected)
+
+    testVal_tc2 = testVal_nsv and testVal_sv and testVal_logdet
 
     # -------------------------------------------------------------------------
     # Test case 3: multiple random factors, multiple random effects
@@ -819,7 +825,12 @@ def test_get_DinvIplusZtZD3D():
     # Check if results are all close.
     testVal_nsv = np.allclose(DinvIplusZtZD_nsv_test,DinvIplusZtZD_nsv_expected)
     testVal_sv = np.allclose(DinvIplusZtZD_sv_test,DinvIplusZtZD_sv_expected)
-    testVal_tc3 = testVal_nsv and testVal_sv
+
+    # Test result using block elimination (sv)
+    DinvIplusZtZD_schur_test = get_DinvIplusZtZD3D(Ddict, D, ZtZ_sv, nlevels, nraneffs, schur=True)
+    testVal_schur = np.allclose(DinvIplusZtZD_schur_test,DinvIplusZtZD_sv_expected)
+
+    testVal_tc3 = testVal_nsv and testVal_sv and testVal_schur
 
     # Combine test values from all cases
     testVal = testVal_tc1 and testVal_tc2 and testVal_tc3
@@ -4343,6 +4354,107 @@ def test_get_swdf_F3D():
     
     return(result)
 
+# =============================================================================
+#
+# The below function tests the function `get_swdf_F3D` for contrast matrices
+# with several rows. It does this by simulating random test data and testing
+# against the row by row calculation using `get_swdf_T3D`.
+#
+# =============================================================================
+def test_get_swdf_F3D_rows():
+
+    # Number of voxels
+    v = 10
+
+    # Test values for each case
+    testVals = []
+
+    # Test case 1: 1 random factor, 1 random effect, test case 2: 1 random
+    # factor, multiple random effects and test case 3: multiple random factors,
+    # multiple random effects
+    for nlevels, nraneffs in [(np.array([800]), np.array([1])), (np.array([300]), np.array([2])), (None, None)]:
+
+        # Generate a random mass univariate linear mixed model.
+        if nlevels is None:
+            Y,X,Z,nlevels,nraneffs,beta,sigma2,b,D,X_sv,Z_sv,n_sv = genTestData3D(v=v)
+        else:
+            Y,X,Z,nlevels,nraneffs,beta,sigma2,b,D,X_sv,Z_sv,n_sv = genTestData3D(v=v, nlevels=nlevels, nraneffs=nraneffs)
+        n = Y.shape[1]
+        q = np.sum(nlevels*nraneffs)
+        p = X.shape[1]
+
+        # Generate product matrices
+        XtX, XtY, XtZ, YtX, YtY, YtZ, ZtX, ZtY, ZtZ, XtX_sv, XtY_sv, XtZ_sv, YtX_sv, YtZ_sv, ZtX_sv, ZtY_sv, ZtZ_sv = prodMats3D(Y,Z,X,Z_sv,X_sv)
+
+        # Obtain D(I+Z'ZD)^(-1)
+        DinvIplusZtZD = D @ np.linalg.inv(np.eye(q) + ZtZ @ D)
+
+        # Use the diagonal forms in the one random factor, one random effect
+        # case and the flattened forms in the one random factor, multiple 
+        # random effects case
+        if len(nraneffs)==1 and nraneffs[0]==1:
+            ZtZ = np.einsum('ijj->ij', ZtZ)
+            DinvIplusZtZD = np.einsum('ijj->ij', DinvIplusZtZD)
+        elif len(nraneffs)==1:
+            ZtZ = flattenZtZ(ZtZ, nlevels[0], nraneffs[0])
+            DinvIplusZtZD = flattenZtZ(DinvIplusZtZD, nlevels[0], nraneffs[0])
+
+        # Test contrast matrix (with rank 2)
+        L = np.random.binomial(1,0.5,size=(2,p))
+        L[0,0]=1
+        L[0,1]=0
+        L[1,0]=0
+        L[1,1]=1
+
+        # L is rL in rank
+        rL = np.linalg.matrix_rank(L)
+
+        # X'V^(-1)X
+        XtiVX = X.transpose() @ np.linalg.inv(np.eye(n) + Z @ D @ Z.transpose()) @ X
+
+        # Z'V^(-1)X
+        ZtiVX = Z.transpose() @ np.linalg.inv(np.eye(n) + Z @ D @ Z.transpose()) @ X
+
+        # Initialize empty sum.
+        sum_swdf_adj = 0
+
+        # Loop through first rL rows of L
+        for i in np.arange(rL):
+
+            # Work out the swdf for each row of L
+            swdf_row = get_swdf_T3D(L[i:(i+1),:], sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs).reshape(v)
+
+            # Work out adjusted df = df/(df-2)
+            swdf_adj = swdf_row/(swdf_row-2)
+
+            # Add to running sum
+            sum_swdf_adj = sum_swdf_adj + swdf_adj
+
+        # Work out final df
+        swdf_expected = 2*sum_swdf_adj/(sum_swdf_adj-rL)
+
+        # Function version 
+        swdf_test = get_swdf_F3D(L, sigma2, XtiVX, ZtiVX, XtZ, ZtX, ZtZ, DinvIplusZtZD, n, nlevels, nraneffs)
+
+        # Check if results are all close.
+        testVals.append(np.allclose(swdf_test,swdf_expected))
+
+    # Combine the test values
+    testVal = all(testVals)
+
+    # Result
+    if testVal:
+        result = 'Passed'
+    else:
+        result = 'Failed'
+
+    print('=============================================================')
+    print('Unit test for: get_swdf_F3D (multiple rows)')
+    print('-------------------------------------------------------------')
+    print('Result: ', result)
+    
+    return(result)
+
 # =============================================================================
 #
 # The below function tests the function `get_dS23D`. It does this by
@@ -5345,6 +5457,16 @@ def run_all3D():
         failedTests = np.append(failedTests, name)
 
 
+    # Test get_swdf_F3D for contrast matrices with several rows
+    name = 'get_swdf_F3D (multiple rows)'
+    result = test_get_swdf_F3D_rows()
+    # Add result to arrays.
+    if result=='Passed':
+        passedTests = np.append(passedTests, name)
+    if result=='Failed':
+        failedTests = np.append(failedTests, name)
+
+
     # Test get_dS23D
     name = 'get_dS23D'
     result = test_get_dS23D()